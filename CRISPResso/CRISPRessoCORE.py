@@ -8,7 +8,7 @@ https://github.com/lucapinello/CRISPResso
 '''
 
 
-__version__ = "1.0.12"
+__version__ = "1.0.13"
 
 import sys
 import errno
@@ -17,11 +17,23 @@ import subprocess as sb
 import argparse
 import re
 import gzip
-from collections import defaultdict
+from collections import defaultdict,Counter
 import multiprocessing as mp
 import cPickle as cp
 import unicodedata
 import traceback
+import hashlib
+import itertools
+import sqlite3
+import time
+import zlib
+import random
+import importlib
+import json
+import socket
+import tempfile
+
+_START_TIME=time.time()
 
 
 import logging
@@ -45,11 +57,33 @@ def get_data(path):
 
 def check_library(library_name):
         try:
-                return __import__(library_name)
+                return importlib.import_module(library_name)
         except:
                 error('You need to install %s module to use CRISPResso!' % library_name)
                 sys.exit(1)
 
+#seconds spent importing each library loaded with LazyLibrary, reported with --debug
+LIBRARY_IMPORT_TIMES={}
+
+class LazyLibrary(object):
+        '''
+        A library checked and imported the first time one of its attributes is used, so that the commands that do not
+        need it (for example --help or a run with --plot_level none) do not pay for its import
+        '''
+        def __init__(self,library_name):
+                self._library_name=library_name
+                self._library=None
+
+        def import_library(self):
+                if self._library is None:
+                        start_time=time.time()
+                        self._library=check_library(self._library_name)
+                        LIBRARY_IMPORT_TIMES[self._library_name]=time.time()-start_time
+                return self._library
+
+        def __getattr__(self,attribute_name):
+                return getattr(self.import_library(),attribute_name)
+
 
 def which(program):
         import os
@@ -69,13 +103,33 @@ def which(program):
 
         return None
 
+#programs already found in the PATH, each program is checked only once
+_checked_programs=set()
+
 def check_program(binary_name,download_url=None):
+        if binary_name in _checked_programs:
+                return
+
         if not which(binary_name):
                 error('You need to install and have the command #####%s##### in your PATH variable to use CRISPResso!\n Please read the documentation!' % binary_name)
                 if download_url:
                         error('You can download it from here:%s' % download_url)
                 sys.exit(1)
 
+        _checked_programs.add(binary_name)
+
+def check_required_programs(args):
+        '''
+        Check the programs needed to preprocess and align the reads with the options in args
+        '''
+        if args.trim_sequences:
+                check_program('java')
+        if args.fastq_r2:
+                check_program('flash')
+        #the quick estimate does not align the reads
+        if not args.quick_estimate:
+                check_program('needle')
+
 
 def check_file(filename):
     try:
@@ -198,31 +252,643 @@ def get_n_reads_fastq(fastq_filename):
      p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
      return int(float(p.communicate()[0])/4.0)
 
-matplotlib=check_library('matplotlib')
-from matplotlib import font_manager as fm
-font = {'size'   : 22}
-matplotlib.rc('font', **font)
-matplotlib.use('Agg')
+def read_fastq(fastq_filename,full_header=False):
+    if fastq_filename.endswith('.gz'):
+        fastq_handle=gzip.open(fastq_filename)
+    else:
+        fastq_handle=open(fastq_filename)
+
+    #we stream the records, the file can be much bigger than the memory
+    header=fastq_handle.readline()
+    while header:
+        seq=fastq_handle.readline().strip()
+        fastq_handle.readline()
+        qual=fastq_handle.readline().strip()
+
+        if header.strip():
+            yield header[1:].rstrip('\n') if full_header else header[1:].split()[0],seq,qual
+
+        header=fastq_handle.readline()
+
+    fastq_handle.close()
+
+def extract_umi(header,seq,qual,umi_regex=None,umi_length=0):
+    '''
+    Returns (umi,seq,qual): the UMI is searched in the read header with umi_regex (the first group if
+    present) or taken from the first umi_length bases, which are removed from the read. The UMI is None
+    if not found.
+    '''
+    if umi_regex is not None:
+        m=umi_regex.search(header)
+        if not m:
+            return None,seq,qual
+        return (m.group(1) if m.groups() else m.group(0)),seq,qual
+    else:
+        if len(seq)<=umi_length:
+            return None,seq,qual
+        return seq[:umi_length],seq[umi_length:],qual[umi_length:]
+
+def umi_consensus(family):
+    '''
+    Majority consensus of the (seq,qual) reads of a UMI family. Only the reads with the most common length
+    are used, ties are broken by the sum of the base qualities and positions still tied are set to N. The
+    quality is the best quality supporting the consensus base.
+    '''
+    if len(family)==1:
+        return family[0]
+
+    length_counts=Counter([len(seq) for seq,qual in family])
+    consensus_length=max(length_counts.keys(),key=lambda length: (length_counts[length],-length))
+    family=[(seq,qual) for seq,qual in family if len(seq)==consensus_length]
+
+    consensus_seq=[]
+    consensus_qual=[]
+    for bases,quals in itertools.izip(itertools.izip(*[seq for seq,qual in family]),itertools.izip(*[qual for seq,qual in family])):
+        base_scores=defaultdict(lambda: [0,0])
+        for b,q in itertools.izip(bases,quals):
+            base_scores[b][0]+=1
+            base_scores[b][1]+=ord(q)
+        ranked_bases=sorted(base_scores.keys(),key=lambda b: base_scores[b],reverse=True)
+
+        if len(ranked_bases)>1 and base_scores[ranked_bases[0]]==base_scores[ranked_bases[1]]:
+            consensus_seq.append('N')
+            consensus_qual.append(min(quals))
+        else:
+            consensus_base=ranked_bases[0]
+            consensus_seq.append(consensus_base)
+            consensus_qual.append(max([q for b,q in itertools.izip(bases,quals) if b==consensus_base]))
+
+    return ''.join(consensus_seq),''.join(consensus_qual)
+
+def collapse_umi_families(fastq_filename,output_filename,tmp_folder,umi_regex='',umi_length=0,min_family_size=1,n_buckets=16):
+    '''
+    Collapse the reads sharing the same UMI in one consensus read. The reads are first partitioned by UMI
+    hash in n_buckets temporary files, so only one bucket at a time is kept in memory. The consensus reads
+    are written with the UMI as read id. Returns the number of reads with a UMI, the number of reads in
+    families of at least min_family_size reads and a dictionary read id->family size.
+    '''
+    if umi_regex:
+        try:
+            umi_regex=re.compile(umi_regex)
+        except re.error as e:
+            raise UMIException('The UMI regular expression %s is not valid: %s' % (umi_regex,e))
+    else:
+        umi_regex=None
+
+    bucket_filenames=[os.path.join(tmp_folder,'umi_bucket_%d.txt.gz' % idx_bucket) for idx_bucket in range(n_buckets)]
+    bucket_handles=[gzip.open(bucket_filename,'wb',compresslevel=1) for bucket_filename in bucket_filenames]
 
-plt=check_library('pylab')
-from matplotlib import font_manager as fm
-from matplotlib import colors as colors_mpl
-import matplotlib.gridspec as gridspec
+    n_reads_with_umi=0
+    n_reads_without_umi=0
+    for header,seq,qual in read_fastq(fastq_filename,full_header=True):
+        umi,seq,qual=extract_umi(header,seq,qual,umi_regex,umi_length)
+        if not umi:
+            n_reads_without_umi+=1
+            continue
 
-pd=check_library('pandas')
-np=check_library('numpy')
-Bio=check_library('Bio')
+        bucket_handles[zlib.crc32(umi) % n_buckets].write('%s\t%s\t%s\n' % (umi,seq,qual))
+        n_reads_with_umi+=1
+
+    for bucket_handle in bucket_handles:
+        bucket_handle.close()
+
+    if n_reads_without_umi:
+        warn('Skipped %d reads without UMI.' % n_reads_without_umi)
+
+    if n_reads_with_umi==0:
+        for bucket_filename in bucket_filenames:
+            os.remove(bucket_filename)
+        raise UMIException('No UMI was found in the reads, please check the options --umi_regex and --umi_length.')
+
+    n_reads_in_families=0
+    family_sizes={}
+    with gzip.open(output_filename,'w+') as outfile:
+        for bucket_filename in bucket_filenames:
+            families=defaultdict(list)
+            with gzip.open(bucket_filename) as infile:
+                for line in infile:
+                    umi,seq,qual=line.rstrip('\n').split('\t')
+                    families[umi].append((seq,qual))
+
+            for umi in sorted(families.keys()):
+                family=families[umi]
+                if len(family)<min_family_size:
+                    continue
+
+                consensus_seq,consensus_qual=umi_consensus(family)
+                read_id='UMI_%s' % umi
+                outfile.write('@%s reads=%d\n%s\n+\n%s\n' % (read_id,len(family),consensus_seq,consensus_qual))
+
+                family_sizes[read_id]=len(family)
+                n_reads_in_families+=len(family)
+
+            del families
+            os.remove(bucket_filename)
+
+    return n_reads_with_umi,n_reads_in_families,family_sizes
+
+
+def parse_needle_output(needle_filename,name='seq',just_score=False):
+        needle_data=[]
+
+        try:
+            needle_infile=gzip.open(needle_filename)
+
+            line=needle_infile.readline()
+            while line:
+
+                    while line and ('# Aligned_sequences' not  in line):
+                            line=needle_infile.readline()
+
+                    if line:
+                            #print line
+                            needle_infile.readline() #skip another line
+
+                            line=needle_infile.readline()
+                            id_seq=line.split()[-1].replace('_',':')
+
+                            for _ in range(5):
+                                    needle_infile.readline()
+
+                            line=needle_infile.readline()
+
+                            identity_seq=eval(line.strip().split(' ')[-1].replace('%','').replace(')','').replace('(',''))
+
+                            if just_score:
+                                    needle_data.append([id_seq,identity_seq])
+                            else:
+                                    for _ in range(7):
+                                            needle_infile.readline()
+
+                                    line=needle_infile.readline()
+                                    aln_ref_seq=line.split()[2]
+
+
+                                    aln_str=needle_infile.readline()[21:].rstrip('\n')
+                                    line=needle_infile.readline()
+                                    aln_query_seq=line.split()[2]
+                                    aln_query_len=line.split()[3]
+                                    needle_data.append([id_seq,identity_seq,aln_query_len,aln_ref_seq,aln_str,aln_query_seq])
+
+            if just_score:
+                    needle_infile.close()
+                    return pd.DataFrame(needle_data,columns=['ID','score_'+name]).set_index('ID')
+            else:
+                    needle_infile.close()
+                    return pd.DataFrame(needle_data,columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']).set_index('ID')
+        except:
+            raise NeedleException('Failed to parse the output of needle!')
+
+
+def run_needle(fasta_filename,database_fasta_filename,needle_options_string,log_filename,needle_output_filename):
+    cmd="zcat < %s | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
+    %(fasta_filename,database_fasta_filename,needle_options_string,log_filename,needle_output_filename)
+
+    NEEDLE_OUTPUT=sb.call(cmd,shell=True)
+    if NEEDLE_OUTPUT:
+            raise NeedleException('Needle failed to run, please check the log file.')
+
+
+class AlignmentCache(object):
+    '''
+    Persistent on disk cache of the alignments of the unique read sequences, it can be shared
+    by several runs (and processes) analyzing the same amplicon. Each record is keyed by the amplicon and
+    expected HDR amplicon sequences, the needle options, the minimum identity score and the read sequence.
+    When the cache is bigger than max_size bytes the least recently used records are evicted.
+    The classifications are not stored: they depend also on the quantification window and the ignore_*
+    options, which would split the cache between runs differing only in these parameters, while computing
+    them from the cached alignments takes a fraction of the time of the alignment.
+    '''
+
+    def __init__(self,cache_folder,amplicon_seq,expected_hdr_amplicon_seq,needle_options_string,min_identity_score,max_size=1024**3):
+
+        try:
+            os.makedirs(cache_folder)
+        except OSError as exc:
+            if exc.errno != errno.EEXIST:
+                raise
+
+        self.filename=os.path.join(cache_folder,'CRISPResso_alignment_cache.sqlite')
+        self.max_size=max_size
+        self.namespace=hashlib.sha1('\n'.join([amplicon_seq,expected_hdr_amplicon_seq,
+                                               ' '.join(needle_options_string.split()),
+                                               '%g' % min_identity_score])).hexdigest()
+
+        #sqlite takes care of the locking between concurrent processes
+        self.conn=sqlite3.connect(self.filename,timeout=600)
+        self.conn.text_factory=str
+        self.conn.execute('PRAGMA journal_mode=WAL')
+
+        with self.conn:
+            self.conn.execute('CREATE TABLE IF NOT EXISTS alignments (key TEXT PRIMARY KEY, record TEXT, size INTEGER, last_access REAL)')
+            self.conn.execute('CREATE INDEX IF NOT EXISTS alignments_last_access ON alignments (last_access)')
+
+    def _key(self,seq):
+        return self.namespace+hashlib.sha1(seq).hexdigest()
+
+    @staticmethod
+    def _encode(record):
+        return '\t'.join(['' if value is None else str(value) for value in record])
+
+    @staticmethod
+    def _decode(record):
+        orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq=record.split('\t')
+        return (orientation,float(score_ref),float(score_repaired) if score_repaired else None,
+                length,ref_seq,align_str,align_seq)
+
+    def get_many(self,sequences,chunk_size=500):
+        records={}
+        keys_to_seqs=dict([(self._key(seq),seq) for seq in sequences])
+        keys=keys_to_seqs.keys()
+        now=time.time()
+
+        with self.conn:
+            for i in range(0,len(keys),chunk_size):
+                chunk=keys[i:i+chunk_size]
+                placeholders=','.join(['?']*len(chunk))
+                for key,record in self.conn.execute('SELECT key,record FROM alignments WHERE key IN (%s)' % placeholders,chunk):
+                    records[keys_to_seqs[key]]=self._decode(record)
+
+                self.conn.execute('UPDATE alignments SET last_access=? WHERE key IN (%s)' % placeholders,[now]+chunk)
+
+        return records
+
+    def put_many(self,records):
+        now=time.time()
+        rows=[]
+        for seq,record in records.iteritems():
+            key=self._key(seq)
+            encoded_record=self._encode(record)
+            rows.append((key,encoded_record,len(key)+len(encoded_record),now))
+
+        with self.conn:
+            self.conn.executemany('INSERT OR REPLACE INTO alignments VALUES (?,?,?,?)',rows)
+            self._evict()
+
+    def _evict(self,chunk_size=500):
+        total_size=self.conn.execute('SELECT COALESCE(SUM(size),0) FROM alignments').fetchone()[0]
+
+        if total_size<=self.max_size:
+            return
+
+        #we free 10% more than needed to avoid evicting at every run
+        size_to_free=total_size-int(self.max_size*0.9)
+        keys_to_remove=[]
+        for key,size in self.conn.execute('SELECT key,size FROM alignments ORDER BY last_access').fetchall():
+            if size_to_free<=0:
+                break
+            keys_to_remove.append(key)
+            size_to_free-=size
+
+        for i in range(0,len(keys_to_remove),chunk_size):
+            chunk=keys_to_remove[i:i+chunk_size]
+            self.conn.execute('DELETE FROM alignments WHERE key IN (%s)' % ','.join(['?']*len(chunk)),chunk)
+
+        info('Evicted %d records from the alignment cache.' % len(keys_to_remove))
+
+    def close(self):
+        self.conn.close()
+
+
+class AlignmentPrescreen(object):
+    '''
+    Rejects the reads that cannot reach the identity threshold without aligning them. The needle identity is the
+    number of identical columns over the alignment length, so it is bounded by the lengths of the read and of the
+    reference and by the number of read k-mers missing from the reference (on both strands): each mismatched or
+    inserted base can destroy at most k of them and each deletion at most k-1.
+    '''
+
+    def __init__(self,reference_seqs,k=10):
+        self.k=k
+        self.reference_lengths=sorted(set([len(reference_seq) for reference_seq in reference_seqs]))
+        self.kmers=set()
+        for reference_seq in reference_seqs:
+            for seq in [reference_seq,reverse_complement(reference_seq)]:
+                for i in range(len(seq)-k+1):
+                    self.kmers.add(seq[i:i+k])
+
+    def max_identity(self,seq):
+        k=self.k
+        len_seq=len(seq)
+        kmers=self.kmers
+        n_missing_kmers=sum([1 for i in range(len_seq-k+1) if seq[i:i+k] not in kmers])
+
+        max_identity=0.0
+        for len_ref in self.reference_lengths:
+            #e read bases mismatched or inserted and d deletions, with k*e+(k-1)*d>=n_missing_kmers: the bound is
+            #monotone between the points where the length of the read or of the reference becomes the limiting one
+            candidates=[0.0,n_missing_kmers/float(k),len_seq-len_ref,(n_missing_kmers-(len_ref-len_seq)*(k-1))/float(k)]
+            for e in candidates:
+                e=min(max(e,0.0),n_missing_kmers/float(k))
+                d=(n_missing_kmers-k*e)/float(k-1)
+                max_identity=max(max_identity,100.0*min(len_seq-e,len_ref)/max(len_seq+d,len_ref))
+
+        return max_identity
+
+    def can_align(self,seq,min_identity_score):
+        #needle reports the identity rounded to one decimal
+        return float('%.1f' % (self.max_identity(seq)+1e-6))>min_identity_score
+
+def align_sequences(sequences,args,_jp,database_id,log_filename,alignment_cache=None,repaired_alignments=None):
+    '''
+    Align each unique sequence to the amplicon (and to the expected HDR amplicon) with needle, the sequences
+    that fail are aligned to the reverse complement. Returns a dictionary sequence->record where each
+    record is (orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq) and the orientation
+    is FW, RC or NA for the sequences not aligned. Alignments on the reverse complement are reported in the
+    amplicon orientation. If a dictionary is passed as repaired_alignments it is filled with the
+    (ref_seq,align_str,align_seq) alignments to the expected HDR amplicon of the aligned sequences.
+    '''
+    alignments={}
+    needle_output_filenames=[]
+    intermediate_filenames=[]
+
+    if alignment_cache:
+        alignments=alignment_cache.get_many(sequences)
+        info('%d/%d unique sequences found in the alignment cache.' % (len(alignments),len(sequences)))
+
+    sequences_to_align=[seq for seq in sequences if seq not in alignments]
+    new_alignments={}
+
+    if args.expected_hdr_amplicon_seq:
+        references=[('FW',args.amplicon_seq,args.expected_hdr_amplicon_seq),
+                    ('RC',reverse_complement(args.amplicon_seq),reverse_complement(args.expected_hdr_amplicon_seq))]
+    else:
+        references=[('FW',args.amplicon_seq,''),('RC',reverse_complement(args.amplicon_seq),'')]
+
+    #the sequences not aligned to the amplicon (or to the expected HDR amplicon) are aligned from the
+    #read sequence to the reverse complement, 1.0.12 aligned instead their gapped forward alignment
+    for orientation,reference_seq,reference_repair_seq in references:
+
+        if not sequences_to_align:
+            break
+
+        suffix='_rc' if orientation=='RC' else ''
+
+        if orientation=='RC':
+            info('Align sequences to reverse complement of the amplicon...')
+
+        fasta_filename=_jp('%s_sequences_to_align%s.fa.gz' % (database_id,suffix))
+        database_fasta_filename=_jp('%s_database%s.fa' % (database_id,suffix))
+        needle_output_filename=_jp('needle_output%s_%s.txt.gz' % (suffix,database_id))
+
+        outfile=gzip.open(fasta_filename,'w+')
+        for idx,seq in enumerate(sequences_to_align):
+            outfile.write('>s%d\n%s\n' % (idx,seq))
+        outfile.close()
+
+        with open(database_fasta_filename,'w+') as outfile:
+                outfile.write('>%s\n%s\n' % (database_id,reference_seq))
 
-check_program('java')
-check_program('flash')
-check_program('needle')
+        run_needle(fasta_filename,database_fasta_filename,args.needle_options_string,log_filename,needle_output_filename)
+        df_alignment=parse_needle_output(needle_output_filename,'ref')
 
-sns=check_library('seaborn')
-sns.set_context('poster')
-sns.set(font_scale=2.2)
-sns.set_style('white')
+        intermediate_filenames+=[fasta_filename,database_fasta_filename]
+        if orientation=='FW':
+            needle_output_filenames.append(needle_output_filename)
+        else:
+            intermediate_filenames.append(needle_output_filename)
+
+        #If we have a donor sequence we just compare the fq in the two cases and see which one alignes better
+        if reference_repair_seq:
+            database_repair_fasta_filename=_jp('%s_database_repair%s.fa' % (database_id,suffix))
+            needle_output_repair_filename=_jp('needle_output_repair%s_%s.txt.gz' % (suffix,database_id))
+
+            with open(database_repair_fasta_filename,'w+') as outfile:
+                    outfile.write('>%s\n%s\n' % (database_id,reference_repair_seq))
+
+            run_needle(fasta_filename,database_repair_fasta_filename,args.needle_options_string,log_filename,needle_output_repair_filename)
+            if repaired_alignments is None:
+                df_alignment=df_alignment.join(parse_needle_output(needle_output_repair_filename,'repaired',just_score=True))
+            else:
+                df_repair=parse_needle_output(needle_output_repair_filename,'repaired')
+                df_alignment=df_alignment.join(df_repair[['score_repaired']])
+
+            intermediate_filenames.append(database_repair_fasta_filename)
+            if orientation=='FW':
+                needle_output_filenames.append(needle_output_repair_filename)
+            else:
+                intermediate_filenames.append(needle_output_repair_filename)
+        else:
+            df_alignment['score_repaired']=np.nan
+
+        not_aligned=[]
+        for row in df_alignment.itertuples():
+            seq=sequences_to_align[int(row.Index[1:])]
+            score_repaired=None if np.isnan(row.score_repaired) else row.score_repaired
+
+            if row.score_ref>args.min_identity_score or (score_repaired is not None and score_repaired>args.min_identity_score):
+                if orientation=='RC':
+                    #reverse complement and invert the align string so we have everything in the positive strand
+                    new_alignments[seq]=(orientation,row.score_ref,score_repaired,row.length,
+                                         reverse_complement(row.ref_seq),row.align_str[::-1],reverse_complement(row.align_seq))
+                else:
+                    new_alignments[seq]=(orientation,row.score_ref,score_repaired,row.length,
+                                         row.ref_seq,row.align_str,row.align_seq)
+
+                if repaired_alignments is not None and reference_repair_seq:
+                    repair_row=df_repair.loc[row.Index]
+                    if orientation=='RC':
+                        repaired_alignments[seq]=(reverse_complement(repair_row.ref_seq),repair_row.align_str[::-1],reverse_complement(repair_row.align_seq))
+                    else:
+                        repaired_alignments[seq]=(repair_row.ref_seq,repair_row.align_str,repair_row.align_seq)
+            else:
+                not_aligned.append(seq)
+                if orientation=='FW':
+                    new_alignments[seq]=('NA',row.score_ref,score_repaired,'','','','')
+
+        sequences_to_align=not_aligned
+
+    if alignment_cache and new_alignments:
+        alignment_cache.put_many(new_alignments)
+
+    alignments.update(new_alignments)
+
+    return alignments,needle_output_filenames,intermediate_filenames
+
+def cluster_near_duplicates(sequences,max_distance):
+    '''
+    Group the sequences that differ by at most max_distance substitutions from a previous (more abundant)
+    sequence. Returns the list of representatives and a dictionary near duplicate->representative.
+    Each sequence is cut in 2*max_distance+2 blocks: two sequences within max_distance substitutions have
+    identical blocks once max_distance blocks are masked, so the candidates are found with exact lookups.
+    '''
+    n_blocks=2*max_distance+2
+    masks=list(itertools.combinations(range(n_blocks),max_distance))
+
+    representatives=[]
+    near_duplicates={}
+    index=defaultdict(list)
+
+    for seq in sequences:
+        len_seq=len(seq)
+        bounds=[len_seq*i/n_blocks for i in range(n_blocks+1)]
+        blocks=[seq[bounds[i]:bounds[i+1]] for i in range(n_blocks)]
+        keys=[(len_seq,mask,hash(tuple([block for i,block in enumerate(blocks) if i not in mask]))) for mask in masks]
+
+        representative=None
+        for key in keys:
+            for candidate in index.get(key,[]):
+                n_diff=0
+                for a,b in itertools.izip(candidate,seq):
+                    if a!=b:
+                        n_diff+=1
+                        if n_diff>max_distance:
+                            break
+                if n_diff<=max_distance:
+                    representative=candidate
+                    break
+            if representative:
+                break
+
+        if representative:
+            near_duplicates[seq]=representative
+        else:
+            representatives.append(seq)
+            for key in keys:
+                index[key].append(seq)
+
+    return representatives,near_duplicates
+
+def get_gap_protected_columns(aln_ref_seq,aln_seq):
+    '''
+    Columns of an alignment where a substitution could move a gap: each gap can slide along the repeat of the
+    sequence it deletes or inserts without changing the score, a substitution inside this repeat or in a flank
+    as long as the gap around it can change where the aligner places the gap.
+    '''
+    protected_columns=set()
+    for gapped_seq,other_seq in [(aln_ref_seq,aln_seq),(aln_seq,aln_ref_seq)]:
+        for m in re.finditer('-+',gapped_seq):
+            gap_start,gap_end=m.span()
+            gap_length=gap_end-gap_start
+
+            #the gapped bases are in other_seq, shift the gap while the result is the same sequence
+            left=gap_start
+            while left>0 and gapped_seq[left-1]!='-' and other_seq[left-1]!='-' and other_seq[left-1]==other_seq[left-1+gap_length]:
+                left-=1
+            right=gap_end
+            while right<len(other_seq) and gapped_seq[right]!='-' and other_seq[right]!='-' and other_seq[right]==other_seq[right-gap_length]:
+                right+=1
+
+            protected_columns.update(range(max(0,left-gap_length),min(len(other_seq),right+gap_length)))
+
+    return protected_columns
+
+def derive_near_duplicate_alignment(seq,representative_seq,record,repaired_alignment,include_idxs,min_identity_score):
+    '''
+    Derive the alignment of a near duplicate from the alignment of its representative by replacing the
+    substituted bases. Returns None when the result could differ from a real alignment: substitutions
+    involving N, inside the repeat or the flank around a gap where the gap could be placed differently
+    (see get_gap_protected_columns) or inside the quantification window, or a representative not aligned.
+    '''
+    orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq=record
+
+    if orientation=='NA' or (score_repaired is not None and repaired_alignment is None):
+        return None
+
+    if orientation=='RC':
+        seq=reverse_complement(seq)
+        representative_seq=reverse_complement(representative_seq)
+
+    diff_positions=[i for i,(a,b) in enumerate(itertools.izip(representative_seq,seq)) if a!=b]
+    if any([seq[i]=='N' or representative_seq[i]=='N' for i in diff_positions]):
+        return None
+
+    def substitute(aln_ref_seq,aln_str,aln_seq,identity,check_window):
+        if aln_seq.replace('-','')!=representative_seq:
+            return None
+
+        #the identity must be the fraction of matching columns as reported by needle
+        if float('%.1f' % (100.0*aln_str.count('|')/len(aln_ref_seq)))!=identity:
+            return None
+
+        read_columns=[idx for idx,c in enumerate(aln_seq) if c!='-']
+        protected_columns=get_gap_protected_columns(aln_ref_seq,aln_seq)
+        new_aln_str=list(aln_str)
+        new_aln_seq=list(aln_seq)
+
+        for i in diff_positions:
+            col=read_columns[i]
+
+            if aln_ref_seq[col]=='-' or col in protected_columns:
+                return None
+
+            if check_window and len(aln_ref_seq[:col].replace('-','')) in include_idxs:
+                return None
+
+            new_aln_seq[col]=seq[i]
+            new_aln_str[col]='|' if seq[i]==aln_ref_seq[col] else '.'
+
+        new_aln_str=''.join(new_aln_str)
+        new_identity=float('%.1f' % (100.0*new_aln_str.count('|')/len(aln_ref_seq)))
+
+        return new_identity,new_aln_str,''.join(new_aln_seq)
+
+    derived=substitute(ref_seq,align_str,align_seq,score_ref,True)
+    if derived is None:
+        return None
+    new_score_ref,new_align_str,new_align_seq=derived
+
+    new_score_repaired=None
+    if score_repaired is not None:
+        derived_repaired=substitute(repaired_alignment[0],repaired_alignment[1],repaired_alignment[2],score_repaired,False)
+        if derived_repaired is None:
+            return None
+        new_score_repaired=derived_repaired[0]
+
+    #the read may fall below the identity threshold and need to be tried on the other strand
+    if not (new_score_ref>min_identity_score or (new_score_repaired is not None and new_score_repaired>min_identity_score)):
+        return None
+
+    return (orientation,new_score_ref,new_score_repaired,length,ref_seq,new_align_str,new_align_seq)
+
+def align_sequences_clustering_near_duplicates(sequences,args,_jp,database_id,log_filename,include_idxs,alignment_cache=None):
+    '''
+    Same as align_sequences, but only the representatives of the near duplicate groups are aligned with
+    needle. The alignments of the near duplicates are derived from their representative when the
+    substitutions cannot change the quantification, the other near duplicates are aligned individually.
+    '''
+    alignments={}
+    if alignment_cache:
+        alignments=alignment_cache.get_many(sequences)
+        info('%d/%d unique sequences found in the alignment cache.' % (len(alignments),len(sequences)))
+
+    representatives,near_duplicates=cluster_near_duplicates([seq for seq in sequences if seq not in alignments],args.max_cluster_distance)
+    info('Found %d near duplicates of %d representative sequences.' % (len(near_duplicates),len(representatives)))
+
+    repaired_alignments={}
+    representative_alignments,needle_output_filenames,intermediate_filenames=align_sequences(representatives,args,_jp,database_id,log_filename,
+                                                                                             alignment_cache,repaired_alignments)
+    alignments.update(representative_alignments)
+
+    sequences_to_align=[]
+    for seq in sequences:
+        if seq in near_duplicates:
+            representative_seq=near_duplicates[seq]
+            record=derive_near_duplicate_alignment(seq,representative_seq,representative_alignments[representative_seq],
+                                                   repaired_alignments.get(representative_seq),include_idxs,args.min_identity_score)
+            if record is None:
+                sequences_to_align.append(seq)
+            else:
+                alignments[seq]=record
+
+    info('Derived the alignment of %d near duplicates, %d near duplicates need to be aligned.' % (len(near_duplicates)-len(sequences_to_align),len(sequences_to_align)))
+
+    if sequences_to_align:
+        near_duplicate_alignments,near_duplicate_needle_output_filenames,near_duplicate_intermediate_filenames=align_sequences(sequences_to_align,args,_jp,
+                                                                                                                              '%s_near_duplicates' % database_id,
+                                                                                                                              log_filename,alignment_cache)
+        alignments.update(near_duplicate_alignments)
+        needle_output_filenames+=near_duplicate_needle_output_filenames
+        intermediate_filenames+=near_duplicate_intermediate_filenames
+
+    return alignments,needle_output_filenames,intermediate_filenames
 
-from Bio import SeqIO,pairwise2
+#the libraries and the programs are loaded and checked only by the stages that need them
+np=check_library('numpy')
+pd=LazyLibrary('pandas')
+SeqIO=LazyLibrary('Bio.SeqIO')
+pairwise2=LazyLibrary('Bio.pairwise2')
+CRISPRessoPlot=LazyLibrary('CRISPResso.CRISPRessoPlot')
 #########################################
 
 
@@ -267,11 +933,48 @@ class DuplicateSequenceIdException(Exception):
 class NoReadsAfterQualityFiltering(Exception):
     pass
 
+class RequantifyException(Exception):
+    pass
+
+class UMIException(Exception):
+    pass
+
+class SamtoolsException(Exception):
+    pass
+
+class ReplotException(Exception):
+    pass
+
+class BadParameterException(Exception):
+    pass
+
+class ServerException(Exception):
+    pass
+
+#the exit codes of main for each error, the jobs run in worker processes report the same codes
+EXCEPTION_EXIT_CODES=[(NTException,1),(SgRNASequenceException,2),(DonorSequenceException,3),(TrimmomaticException,4),
+                      (FlashException,5),(NeedleException,6),(NoReadsAlignedException,7),(AmpliconEqualDonorException,8),
+                      (CoreDonorSequenceNotContainedException,9),(CoreDonorSequenceNotUniqueException,10),(ExonSequenceException,11),
+                      (DuplicateSequenceIdException,12),(NoReadsAfterQualityFiltering,13),(RequantifyException,14),(UMIException,15),
+                      (SamtoolsException,16),(ReplotException,17),(BadParameterException,18),(ServerException,19)]
+
+def get_exit_code(exception):
+    for exception_type,exit_code in EXCEPTION_EXIT_CODES:
+        if isinstance(exception,exception_type):
+            return exit_code
+    return -1
+
 #########################################
 
 
-def process_df_chunk(df_needle_alignment_chunk):
+def process_df_chunk(df_needle_alignment_chunk,quantification_args=None,quantification_include_idxs=None,quantification_include_idxs_per_cut=None):
 
+     #the quantification parameters are the globals set by run_crispresso_analysis (shared with the processes
+     #of the pool) unless they are given explicitly, as requantify_sweep does for each parameter set
+     if quantification_args is None:
+         quantification_args=args
+         quantification_include_idxs=include_idxs
+         quantification_include_idxs_per_cut=include_idxs_per_cut
 
      MODIFIED_FRAMESHIFT=0
      MODIFIED_NON_FRAMESHIFT=0
@@ -279,7 +982,7 @@ def process_df_chunk(df_needle_alignment_chunk):
      SPLICING_SITES_MODIFIED=0
 
      #INITIALIZATIONS
-     if args.coding_seq:
+     if quantification_args.coding_seq:
          PERFORM_FRAMESHIFT_ANALYSIS=True
      else:
          PERFORM_FRAMESHIFT_ANALYSIS=False
@@ -307,6 +1010,11 @@ def process_df_chunk(df_needle_alignment_chunk):
      avg_vector_del_all=np.zeros(len_amplicon)
      avg_vector_ins_all=np.zeros(len_amplicon)
 
+     #one row for each cut point
+     effect_vector_insertion_per_cut=np.zeros((len(quantification_include_idxs_per_cut),len_amplicon))
+     effect_vector_deletion_per_cut=np.zeros((len(quantification_include_idxs_per_cut),len_amplicon))
+     effect_vector_mutation_per_cut=np.zeros((len(quantification_include_idxs_per_cut),len_amplicon))
+
      re_find_indels=re.compile("(-*-)")
      re_find_substitutions=re.compile("(\.*\.)")
 
@@ -324,7 +1032,7 @@ def process_df_chunk(df_needle_alignment_chunk):
 
                  #quantify substitution
                  substitution_positions=[]
-                 if not args.ignore_substitutions:
+                 if not quantification_args.ignore_substitutions:
                      for p in re_find_substitutions.finditer(row.align_str):
                          st,en=p.span()
                          substitution_positions.append(row.ref_positions[st:en])
@@ -337,7 +1045,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                  deletion_positions_flat=[]
                  deletion_sizes=[]
 
-                 if not args.ignore_deletions:
+                 if not quantification_args.ignore_deletions:
                      for p in re_find_indels.finditer(row.align_seq):
                          st,en=p.span()
                          deletion_positions.append(row.ref_positions[st:en])
@@ -351,7 +1059,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                  insertion_sizes=[]
                  insertion_positions_flat=[]
 
-                 if not args.ignore_insertions:
+                 if not quantification_args.ignore_insertions:
                      for p in re_find_indels.finditer(row.ref_seq):
                          st,en=p.span()
                          #ref_st=row.ref_positions[st-1] # we report the base preceding the insertion
@@ -366,21 +1074,21 @@ def process_df_chunk(df_needle_alignment_chunk):
 
                  ########CLASSIFY READ
                  #WE HAVE THE DONOR SEQUENCE
-                 if args.expected_hdr_amplicon_seq:
+                 if quantification_args.expected_hdr_amplicon_seq:
 
                     #HDR
-                    if (row.score_diff<0) & (row.score_repaired>=args.hdr_perfect_alignment_threshold):
+                    if (row.score_diff<0) & (row.score_repaired>=quantification_args.hdr_perfect_alignment_threshold):
                         df_needle_alignment_chunk.ix[idx_row,'HDR']=True
 
                     #MIXED
-                    elif (row.score_diff<0) & (row.score_repaired<args.hdr_perfect_alignment_threshold):
+                    elif (row.score_diff<0) & (row.score_repaired<quantification_args.hdr_perfect_alignment_threshold):
                         df_needle_alignment_chunk.ix[idx_row,'MIXED']=True
 
                     else:
                         #NHEJ
-                        if include_idxs.intersection(substitution_positions) \
-                        or include_idxs.intersection(insertion_positions_flat) or \
-                        include_idxs.intersection(deletion_positions_flat):
+                        if quantification_include_idxs.intersection(substitution_positions) \
+                        or quantification_include_idxs.intersection(insertion_positions_flat) or \
+                        quantification_include_idxs.intersection(deletion_positions_flat):
                             df_needle_alignment_chunk.ix[idx_row,'NHEJ']=True
 
                         #UNMODIFIED
@@ -390,9 +1098,9 @@ def process_df_chunk(df_needle_alignment_chunk):
                  #NO DONOR SEQUENCE PROVIDED
                  else:
                     #NHEJ
-                    if include_idxs.intersection(substitution_positions) \
-                        or include_idxs.intersection(insertion_positions_flat) or \
-                        include_idxs.intersection(deletion_positions_flat):
+                    if quantification_include_idxs.intersection(substitution_positions) \
+                        or quantification_include_idxs.intersection(insertion_positions_flat) or \
+                        quantification_include_idxs.intersection(deletion_positions_flat):
                         df_needle_alignment_chunk.ix[idx_row,'NHEJ']=True
 
                     #UNMODIFIED
@@ -400,6 +1108,17 @@ def process_df_chunk(df_needle_alignment_chunk):
                         df_needle_alignment_chunk.ix[idx_row,'UNMODIFIED']=True
 
 
+                 #NHEJ around each cut point separately, used for the quantification of each sgRNA
+                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ']:
+                    for idx_cut,include_idxs_cut in enumerate(quantification_include_idxs_per_cut):
+                        if include_idxs_cut.intersection(substitution_positions) \
+                        or include_idxs_cut.intersection(insertion_positions_flat) or \
+                        include_idxs_cut.intersection(deletion_positions_flat):
+                            df_needle_alignment_chunk.ix[idx_row,'NHEJ_cut_%d' % idx_cut]=True
+                            effect_vector_mutation_per_cut[idx_cut][substitution_positions]+=1
+                            effect_vector_deletion_per_cut[idx_cut][deletion_positions_flat]+=1
+                            effect_vector_insertion_per_cut[idx_cut][insertion_positions_flat]+=1
+
                  ###CREATE AVERAGE SIGNALS, HERE WE SHOW EVERYTHING...
                  if df_needle_alignment_chunk.ix[idx_row,'MIXED']:
                     effect_vector_mutation_mixed[substitution_positions]+=1
@@ -411,7 +1130,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                     effect_vector_deletion_hdr[deletion_positions_flat]+=1
                     effect_vector_insertion_hdr[insertion_positions_flat]+=1
 
-                 elif df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and not args.hide_mutations_outside_window_NHEJ:
+                 elif df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and not quantification_args.hide_mutations_outside_window_NHEJ:
                     effect_vector_mutation[substitution_positions]+=1
                     effect_vector_deletion[deletion_positions_flat]+=1
                     effect_vector_insertion[insertion_positions_flat]+=1
@@ -421,9 +1140,9 @@ def process_df_chunk(df_needle_alignment_chunk):
 
                  #For NHEJ we count only the events that overlap the window specified around
                  #the cut site (1bp by default)...
-                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and args.window_around_sgrna:
+                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and quantification_args.window_around_sgrna:
 
-                    substitution_positions=list(include_idxs.intersection(substitution_positions))
+                    substitution_positions=list(quantification_include_idxs.intersection(substitution_positions))
 
                     insertion_positions_window=[]
                     insertion_sizes_window=[]
@@ -431,7 +1150,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                     #count insertions overlapping
                     for idx_ins,ins_pos_set in enumerate(insertion_positions):
                         #print ref_st, insertion_positions
-                        if include_idxs.intersection(ins_pos_set):
+                        if quantification_include_idxs.intersection(ins_pos_set):
                             insertion_positions_window.append(ins_pos_set)
                             insertion_sizes_window.append(insertion_sizes[idx_ins])
 
@@ -441,7 +1160,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                     deletion_positions_window=[]
                     deletion_sizes_window=[]
                     for idx_del,del_pos_set in enumerate(deletion_positions):
-                        if include_idxs.intersection(del_pos_set):
+                        if quantification_include_idxs.intersection(del_pos_set):
                             deletion_positions_window.append(del_pos_set)
                             deletion_sizes_window.append(deletion_sizes[idx_del])
 
@@ -451,7 +1170,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                     if deletion_positions:
                         deletion_positions_flat=np.hstack(deletion_positions)
 
-                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and args.hide_mutations_outside_window_NHEJ:
+                 if df_needle_alignment_chunk.ix[idx_row,'NHEJ'] and quantification_args.hide_mutations_outside_window_NHEJ:
                     effect_vector_mutation[substitution_positions]+=1
                     effect_vector_deletion[deletion_positions_flat]+=1
                     effect_vector_insertion[insertion_positions_flat]+=1
@@ -505,6 +1224,7 @@ def process_df_chunk(df_needle_alignment_chunk):
                                 #there are no indels
                                 MODIFIED_NON_FRAMESHIFT+=1
                                 hist_inframe[0]+=1
+                                df_needle_alignment_chunk.ix[idx_row,'INFRAME']=True
                             else:
 
                                 effetive_length=sum(lenght_modified_positions_exons)
@@ -512,9 +1232,11 @@ def process_df_chunk(df_needle_alignment_chunk):
                                 if (effetive_length % 3 )==0:
                                     MODIFIED_NON_FRAMESHIFT+=1
                                     hist_inframe[effetive_length]+=1
+                                    df_needle_alignment_chunk.ix[idx_row,'INFRAME']=True
                                 else:
                                     MODIFIED_FRAMESHIFT+=1
                                     hist_frameshift[effetive_length]+=1
+                                    df_needle_alignment_chunk.ix[idx_row,'FRAMESHIFT']=True
 
                         #the indels and subtitutions are outside the exon/s  so we don't care!
                         else:
@@ -531,7 +1253,7 @@ def process_df_chunk(df_needle_alignment_chunk):
      effect_vector_mutation_mixed,effect_vector_insertion_hdr,effect_vector_deletion_hdr,effect_vector_mutation_hdr,\
      effect_vector_insertion_noncoding,effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,hist_inframe,\
      hist_frameshift,avg_vector_del_all,avg_vector_ins_all,MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,NON_MODIFIED_NON_FRAMESHIFT,\
-     SPLICING_SITES_MODIFIED
+     SPLICING_SITES_MODIFIED,effect_vector_insertion_per_cut,effect_vector_deletion_per_cut,effect_vector_mutation_per_cut
 
 
 
@@ -582,308 +1304,1003 @@ def get_dataframe_around_cut(df_alleles, cut_point,offset):
     df_alleles_around_cut['Unedited']=df_alleles_around_cut['Unedited']>0
     return df_alleles_around_cut
 
-#We need to customize the seaborn heatmap class and function
-class Custom_HeatMapper(sns.matrix._HeatMapper):
 
-    def __init__(self, data, vmin, vmax, cmap, center, robust, annot, fmt,
-                 annot_kws,per_element_annot_kws,cbar, cbar_kws,
-                 xticklabels=True, yticklabels=True, mask=None):
 
-        super(Custom_HeatMapper, self).__init__(data, vmin, vmax, cmap, center, robust, annot, fmt,
-                 annot_kws, cbar, cbar_kws,
-                 xticklabels, yticklabels, mask)
+def get_cut_points(guide_seq,amplicon_seq,cleavage_offset):
+    cut_points=[]
+    sgRNA_intervals=[]
+    offset_plots=[]
+    sgRNA_sequences=[]
+    cut_point_sgRNAs=[] #the sgRNA of each cut point, a sgRNA can match more than once
+
+    for current_guide_seq in guide_seq.split(','):
+
+        if current_guide_seq in amplicon_seq:
+           offset_plots.append(1)
+        else:
+           offset_plots.append(0)
+
+
+        wrong_nt=find_wrong_nt(current_guide_seq)
+        if wrong_nt:
+           raise NTException('The sgRNA sequence contains wrong characters:%s'  % ' '.join(wrong_nt))
+
+        offset_fw=cleavage_offset+len(current_guide_seq)-1
+        offset_rc=(-cleavage_offset)-1
+        current_cut_points=[m.start() + offset_fw for m in re.finditer(current_guide_seq, amplicon_seq)]+[m.start() + offset_rc for m in re.finditer(reverse_complement(current_guide_seq), amplicon_seq)]
+        cut_points+=current_cut_points
+        sgRNA_intervals+=[(m.start(),m.start()+len(current_guide_seq)-1) for m in re.finditer(current_guide_seq, amplicon_seq)]+[(m.start(),m.start()+len(current_guide_seq)-1) for m in re.finditer(reverse_complement(current_guide_seq), amplicon_seq)]
+        sgRNA_sequences.append(current_guide_seq)
+        cut_point_sgRNAs+=[current_guide_seq]*len(current_cut_points)
+
+    offset_plots=np.array(offset_plots)
+
+    if not cut_points:
+        raise SgRNASequenceException('The guide sequence/s provided is(are) not present in the amplicon sequence! \n\nPlease check your input!')
+
+    return cut_points,sgRNA_intervals,offset_plots,sgRNA_sequences,cut_point_sgRNAs
+
+def get_cut_point_labels(cut_point_sgRNAs):
+    '''
+    Unique label of each cut point, cut_point_N_SGRNA where N is its 1-based index
+    '''
+    return ['cut_point_%d_%s' % (idx_cut+1,sgRNA) for idx_cut,sgRNA in enumerate(cut_point_sgRNAs)]
+
+
+def subsample_reads(reads,max_reads=0,fraction=1.0,seed=0):
+    '''
+    Sample the read records (for example (read_id,read_seq) tuples) in a single pass: each read is kept with probability
+    fraction and, if max_reads>0, at most max_reads reads are kept with reservoir sampling. The sample is deterministic
+    given the seed, it is returned in the input order together with the number of reads seen.
+    '''
+    rng=random.Random(seed)
+    reservoir=[]
+    n_reads=0
+    n_candidates=0
+    for read in reads:
+        n_reads+=1
+        if fraction<1 and rng.random()>=fraction:
+            continue
+
+        if max_reads<=0 or n_candidates<max_reads:
+            reservoir.append((n_candidates,read))
+        else:
+            idx_replace=rng.randint(0,n_candidates)
+            if idx_replace<max_reads:
+                reservoir[idx_replace]=(n_candidates,read)
+        n_candidates+=1
+
+    reservoir.sort()
+    return [read for idx_read,read in reservoir],n_reads
+
+def wilson_interval(n_successes,n_trials,z=1.96):
+    '''
+    Wilson score confidence interval (95% by default) of a binomial proportion, as percentages.
+    '''
+    if n_trials==0:
+        return np.nan,np.nan
+
+    p=float(n_successes)/n_trials
+    denominator=1+z**2/n_trials
+    center=(p+z**2/(2*n_trials))/denominator
+    half_width=z*np.sqrt(p*(1-p)/n_trials+z**2/(4*n_trials**2))/denominator
+
+    return 100*max(0.0,center-half_width),100*min(1.0,center+half_width)
+
+def quick_editing_estimate(fastq_r1,fastq_r2,amplicon_seq,cut_points,window=10,anchor_size=15):
+    '''
+    Alignment free estimate of the editing around each cut point. For each cut point the reads (or read pairs)
+    containing the two anchors flanking the window around the cut are classified as intact if the sequence between
+    the anchors is the reference one and as disrupted otherwise. The reads are checked in both orientations.
+    Returns the number of reads (or pairs) and for each cut point the number of intact and disrupted reads.
+    '''
+    junctions=[]
+    for cut_p in cut_points:
+        window_start=max(0,cut_p+1-window)
+        window_end=min(len(amplicon_seq),cut_p+1+window)
+        left_anchor=amplicon_seq[max(0,window_start-anchor_size):window_start]
+        right_anchor=amplicon_seq[window_end:window_end+anchor_size]
+
+        if min(len(left_anchor),len(right_anchor))<anchor_size:
+            warn('The cut point %d is too close to the end of the amplicon, the anchors for the quick estimate are shorter than %d bp.' % (cut_p,anchor_size))
+
+        junctions.append((left_anchor,amplicon_seq[window_start:window_end],right_anchor))
+
+    def classify(seq):
+        #0: anchors not found, 1: intact, 2: disrupted
+        classes=[]
+        for left_anchor,reference_junction,right_anchor in junctions:
+            read_class=0
+            for oriented_seq in [seq,reverse_complement(seq)]:
+                idx_left=oriented_seq.find(left_anchor)
+                if idx_left>=0:
+                    idx_right=oriented_seq.find(right_anchor,idx_left+len(left_anchor))
+                    if idx_right>=0:
+                        read_class=1 if oriented_seq[idx_left+len(left_anchor):idx_right]==reference_junction else 2
+                        break
+            classes.append(read_class)
+        return classes
+
+    n_reads=0
+    n_intact=np.zeros(len(cut_points),dtype=int)
+    n_disrupted=np.zeros(len(cut_points),dtype=int)
+
+    #most of the reads are identical, each unique sequence is classified once
+    classes_cache={}
+    def get_classes(seq):
+        if seq not in classes_cache:
+            classes_cache[seq]=classify(seq)
+        return classes_cache[seq]
+
+    if fastq_r2:
+        records=itertools.izip(read_fastq(fastq_r1),read_fastq(fastq_r2))
+    else:
+        records=((record,) for record in read_fastq(fastq_r1))
+
+    for mates in records:
+        n_reads+=1
+        mates_classes=[get_classes(read_seq) for read_id,read_seq,read_qual in mates]
+        for idx_cut in range(len(cut_points)):
+            #a pair is disrupted if any of the mates is disrupted
+            pair_class=max([classes[idx_cut] for classes in mates_classes])
+            if pair_class==1:
+                n_intact[idx_cut]+=1
+            elif pair_class==2:
+                n_disrupted[idx_cut]+=1
+
+    return n_reads,n_intact,n_disrupted
+
+def get_include_idxs(cut_points,len_amplicon,window_around_sgrna,exclude_bp_from_left,exclude_bp_from_right):
+
+    if cut_points and window_around_sgrna>0:
+       include_idxs=[]
+       half_window=max(1,window_around_sgrna/2)
+       for cut_p in cut_points:
+           st=max(0,cut_p-half_window+1)
+           en=min(len_amplicon-1,cut_p+half_window+1)
+           include_idxs.append(range(st,en))
+    else:
+       include_idxs=range(len_amplicon)
+
+    exclude_idxs=[]
+
+    if exclude_bp_from_left:
+       exclude_idxs+=range(exclude_bp_from_left)
+
+    if exclude_bp_from_right:
+       exclude_idxs+=range(len_amplicon)[-exclude_bp_from_right:]
+
+    #flatten the arrays to avoid errors with old numpy library
+    include_idxs=np.ravel(include_idxs)
+    exclude_idxs=np.ravel(exclude_idxs)
 
+    return set(np.setdiff1d(include_idxs,exclude_idxs))
 
-        if annot is not None:
-            if per_element_annot_kws is None:
-                self.per_element_annot_kws=np.empty_like(annot,dtype=np.object)
-                self.per_element_annot_kws[:]=dict()
+
+###REQUANTIFY############################
+
+#options that change only the classification of the reads and the reports, the alignments can be reused
+REQUANTIFY_OPTIONS=['window_around_sgrna','exclude_bp_from_left','exclude_bp_from_right',
+                    'ignore_substitutions','ignore_insertions','ignore_deletions',
+                    'hide_mutations_outside_window_NHEJ','coding_seq','hdr_perfect_alignment_threshold',
+                    'name','output_folder','keep_intermediate','dump','save_also_png','plot_level','n_processes',
+                    'offset_around_cut_to_plot','min_frequency_alleles_around_cut_to_plot',
+                    'max_rows_alleles_around_cut_to_plot','vector_alleles_table','write_bam','write_hdf5','debug']
+
+#options that change the classification of the reads, used for the sweep
+SWEEP_OPTIONS=['window_around_sgrna','exclude_bp_from_left','exclude_bp_from_right',
+               'ignore_substitutions','ignore_insertions','ignore_deletions','hdr_perfect_alignment_threshold']
+
+
+def save_crispresso_alignments(output_directory,df_alignments,run_info):
+    alignments_handle=gzip.open(os.path.join(output_directory,'CRISPResso_alignments.txt.gz'),'wb')
+    df_alignments.to_csv(alignments_handle,sep='\t')
+    alignments_handle.close()
+
+    with open(os.path.join(output_directory,'CRISPResso_run_info.pickle'),'wb') as outfile:
+        cp.dump(run_info,outfile)
+
+
+def load_crispresso_alignments(crispresso_output_folder):
+    alignments_filename=os.path.join(crispresso_output_folder,'CRISPResso_alignments.txt.gz')
+    run_info_filename=os.path.join(crispresso_output_folder,'CRISPResso_run_info.pickle')
+
+    if not (os.path.exists(alignments_filename) and os.path.exists(run_info_filename)):
+        raise RequantifyException('The folder %s does not contain the alignments of a previous CRISPResso run (CRISPResso_alignments.txt.gz and CRISPResso_run_info.pickle), please run CRISPResso %s or later on your reads first.' % (crispresso_output_folder,'1.0.13'))
+
+    alignments_handle=gzip.open(alignments_filename)
+    df_alignments=pd.read_csv(alignments_handle,sep='\t',index_col='ID',keep_default_na=False,na_values={'score_repaired':['']})
+    alignments_handle.close()
+
+    with open(run_info_filename,'rb') as infile:
+        run_info=cp.load(infile)
+
+    return df_alignments,run_info
+
+
+def expand_alignments_to_reads(df_alignments):
+    needle_alignment_data=[]
+    n_umi_reads=[]
+    for row in df_alignments.itertuples():
+        for idx_read in range(row.n_reads):
+            read_id='%s_%d' % (row.Index,idx_read)
+
+            #fix for duplicates when rc alignment
+            if row.orientation=='RC':
+                read_id='_'.join([read_id,'RC'])
+
+            needle_alignment_data.append([read_id,row.score_ref,row.length,row.ref_seq,row.align_str,row.align_seq,row.score_repaired])
+
+        if 'umi_family_sizes' in df_alignments.columns:
+            n_umi_reads+=map(int,str(row.umi_family_sizes).split(','))
+
+    df_needle_alignment=pd.DataFrame(needle_alignment_data,columns=['ID','score_ref','length','ref_seq','align_str','align_seq','score_repaired']).set_index('ID')
+
+    if 'umi_family_sizes' in df_alignments.columns:
+        df_needle_alignment['n_umi_reads']=n_umi_reads
+
+    return df_needle_alignment
+
+
+def parse_sweep_parameter_sets(sweep,args):
+    '''
+    Each element of sweep is option=values where values is a comma separated list or an inclusive range start:end[:step],
+    the parameter sets are all the combinations of the values of the options.
+    '''
+    sweep_parameter_names=[]
+    sweep_parameter_values=[]
+
+    if not sweep:
+        return sweep_parameter_names,[]
+
+    for sweep_option in sweep:
+        name,_,values=sweep_option.partition('=')
+        name=name.strip().lstrip('-')
+
+        if name not in SWEEP_OPTIONS:
+            raise RequantifyException('The option %s cannot be used for a sweep, the available options are: %s' % (name,', '.join(SWEEP_OPTIONS)))
+
+        current_value=getattr(args,name)
+
+        try:
+            if isinstance(current_value,bool):
+                values=[value.strip().lower() in ['1','true','yes'] for value in values.split(',')]
+            elif ':' in values:
+                range_values=map(int,values.split(':'))
+                values=range(range_values[0],range_values[1]+1,range_values[2] if len(range_values)>2 else 1)
             else:
-                self.per_element_annot_kws=per_element_annot_kws
-
-    #add per element dict to syle the annotatiin
-    def _annotate_heatmap(self, ax, mesh):
-        """Add textual labels with the value in each cell."""
-        mesh.update_scalarmappable()
-        xpos, ypos = np.meshgrid(ax.get_xticks(), ax.get_yticks())
+                values=map(type(current_value),values.split(','))
+        except:
+            raise RequantifyException('Cannot parse the values of the sweep for the option %s: %s' % (name,sweep_option))
 
+        if not values:
+            raise RequantifyException('No values specified for the sweep of the option %s' % name)
 
-        for x, y, m, color, val,per_element_dict  in zip(xpos.flat, ypos.flat,
-                                       mesh.get_array(), mesh.get_facecolors(),
-                                       self.annot_data.flat,self.per_element_annot_kws.flat):
-            #print per_element_dict
-            if m is not np.ma.masked:
-                l = sns.utils.relative_luminance(color)
-                text_color = ".15" if l > .408 else "w"
-                annotation = ("{:" + self.fmt + "}").format(val)
-                text_kwargs = dict(color=text_color, ha="center", va="center")
-                text_kwargs.update(self.annot_kws)
-                text_kwargs.update(per_element_dict)
+        sweep_parameter_names.append(name)
+        sweep_parameter_values.append(values)
 
-                ax.text(x, y, annotation, **text_kwargs)
+    sweep_parameter_sets=[dict(zip(sweep_parameter_names,values)) for values in itertools.product(*sweep_parameter_values)]
 
+    return sweep_parameter_names,sweep_parameter_sets
 
-    #removed the colobar
-    def plot(self, ax, cax, kws):
-        """Draw the heatmap on the provided Axes."""
-        # Remove all the Axes spines
-        sns.utils.despine(ax=ax, left=True, bottom=True)
 
-        # Draw the heatmap
-        mesh = ax.pcolormesh(self.plot_data, vmin=self.vmin, vmax=self.vmax,
-                             cmap=self.cmap, **kws)
+def parse_requantify_args(argv):
+    requantify_parser = argparse.ArgumentParser(prog='CRISPResso requantify',
+                                                description='Recompute the quantification, reports and plots of a previous CRISPResso run from its alignments, without aligning the reads again. The options of the original run can be overridden with any of the following CRISPResso options: %s.' % ', '.join(['--'+option for option in REQUANTIFY_OPTIONS]),
+                                                formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    requantify_parser.add_argument('crispresso_output_folder', type=str,  help='Output folder of a previous CRISPResso run')
+    requantify_parser.add_argument('--sweep', type=str, nargs='+', help='Report a table with the quantification for each combination of the values specified as option=values, where values is a comma separated list or an inclusive range start:end[:step], for example window_around_sgrna=1:50. Available options: %s' % ', '.join(SWEEP_OPTIONS), default=[])
 
-        # Set the axis limits
-        ax.set(xlim=(0, self.data.shape[1]), ylim=(0, self.data.shape[0]))
+    requantify_args,overrides=requantify_parser.parse_known_args(argv)
 
-        # Add row and column labels
-        ax.set(xticks=self.xticks, yticks=self.yticks)
-        xtl = ax.set_xticklabels(self.xticklabels)
-        ytl = ax.set_yticklabels(self.yticklabels, rotation="vertical")
+    df_alignments,run_info=load_crispresso_alignments(requantify_args.crispresso_output_folder)
+    original_args=run_info['args']
 
-        # Possibly rotate them if they overlap
-        plt.draw()
-        if sns.utils.axis_ticklabels_overlap(xtl):
-            plt.setp(xtl, rotation="vertical")
-        if sns.utils.axis_ticklabels_overlap(ytl):
-            plt.setp(ytl, rotation="horizontal")
+    #we parse the overrides with the CRISPResso parser using the options of the original run as defaults
+    parser=get_crispresso_parser()
+    parser.set_defaults(**original_args)
+    parser.set_defaults(name='%s_requantified' % run_info['database_id'],output_folder=requantify_args.crispresso_output_folder)
+    args=parser.parse_args(['-r1',original_args['fastq_r1'],'-a',original_args['amplicon_seq']]+overrides)
 
-        # Add the axis labels
-        ax.set(xlabel=self.xlabel, ylabel=self.ylabel)
+    for option,value in vars(args).items():
+        if option not in REQUANTIFY_OPTIONS and option in original_args and value!=original_args[option]:
+            raise RequantifyException('The option --%s changes the alignments and cannot be used with requantify, please run CRISPResso again.' % option)
 
-        # Annotate the cells with the formatted values
-        if self.annot:
-            self._annotate_heatmap(ax, mesh)
+    sweep_parameter_names,sweep_parameter_sets=parse_sweep_parameter_sets(requantify_args.sweep,args)
 
+    info('Requantifying the %d reads aligned in %s' % (df_alignments.n_reads.sum(),requantify_args.crispresso_output_folder))
 
+    return args,df_alignments,run_info,sweep_parameter_names,sweep_parameter_sets
 
 
-def custom_heatmap(data, vmin=None, vmax=None, cmap=None, center=None, robust=False,
-            annot=None, fmt=".2g", annot_kws=None,per_element_annot_kws=None,
-            linewidths=0, linecolor="white",
-            cbar=True, cbar_kws=None, cbar_ax=None,
-            square=False, ax=None, xticklabels=True, yticklabels=True,
-            mask=None,
-            **kwargs):
+###REPLOT################################
 
-    # Initialize the plotter object
-    plotter = Custom_HeatMapper(data, vmin, vmax, cmap, center, robust, annot, fmt,
-                          annot_kws, per_element_annot_kws,cbar, cbar_kws, xticklabels,
-                          yticklabels, mask)
+#options of the original run that can be overridden by CRISPResso replot
+REPLOT_OPTIONS=['offset_around_cut_to_plot','min_frequency_alleles_around_cut_to_plot','max_rows_alleles_around_cut_to_plot',
+                'vector_alleles_table','save_also_png','n_processes']
 
-    # Add the pcolormesh kwargs here
-    kwargs["linewidths"] = linewidths
-    kwargs["edgecolor"] = linecolor
 
-    # Draw the plot and return the Axes
-    if ax is None:
-        ax = plt.gca()
-    if square:
-        ax.set_aspect("equal")
-    plotter.plot(ax, cbar_ax, kwargs)
-    return ax
+def save_plot_data(output_directory,plot_data):
+    with open(os.path.join(output_directory,'CRISPResso_plot_data.pickle'),'wb') as outfile:
+        cp.dump(plot_data,outfile,cp.HIGHEST_PROTOCOL)
 
-def plot_alleles_table(reference_seq,cut_point,df_alleles,sgRNA_name,OUTPUT_DIRECTORY,MIN_FREQUENCY=0.5,MAX_N_ROWS=100):
-    #bp we are plotting on each side
-    offset_around_cut_to_plot=len(df_alleles.index[0])/2
 
-    # make a color map of fixed colors
-    alpha=0.5
+def load_plot_data(crispresso_output_folder):
+    plot_data_filename=os.path.join(crispresso_output_folder,'CRISPResso_plot_data.pickle')
 
+    if not os.path.exists(plot_data_filename):
+        raise ReplotException('The folder %s does not contain the plot data of a previous CRISPResso run (CRISPResso_plot_data.pickle), please run CRISPResso %s or later on your reads first.' % (crispresso_output_folder,'1.0.13'))
 
-    get_color=lambda x,y,z: (x/255.0,y/255.0,z/255.0,alpha)
-    A_color=get_color(127,201,127)
-    T_color=get_color(190,174,212)
-    C_color=get_color(253,192,134)
-    G_color=get_color(255,255,153)
-    INDEL_color=get_color(230,230,230)
+    with open(plot_data_filename,'rb') as infile:
+        plot_data=cp.load(infile)
 
-    cmap = colors_mpl.ListedColormap([INDEL_color, A_color,T_color,C_color,G_color])
+    return plot_data
 
-    dna_to_numbers={'-':0,'A':1,'T':2,'C':3,'G':4}
-    seq_to_numbers= lambda seq: [dna_to_numbers[x] for x in seq]
 
-    X=[]
-    annot=[]
-    y_labels=[]
-    lines=defaultdict(list)
+def get_alleles_table_figure_jobs(output_directory,df_alleles,reference_seq,sgRNA_sequences,cut_points,offset,min_frequency,max_n_rows,vector_alleles_table):
+    '''
+    Write the alleles around each cut site and return the figure jobs for their alleles tables (figure 9).
+    '''
+    figure_jobs=[]
+    for sgRNA,cut_point in zip(sgRNA_sequences,cut_points):
+        df_allele_around_cut=get_dataframe_around_cut(df_alleles,cut_point,offset)
 
-    re_find_indels=re.compile("(-*-)")
+        #write alleles table to file
+        df_allele_around_cut.to_csv(os.path.join(output_directory,'Alleles_frequency_table_around_cut_site_for_%s.txt' % sgRNA),sep='\t',header=True)
+        figure_jobs.append(('9','plot_alleles_table' if vector_alleles_table else 'plot_alleles_table_fast',
+                            {'reference_seq':reference_seq,'cut_point':cut_point,'df_alleles':df_allele_around_cut,
+                             'MIN_FREQUENCY':min_frequency,'MAX_N_ROWS':max_n_rows},
+                            '9.Alleles_around_cut_site_for_%s' % sgRNA))
 
+    return figure_jobs
 
-    per_element_annot_kws=[]
-    idx_row=0
-    for idx,row in df_alleles.ix[df_alleles['%Reads']>=MIN_FREQUENCY][:MAX_N_ROWS].iterrows():
-        X.append(seq_to_numbers(str.upper(idx)))
-        annot.append(list(idx))
-        y_labels.append('%.2f%% (%d reads)' % (row['%Reads'],row['#Reads']))
 
+def parse_replot_args(argv):
+    replot_parser = argparse.ArgumentParser(prog='CRISPResso replot',
+                                            description='Draw again the figures of a previous CRISPResso run from its plot data, without the reads or the alignments. The options of the original run are used as defaults.')
+    replot_parser.add_argument('crispresso_output_folder', type=str,  help='Output folder of a previous CRISPResso run')
+    replot_parser.add_argument('--figures', type=str, nargs='+', help='Draw only these figures, for example 1a 4a 9 (default: the figures selected by --plot_level)', default=[])
+    replot_parser.add_argument('--plot_level', type=str, choices=['none','summary','full'], help='Figures to draw: none, summary (1a, 2, 4a and 5) or full (default: full)',default='full')
+    replot_parser.add_argument('--offset_around_cut_to_plot',  type=int, help='Offset to use to summarize alleles around the cut site in the alleles table plot (default: as in the original run)')
+    replot_parser.add_argument('--min_frequency_alleles_around_cut_to_plot', type=float, help='Minimum %% reads required to report an allele in the alleles table plot (default: as in the original run)')
+    replot_parser.add_argument('--max_rows_alleles_around_cut_to_plot',  type=int, help='Maximum number of rows to report in the alleles table plot (default: as in the original run)')
+    replot_parser.add_argument('--vector_alleles_table',help='Draw the alleles table plots as vector graphics, one patch and one text object for each base (slower) (default: as in the original run)',action='store_true',default=None)
+    replot_parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files (default: as in the original run)',action='store_true',default=None)
+    replot_parser.add_argument('-p','--n_processes',type=int, help='Number of processes to use for the rendering of the figures (default: as in the original run)')
 
-        for p in re_find_indels.finditer(row['Reference_Sequence']):
-            lines[idx_row].append((p.start(),p.end()))
+    args=replot_parser.parse_args(argv)
 
-        idx_row+=1
+    plot_data=load_plot_data(args.crispresso_output_folder)
 
+    #the options not specified are taken from the original run
+    for option in REPLOT_OPTIONS:
+        if getattr(args,option) is None:
+            setattr(args,option,plot_data['args'][option])
 
-        idxs_sub= [i_sub for i_sub in range(len(idx)) if \
-                   (row['Reference_Sequence'][i_sub]!=idx[i_sub]) and \
-                   (row['Reference_Sequence'][i_sub]!='-') and\
-                   (idx[i_sub]!='-')]
-        to_append=np.array([{}]*len(idx),dtype=np.object)
-        to_append[ idxs_sub]={'weight':'bold', 'color':'black','size':16}
-        per_element_annot_kws.append(to_append)
+    return args,plot_data
 
-    ref_seq_around_cut=reference_seq[cut_point-offset_around_cut_to_plot+1:cut_point+offset_around_cut_to_plot+1]
 
+def replot(args,plot_data):
+    '''
+    Draw again the figures of a previous run from the plot data saved in its output folder.
+    '''
+    output_directory=args.crispresso_output_folder
 
-    per_element_annot_kws=np.vstack(per_element_annot_kws[::-1])
-    ref_seq_hm=np.expand_dims(seq_to_numbers(ref_seq_around_cut),1).T
-    ref_seq_annot_hm=np.expand_dims(list(ref_seq_around_cut),1).T
+    figure_jobs=list(plot_data['figure_jobs'])
 
-    NEW_SEABORN=np.sum(np.array(map(int,sns.__version__.split('.')))*(100,10,1))>= 80
+    available_figures=set([figure_job[0] for figure_job in figure_jobs]+(['9'] if plot_data['cut_points'] else []))
+    unknown_figures=set(args.figures)-available_figures
+    if unknown_figures:
+        raise ReplotException('The figures %s are not available for this run, the available figures are: %s' % (', '.join(sorted(unknown_figures)),', '.join(sorted(available_figures))))
 
-    if NEW_SEABORN:
-        annot=annot[::-1]
-        X=X[::-1]
+    if not args.figures or '9' in args.figures:
+        figure_jobs+=get_alleles_table_figure_jobs(output_directory,plot_data['df_alleles'],plot_data['args']['amplicon_seq'],
+                                                   plot_data['sgRNA_sequences'],plot_data['cut_points'],
+                                                   args.offset_around_cut_to_plot,args.min_frequency_alleles_around_cut_to_plot,
+                                                   args.max_rows_alleles_around_cut_to_plot,args.vector_alleles_table)
 
-    sns.set_context('poster')
+    if args.figures:
+        figure_jobs=[figure_job for figure_job in figure_jobs if figure_job[0] in args.figures]
 
-    N_ROWS=len(X)
-    N_COLUMNS=offset_around_cut_to_plot*2
+    info('Drawing %d figures in %s' % (len(figure_jobs),output_directory))
+    start_time=time.time()
+    CRISPRessoPlot.render_figures(figure_jobs,output_directory,'full' if args.figures else args.plot_level,
+                                  ['pdf','png'] if args.save_also_png else ['pdf'],args.n_processes)
+    info('Done in %.1f seconds!' % (time.time()-start_time))
 
-    fig=plt.figure(figsize=(offset_around_cut_to_plot*0.6,(N_ROWS+1)*0.6))
-    gs1 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
-    gs2 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
 
-    ax_hm_ref=plt.subplot(gs1[0, :])
-    ax_hm=plt.subplot(gs2[1:, :])
+def compute_ref_positions(ref_seq):
+        pos_idxs=[]
+        idx=0
+        for c in ref_seq:
+                if c in set(['A','T','C','G','N']):
+                        pos_idxs.append(idx)
+                        idx+=1
+                else:
+                        if idx==0:
+                                pos_idxs.append(-1)
+                        else:
+                                pos_idxs.append(-idx)
+        return np.array(pos_idxs)
+
+def prepare_alignments_for_quantification(df_needle_alignment,cut_points):
+    '''
+    Add the columns used and filled by process_df_chunk: the score difference with the HDR alignment, the classes
+    and the counters, and the position in the reference of each alignment column. The bp equal to N in the
+    amplicon are not considered as mutated.
+    '''
+    if args.expected_hdr_amplicon_seq:
+            df_needle_alignment['score_diff']=df_needle_alignment.score_ref-df_needle_alignment.score_repaired
+    else:
+            del df_needle_alignment['score_repaired']
 
-    custom_heatmap(ref_seq_hm,annot=ref_seq_annot_hm,annot_kws={'size':16},cmap=cmap,fmt='s',ax=ax_hm_ref,vmin=0,vmax=5,square=True)
-    custom_heatmap(X,annot=np.array(annot),annot_kws={'size':16},cmap=cmap,fmt='s',ax=ax_hm,square=True, per_element_annot_kws=per_element_annot_kws)
+    df_needle_alignment['UNMODIFIED']=(df_needle_alignment.score_ref==100)
 
-    ax_hm.yaxis.tick_right()
-    ax_hm.yaxis.set_ticklabels(y_labels[::-1],rotation=True),
-    ax_hm.xaxis.set_ticks([])
+    #the rest we have to look one by one to potentially exclude regions
+    df_needle_alignment['MIXED']=False
+    df_needle_alignment['HDR']=False
+    df_needle_alignment['NHEJ']=False
 
-    #print lines
+    df_needle_alignment['n_mutated']=0
+    df_needle_alignment['n_inserted']=0
+    df_needle_alignment['n_deleted']=0
 
-    #cut point vertical line
-    ax_hm.vlines([offset_around_cut_to_plot],*ax_hm.get_ylim(),linestyles='dashed')
+    df_needle_alignment['FRAMESHIFT']=False
+    df_needle_alignment['INFRAME']=False
 
-    #create boxes for ins
-    for idx,lss in lines.iteritems():
-            for ls in lss:
-                for l in ls:
-                    ax_hm.vlines([l],N_ROWS-idx-1,N_ROWS-idx,color='red',lw=3)
+    for idx_cut in range(len(cut_points)):
+        df_needle_alignment['NHEJ_cut_%d' % idx_cut]=False
 
-                ax_hm.hlines(N_ROWS-idx-1,ls[0],ls[1],color='red',lw=3)
-                ax_hm.hlines(N_ROWS-idx,ls[0],ls[1],color='red',lw=3)
+    #remove the mutations in bp equal to 'N'
+    if 'N' in args.amplicon_seq and df_needle_alignment.shape[0]>0:
 
-    ax_hm_ref.yaxis.tick_right()
-    ax_hm_ref.xaxis.set_ticks([])
-    ax_hm_ref.yaxis.set_ticklabels(['Reference'],rotation=True)
+        def ignore_N_in_alignment(row):
+            row['align_str']=''.join([('|' if  (row['ref_seq'][idx]=='N') else c ) for idx,c in enumerate(row['align_str'])])
+            if len(set(row['align_str']))==1:
+                row['UNMODIFIED']=True
 
-    gs2.update(left=0,right=1, hspace=0.05,wspace=0,top=1*(((N_ROWS)*1.13))/(N_ROWS))
-    gs1.update(left=0,right=1, hspace=0.05,wspace=0,)
+            return row
 
-    sns.set_context(rc={'lines.markeredgewidth': 1,'mathtext.fontset' : 'stix','text.usetex':True,'text.latex.unicode':True} )
+        df_needle_alignment=df_needle_alignment.apply(ignore_N_in_alignment,axis=1)
 
-    proxies = [matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='black',
-                    mec='none', marker=r'$\mathbf{{{}}}$'.format('bold'),ms=18),
-               matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
-                    mec='red', marker='s',ms=8,markeredgewidth=2.5),
-              matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
-                    mec='black', marker='_',ms=2,),
-              matplotlib.lines.Line2D([0], [1], linestyle='--',c='black',ms=6)] #
-    descriptions=['Substitutions','Insertions','Deletions','Predicted cleavage position']
-    ax_hm_ref.legend(proxies, descriptions, numpoints=1, markerscale=2, loc='center', bbox_to_anchor=(0.5, 4),ncol=1)
+    #compute positions relative to alignmnet
+    df_needle_alignment['ref_positions']=df_needle_alignment['ref_seq'].apply(compute_ref_positions)
 
-    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename)
+    return df_needle_alignment
 
-    plt.savefig(_jp('9.Alleles_around_cut_site_for_%s.pdf' % sgRNA_name),bbox_inches='tight')
-    if args.save_also_png:
-        plt.savefig(_jp('9.Alleles_around_cut_site_for_%s.png' % sgRNA_name),bbox_inches='tight',pad=1)
+def get_alignment_id(read_id,alignment_ids):
+    '''
+    Id of the alignment of a read in df_needle_alignment, the reads aligned to the reverse complement have the suffix _RC.
+    Returns None for the reads not aligned.
+    '''
+    if read_id in alignment_ids:
+        return read_id
+    elif read_id+'_RC' in alignment_ids:
+        return read_id+'_RC'
+    else:
+        return None
 
+def write_reads_by_class(df_needle_alignment,reads_filename,output_prefix,output_format='fastq',classes=['UNMODIFIED','NHEJ','HDR','MIXED']):
+    '''
+    Write the reads of each class (a boolean column of df_needle_alignment) in a gzipped fastq or fasta file
+    output_prefix+class. The reads are streamed from reads_filename, the reads saved while they were loaded for the
+    alignment, so only the classes of the aligned reads are kept in memory. Returns the filenames written.
+    '''
+    output_filenames=dict([(class_name,'%s%s.%s.gz' % (output_prefix,class_name,output_format)) for class_name in classes])
+    output_handles=dict([(class_name,gzip.open(output_filenames[class_name],'w+')) for class_name in classes])
+    read_classes=dict(itertools.izip(df_needle_alignment.index,df_needle_alignment[classes].values.tolist()))
 
-def main():
     try:
-             print '  \n~~~CRISPResso~~~'
-             print '-Analysis of CRISPR/Cas9 outcomes from deep sequencing data-'
-             print'''
-                      )
-                     (
-                    __)__
-                 C\|     |
-                   \     /
-                    \___/
-             '''
-             print'\n[Luca Pinello 2015, send bugs, suggestions or *green coffee* to lucapinello AT gmail DOT com]\n\n',
+        for read_id,read_seq,read_qual in read_fastq(reads_filename):
+            alignment_id=get_alignment_id(read_id,read_classes)
+            if alignment_id is None:
+                continue
+
+            for class_name,in_class in zip(classes,read_classes[alignment_id]):
+                if in_class:
+                    if output_format=='fastq':
+                        output_handles[class_name].write('@%s\n%s\n+\n%s\n' % (read_id,read_seq,read_qual))
+                    else:
+                        output_handles[class_name].write('>%s\n%s\n' % (read_id,read_seq))
+    finally:
+        for output_handle in output_handles.values():
+            output_handle.close()
+
+    return [output_filenames[class_name] for class_name in classes]
+
+def alignment_to_sam_fields(ref_seq,align_seq):
+    '''
+    Convert a global alignment of a read to the amplicon (with - for the gaps) to the 1-based position of the
+    first aligned amplicon base, the CIGAR string, the number of edits (NM) and the read sequence. The read
+    bases aligned before the start or after the end of the amplicon are soft clipped.
+    '''
+    ops=[]
+    for ref_base,read_base in zip(ref_seq,align_seq):
+        if ref_base=='-':
+            ops.append('I')
+        elif read_base=='-':
+            ops.append('D')
+        else:
+            ops.append('M' if ref_base==read_base else 'X')
+
+    #the end gaps are not part of the alignment
+    start=0
+    pos=1
+    clip_left=0
+    while start<len(ops) and ops[start] in 'ID':
+        if ops[start]=='I':
+            clip_left+=1
+        else:
+            pos+=1
+        start+=1
+
+    end=len(ops)
+    clip_right=0
+    while end>start and ops[end-1] in 'ID':
+        if ops[end-1]=='I':
+            clip_right+=1
+        end-=1
+
+    cigar=['%dS' % clip_left] if clip_left else []
+    n_edits=0
+    for op,group in itertools.groupby(ops[start:end],key=lambda op: 'M' if op=='X' else op):
+        group=list(group)
+        cigar.append('%d%s' % (len(group),op))
+        n_edits+=sum([1 for o in group if o!='M'])
+    if clip_right:
+        cigar.append('%dS' % clip_right)
+
+    return pos,''.join(cigar),n_edits,align_seq.replace('-','')
+
+def write_alignments_bam(df_needle_alignment,bam_filename,reference_name,reference_seq,reads_filename=None,classes=['UNMODIFIED','NHEJ','HDR','MIXED']):
+    '''
+    Write the alignments to the amplicon as a sorted and indexed bam file (with samtools), with the class of each
+    read in the XC tag and the identity to the amplicon (and to the expected HDR amplicon) in the XI (and XH) tag.
+    The qualities of the reads are streamed from reads_filename, without it the reads are named after the alignment
+    ids and the qualities are not reported.
+    '''
+    sam_filename=bam_filename.replace('.bam','.sam')
+
+    if reads_filename is not None:
+        rows=dict([(row.Index,row) for row in df_needle_alignment.itertuples()])
+        aligned_reads=((rows[alignment_id],read_id,read_qual) for alignment_id,read_id,read_qual in
+                       ((get_alignment_id(read_id,rows),read_id,read_qual) for read_id,read_seq,read_qual in read_fastq(reads_filename))
+                       if alignment_id is not None)
+    else:
+        aligned_reads=((row,row.Index[:-3] if row.Index.endswith('_RC') else row.Index,'*') for row in df_needle_alignment.itertuples())
 
+    with open(sam_filename,'w+') as outfile:
+        outfile.write('@HD\tVN:1.4\tSO:unsorted\n@SQ\tSN:%s\tLN:%d\n@PG\tID:CRISPResso\tPN:CRISPResso\tVN:%s\n' % (reference_name,len(reference_seq),__version__))
 
-             print 'Version %s\n' % __version__
+        has_score_repaired='score_repaired' in df_needle_alignment.columns
+        for row,read_id,read_qual in aligned_reads:
+            is_rc=row.Index.endswith('_RC')
+            if is_rc and read_qual!='*':
+                read_qual=read_qual[::-1]
 
-             def print_stacktrace_if_debug():
-                debug_flag = False
-                if 'args' in globals() and 'debug' in args:
-                    debug_flag = args.debug
+            pos,cigar,n_edits,read_seq=alignment_to_sam_fields(row.ref_seq,row.align_seq)
+            read_classes=','.join([class_name for class_name in classes if getattr(row,class_name)])
+
+            tags=['NM:i:%d' % n_edits,'XC:Z:%s' % read_classes,'XI:f:%.1f' % row.score_ref]
+            if has_score_repaired and not pd.isnull(row.score_repaired):
+                tags.append('XH:f:%.1f' % row.score_repaired)
+
+            outfile.write('\t'.join([read_id,'16' if is_rc else '0',reference_name,str(pos),'255',cigar,'*','0','0',read_seq,read_qual]+tags)+'\n')
+
+    cmd='samtools sort -o %s %s && samtools index %s' % (bam_filename,sam_filename,bam_filename)
+    SAMTOOLS_STATUS=sb.call(cmd,shell=True)
+    os.remove(sam_filename)
+
+    if SAMTOOLS_STATUS:
+        raise SamtoolsException('samtools failed to create the bam file %s' % bam_filename)
+
+def write_results_hdf5(hdf5_filename,vectors,tables,metadata):
+    '''
+    Write the results of a run in a single HDF5 file (pandas with PyTables) with typed columns: the table vectors
+    with the effect vectors by amplicon position, one table for each (key,dataframe) pair in tables and the table
+    metadata with the key,value pairs of the dictionary metadata. The tables are stored in the table format, so
+    they can be loaded in chunks or filtered, for example pd.read_hdf(hdf5_filename,'alleles',where='NHEJ==True',chunksize=10000).
+    '''
+    df_vectors=pd.DataFrame(dict([(name,pd.Series(vector)) for name,vector in vectors]),columns=[name for name,vector in vectors])
+    df_vectors.index=pd.Index(np.arange(df_vectors.shape[0])+1,name='amplicon_position')
+
+    df_metadata=pd.DataFrame([[str(key),str(value)] for key,value in sorted(metadata.items())],columns=['key','value'])
+
+    store=pd.HDFStore(hdf5_filename,mode='w',complevel=5,complib='zlib')
+    try:
+        for key,df_table in [('vectors',df_vectors)]+tables+[('metadata',df_metadata)]:
+            #the columns with a valid name can be used in the queries
+            data_columns=[column for column in df_table.columns if re.match(r'^[A-Za-z_]\w*$',str(column))]
+            store.put(key,df_table,format='table',data_columns=data_columns)
+    finally:
+        store.close()
+
+def requantify_sweep(df_needle_alignment,sweep_parameter_names,sweep_parameter_sets,cut_points,cut_point_sgRNAs):
+    '''
+    Classify the unique alignments for each parameter set, each alignment is weighted by its number of reads.
+    The parameters of each set are passed to process_df_chunk, the global args are not changed.
+    '''
+    N_TOTAL=float(df_needle_alignment.n_reads.sum())
+    sweep_data=[]
+
+    for parameter_set in sweep_parameter_sets:
+        sweep_args=argparse.Namespace(**vars(args))
+        for name,value in parameter_set.items():
+            setattr(sweep_args,name,value)
+
+        sweep_include_idxs=get_include_idxs(cut_points,len_amplicon,sweep_args.window_around_sgrna,sweep_args.exclude_bp_from_left,sweep_args.exclude_bp_from_right)
+        sweep_include_idxs_per_cut=[get_include_idxs([cut_p],len_amplicon,sweep_args.window_around_sgrna,sweep_args.exclude_bp_from_left,sweep_args.exclude_bp_from_right) for cut_p in cut_points]
+
+        df_needle_alignment_set=process_df_chunk(df_needle_alignment.copy(),sweep_args,sweep_include_idxs,sweep_include_idxs_per_cut)[0]
+
+        n_reads=df_needle_alignment_set.n_reads
+        N_UNMODIFIED=(df_needle_alignment_set.UNMODIFIED*n_reads).sum()
+        N_MODIFIED=(df_needle_alignment_set.NHEJ*n_reads).sum()
+        N_REPAIRED=(df_needle_alignment_set.HDR*n_reads).sum()
+        N_MIXED_HDR_NHEJ=(df_needle_alignment_set.MIXED*n_reads).sum()
+
+        sweep_data.append([parameter_set[name] for name in sweep_parameter_names]+\
+                          [N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,int(N_TOTAL),
+                           N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100,N_REPAIRED/N_TOTAL*100,N_MIXED_HDR_NHEJ/N_TOTAL*100]+\
+                          [(df_needle_alignment_set['NHEJ_cut_%d' % idx_cut]*n_reads).sum() for idx_cut in range(len(cut_points))])
+
+    return pd.DataFrame(sweep_data,columns=sweep_parameter_names+['Unmodified','NHEJ','HDR','Mixed HDR-NHEJ','Total Aligned',
+                                                                  '%Unmodified','%NHEJ','%HDR','%Mixed HDR-NHEJ']+\
+                                                                  ['NHEJ_%s' % cut_point_label for cut_point_label in get_cut_point_labels(cut_point_sgRNAs)])
+
+
+def classify_unique_sequences(sequences,alignments,cut_points):
+    '''
+    Classify each aligned sequence as UNMODIFIED, NHEJ, HDR or MIXED with the code used for the quantification,
+    include_idxs and include_idxs_per_cut must be already set. Returns a dictionary sequence->class.
+    '''
+    needle_alignment_data=[]
+    for seq in sequences:
+        orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq=alignments[seq]
+        if orientation!='NA':
+            needle_alignment_data.append([seq,score_ref,length,ref_seq,align_str,align_seq,score_repaired])
+
+    if not needle_alignment_data:
+        return {}
+
+    df_needle_alignment=pd.DataFrame(needle_alignment_data,columns=['ID','score_ref','length','ref_seq','align_str','align_seq','score_repaired']).set_index('ID')
+    df_needle_alignment=process_df_chunk(prepare_alignments_for_quantification(df_needle_alignment,cut_points))[0]
+
+    classes={}
+    for seq,row in df_needle_alignment[['NHEJ','HDR','MIXED']].iterrows():
+        if row.NHEJ:
+            classes[seq]='NHEJ'
+        elif row.HDR:
+            classes[seq]='HDR'
+        elif row.MIXED:
+            classes[seq]='MIXED'
+        else:
+            classes[seq]='UNMODIFIED'
+
+    return classes
+
+def align_until_convergence(read_seqs,align_function,cut_points,allowed_sequences,batch_size=10000,tolerance=1.0,seed=0):
+    '''
+    Align and classify the reads in random batches until the 95% confidence interval of the percentage of each
+    class is narrower than tolerance (in percentage points). align_function(sequences,batch_id) must return the
+    alignments, the needle output files and the intermediate files. The sequences not in allowed_sequences are
+    not aligned. Returns the alignments, the files created and the sorted indexes of the reads used.
+    '''
+    read_order=range(len(read_seqs))
+    random.Random(seed).shuffle(read_order)
+
+    alignments={}
+    classes={}
+    class_counts=Counter()
+    n_reads_aligned=0
+    n_reads_used=0
+    needle_output_filenames=[]
+    intermediate_filenames=[]
+
+    for idx_batch,batch_start in enumerate(range(0,len(read_order),batch_size)):
+        batch=read_order[batch_start:batch_start+batch_size]
+
+        batch_counts=Counter([read_seqs[idx_read] for idx_read in batch])
+        new_sequences=[seq for seq,count in batch_counts.most_common() if seq not in alignments and seq in allowed_sequences]
+        if new_sequences:
+            batch_alignments,batch_needle_output_filenames,batch_intermediate_filenames=align_function(new_sequences,idx_batch)
+            alignments.update(batch_alignments)
+            classes.update(classify_unique_sequences(new_sequences,alignments,cut_points))
+            needle_output_filenames+=batch_needle_output_filenames
+            intermediate_filenames+=batch_intermediate_filenames
+
+        for seq,count in batch_counts.iteritems():
+            if seq in classes:
+                class_counts[classes[seq]]+=count
+                n_reads_aligned+=count
+
+        n_reads_used+=len(batch)
+
+        if n_reads_aligned==0:
+            continue
+
+        ci_widths=[]
+        for class_name in ['UNMODIFIED','NHEJ','HDR','MIXED']:
+            ci_low,ci_high=wilson_interval(class_counts[class_name],n_reads_aligned)
+            ci_widths.append(ci_high-ci_low)
+
+        info('%d reads used, %d aligned: %s, widest 95%% confidence interval %.2f%%.' % (n_reads_used,n_reads_aligned,
+             ', '.join(['%s %.2f%%' % (class_name,100.0*class_counts[class_name]/n_reads_aligned) for class_name in ['UNMODIFIED','NHEJ','HDR','MIXED']]),max(ci_widths)))
+
+        if max(ci_widths)<=tolerance:
+            break
+
+    return alignments,needle_output_filenames,intermediate_filenames,sorted(read_order[:n_reads_used])
+
+
+def preprocess_reads(args,OUTPUT_DIRECTORY,log_filename,len_amplicon,merge_paired_end=True):
+    '''
+    Split, filter, trim and merge the reads as requested, returns the processed reads filename, the number of reads in input and after
+    the preprocessing and the intermediate files created. With merge_paired_end False the paired end reads are not merged and the
+    processed reads filename is the pair of filenames of the processed mates.
+    '''
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename) #handy function to put a file in the output directory
+
+    if args.split_paired_end:
+
+       if args.fastq_r2!='':
+               raise Exception('The option --split_paired_end is available only when a single fastq file is specified!')
+       else:
+               info('Splitting paired end single fastq file in two files...')
+               args.fastq_r1,args.fastq_r2=split_paired_end_reads_single_file(args.fastq_r1,
+                                                                           output_filename_r1=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r1.fastq.gz'),
+                                                                           output_filename_r2=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r2.fastq.gz'),)
+               splitted_files_to_remove=[args.fastq_r1,args.fastq_r2]
+
+               info('Done!')
+
+    if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
+       info('Filtering reads with average bp quality < %d and single bp quality < %d ...' % (args.min_average_read_quality,args.min_single_bp_quality))
+       if args.fastq_r2!='':
+               args.fastq_r1,args.fastq_r2=filter_pe_fastq_by_qual(args.fastq_r1,
+                                                                args.fastq_r2,
+                                                                output_filename_r1=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_filtered.fastq.gz'),
+                                                                output_filename_r2=_jp(os.path.basename(args.fastq_r2.replace('.fastq','')).replace('.gz','')+'_filtered.fastq.gz'),
+                                                                min_bp_quality=args.min_average_read_quality,
+                                                                min_single_bp_quality=args.min_single_bp_quality,
+                                                                )
+       else:
+               args.fastq_r1=filter_se_fastq_by_qual(args.fastq_r1,
+                                                          output_filename=_jp(os.path.basename(args.fastq_r1).replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'),
+                                                          min_bp_quality=args.min_average_read_quality,
+                                                          min_single_bp_quality=args.min_single_bp_quality,
+                                                          )
+
+
+
+    if args.fastq_r2=='': #single end reads
+
+        #check if we need to trim
+        if not args.trim_sequences:
+            #create a symbolic link
+            symlink_filename=_jp(os.path.basename(args.fastq_r1))
+            force_symlink(os.path.abspath(args.fastq_r1),symlink_filename)
+            output_forward_filename=symlink_filename
+        else:
+            output_forward_filename=_jp('reads.trimmed.fq.gz')
+            #Trimming with trimmomatic
+            cmd='java -jar %s SE -phred33 %s  %s %s >>%s 2>&1'\
+            % (get_data('trimmomatic-0.33.jar'),args.fastq_r1,
+               output_forward_filename,
+               args.trimmomatic_options_string.replace('NexteraPE-PE.fa','TruSeq3-SE.fa'),
+               log_filename)
+            #print cmd
+            TRIMMOMATIC_STATUS=sb.call(cmd,shell=True)
+
+            if TRIMMOMATIC_STATUS:
+                    raise TrimmomaticException('TRIMMOMATIC failed to run, please check the log file.')
 
-                if debug_flag:
-                    traceback.print_exc(file=sys.stdout)
 
+        processed_output_filename=output_forward_filename
 
+    else:#paired end reads case
+
+        if not args.trim_sequences:
+            output_forward_paired_filename=args.fastq_r1
+            output_reverse_paired_filename=args.fastq_r2
+        else:
+            info('Trimming sequences with Trimmomatic...')
+            output_forward_paired_filename=_jp('output_forward_paired.fq.gz')
+            output_forward_unpaired_filename=_jp('output_forward_unpaired.fq.gz')
+            output_reverse_paired_filename=_jp('output_reverse_paired.fq.gz')
+            output_reverse_unpaired_filename=_jp('output_reverse_unpaired.fq.gz')
+
+            #Trimming with trimmomatic
+            cmd='java -jar %s PE -phred33 %s  %s %s  %s  %s  %s %s >>%s 2>&1'\
+            % (get_data('trimmomatic-0.33.jar'),
+                    args.fastq_r1,args.fastq_r2,output_forward_paired_filename,
+                    output_forward_unpaired_filename,output_reverse_paired_filename,
+                    output_reverse_unpaired_filename,args.trimmomatic_options_string,log_filename)
+            #print cmd
+            TRIMMOMATIC_STATUS=sb.call(cmd,shell=True)
+            if TRIMMOMATIC_STATUS:
+                    raise TrimmomaticException('TRIMMOMATIC failed to run, please check the log file.')
+
+            info('Done!')
+
+        if not merge_paired_end:
+            N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
+            N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(output_forward_paired_filename)
+            if N_READS_AFTER_PREPROCESSING == 0:
+                raise NoReadsAfterQualityFiltering('No reads in input or no reads survived the average or single bp quality filtering.')
+
+            files_to_remove=[]
+            if args.trim_sequences:
+                files_to_remove+=[output_forward_paired_filename,output_reverse_paired_filename,\
+                                  output_forward_unpaired_filename,output_reverse_unpaired_filename]
+
+            if args.split_paired_end:
+                files_to_remove+=splitted_files_to_remove
+
+            if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
+                files_to_remove+=[args.fastq_r1,args.fastq_r2]
+
+            return (output_forward_paired_filename,output_reverse_paired_filename),N_READS_INPUT,N_READS_AFTER_PREPROCESSING,files_to_remove
+
+        info('Estimating average read length...')
+        if get_n_reads_fastq(output_forward_paired_filename):
+            avg_read_length=get_avg_read_lenght_fastq(output_forward_paired_filename)
+            std_fragment_length=int(len_amplicon*0.1)
+        else:
+           raise NoReadsAfterQualityFiltering('No reads survived the average or single bp quality filtering.')
+
+        #Merging with Flash
+        info('Merging paired sequences with Flash...')
+        cmd='flash %s %s --allow-outies --max-overlap %d --min-overlap %d -f %d -r %d -s %d  -z -d %s >>%s 2>&1' %\
+        (output_forward_paired_filename,
+         output_reverse_paired_filename,
+         args.max_paired_end_reads_overlap,
+         args.min_paired_end_reads_overlap,
+         len_amplicon,avg_read_length,
+         std_fragment_length,
+         OUTPUT_DIRECTORY,log_filename)
+
+        FLASH_STATUS=sb.call(cmd,shell=True)
+        if FLASH_STATUS:
+            raise FlashException('Flash failed to run, please check the log file.')
+
+        info('Done!')
+
+        flash_hist_filename=_jp('out.hist')
+        flash_histogram_filename=_jp('out.histogram')
+        flash_not_combined_1_filename=_jp('out.notCombined_1.fastq.gz')
+        flash_not_combined_2_filename=_jp('out.notCombined_2.fastq.gz')
+
+        processed_output_filename=_jp('out.extendedFrags.fastq.gz')
+
+    #count reads
+    N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
+    N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
+    if N_READS_AFTER_PREPROCESSING == 0:
+        raise NoReadsAfterQualityFiltering('No reads in input or no reads survived the average or single bp quality filtering.')
+
+    files_to_remove=[processed_output_filename]
+
+    if args.fastq_r2!='':
+        files_to_remove+=[flash_hist_filename,flash_histogram_filename,\
+                          flash_not_combined_1_filename,flash_not_combined_2_filename]
+
+    if args.trim_sequences and args.fastq_r2!='':
+        files_to_remove+=[output_forward_paired_filename,output_reverse_paired_filename,\
+                          output_forward_unpaired_filename,output_reverse_unpaired_filename]
+
+    if args.split_paired_end:
+        files_to_remove+=splitted_files_to_remove
+
+    if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
+
+       if args.fastq_r2!='':
+                files_to_remove+=[args.fastq_r1,args.fastq_r2]
+       else:
+                files_to_remove+=[args.fastq_r1]
+
+    return processed_output_filename,N_READS_INPUT,N_READS_AFTER_PREPROCESSING,files_to_remove
+
+
+def get_crispresso_parser():
+    parser = argparse.ArgumentParser(description='CRISPResso Parameters',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    parser.add_argument('-r1','--fastq_r1', type=str,  help='First fastq file', required=True,default='Fastq filename' )
+    parser.add_argument('-r2','--fastq_r2', type=str,  help='Second fastq file for paired end reads',default='')
+    parser.add_argument('-a','--amplicon_seq', type=str,  help='Amplicon Sequence', default='')
+
+    #optional
+    parser.add_argument('-g','--guide_seq',  help="sgRNA sequence, if more than one, please separate by comma/s. Note that the sgRNA needs to be input as the guide RNA sequence (usually 20 nt) immediately adjacent to but not including the PAM sequence (5' of NGG for SpCas9). If the PAM is found on the opposite strand with respect to the Amplicon Sequence, ensure the sgRNA sequence is also found on the opposite strand. The CRISPResso convention is to depict the expected cleavage position using the value of the parameter cleavage_offset nt  3' from the end of the guide. In addition, the use of alternate nucleases to SpCas9 is supported. For example, if using the Cpf1 system, enter the sequence (usually 20 nt) immediately 3' of the PAM sequence and explicitly set the cleavage_offset parameter to 1, since the default setting of -3 is suitable only for SpCas9.", default='')
+    parser.add_argument('-e','--expected_hdr_amplicon_seq',  help='Amplicon sequence expected after HDR', default='')
+    parser.add_argument('-d','--donor_seq',  help='Donor Sequence. This optional input comprises a subsequence of the expected HDR amplicon to be highlighted in plots.', default='')
+    parser.add_argument('-c','--coding_seq',  help='Subsequence/s of the amplicon sequence covering one or more coding sequences for the frameshift analysis.If more than one (for example, split by intron/s), please separate by comma.', default='')
+    parser.add_argument('-f','--amplicons_file', type=str,  help='Amplicons description file to analyze several amplicons in a single run, in the same format used by CRISPRessoPooled: a tab delimited text file with up to 5 columns (AMPLICON_NAME, AMPLICON_SEQUENCE, sgRNA_SEQUENCE, EXPECTED_AMPLICON_AFTER_HDR, CODING_SEQUENCE), NA can be used for the optional columns. The reads are preprocessed once and each read is assigned to its amplicon.', default='')
+    parser.add_argument('--amplicon_assignment_kmer_size', type=int,  help='Size of the k-mers used to assign each read to its amplicon when an amplicons description file is provided', default=10)
+    parser.add_argument('--amplicon_assignment_min_kmer_fraction', type=float,  help='Minimum fraction of the k-mers of a read that must be specific to its amplicon to assign the read to it', default=0.5)
+    parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
+    parser.add_argument('-s','--min_single_bp_quality', type=int, help='Minimum single bp score (phred33) to keep a read', default=0)
+    parser.add_argument('--min_identity_score', type=float, help='Minimum identity score for the alignment', default=60.0)
+    parser.add_argument('-n','--name',  help='Output name', default='')
+    parser.add_argument('-o','--output_folder',  help='', default='')
+    parser.add_argument('--split_paired_end',help='Splits a single fastq file contating paired end reads in two files before running CRISPResso',action='store_true')
+    parser.add_argument('--trim_sequences',help='Enable the trimming of Illumina adapters with Trimmomatic',action='store_true')
+    parser.add_argument('--trimmomatic_options_string', type=str, help='Override options for Trimmomatic',default=' ILLUMINACLIP:%s:0:90:10:0:true MINLEN:40' % get_data('NexteraPE-PE.fa'))
+    parser.add_argument('--min_paired_end_reads_overlap',  type=int, help='Parameter for the FLASH read merging step. Minimum required overlap length between two reads to provide a confident overlap. ', default=4)
+    parser.add_argument('--max_paired_end_reads_overlap',  type=int, help='Parameter for the FLASH merging step. Maximum overlap length expected in approximately 90%% of read pairs. Please see the FLASH manual for more information.', default=100)    
+    parser.add_argument('--hide_mutations_outside_window_NHEJ',help='This parameter allows to visualize only the mutations overlapping the cleavage site and used to classify a read as NHEJ. This parameter has no effect on the quanitification of the NHEJ. It  may be helpful to mask a pre-existing and known mutations or sequencing errors outside the window used for quantification of NHEJ events.',action='store_true')
+    parser.add_argument('-w','--window_around_sgrna', type=int, help='Window(s) in bp around the cleavage position (half on on each side) as determined by the provide guide RNA sequence to quantify the indels. Any indels outside this window are excluded. A value of 0 disables this filter.', default=1)
+    parser.add_argument('--cleavage_offset', type=int, help="Cleavage offset to use within respect to the 3' end of the provided sgRNA sequence. Remember that the sgRNA sequence must be entered without the PAM. The default is -3 and is suitable for the SpCas9 system. For alternate nucleases, other cleavage offsets may be appropriate, for example, if using Cpf1 this parameter would be set to 1.", default=-3)
+    parser.add_argument('--exclude_bp_from_left', type=int, help='Exclude bp from the left side of the amplicon sequence for the quantification of the indels', default=15)
+    parser.add_argument('--exclude_bp_from_right', type=int, help='Exclude bp from the right side of the amplicon sequence for the quantification of the indels', default=15)
+    parser.add_argument('--hdr_perfect_alignment_threshold',  type=float, help='Sequence homology %% for an HDR occurrence', default=98.0)
+    parser.add_argument('--ignore_substitutions',help='Ignore substitutions events for the quantification and visualization',action='store_true')
+    parser.add_argument('--ignore_insertions',help='Ignore insertions events for the quantification and visualization',action='store_true')
+    parser.add_argument('--ignore_deletions',help='Ignore deletions events for the quantification and visualization',action='store_true')
+    parser.add_argument('--needle_options_string',type=str,help='Override options for the Needle aligner',default='-gapopen=10 -gapextend=0.5  -awidth3=5000')
+    parser.add_argument('--alignment_cache_dir',type=str,help='Folder of a persistent alignment cache shared between runs: sequences already aligned to the same amplicon with the same parameters are not aligned again',default='')
+    parser.add_argument('--alignment_cache_max_size',type=float,help='Maximum size (in MB) of the alignment cache, the least recently used alignments are evicted',default=1024)
+    parser.add_argument('--max_reads',type=int,help='Analyze a random sample of at most this number of reads (after the preprocessing), 0 to analyze all the reads. Confidence intervals are reported for the percentages',default=0)
+    parser.add_argument('--subsample_fraction',type=float,help='Analyze a random sample of this fraction of the reads (after the preprocessing). Confidence intervals are reported for the percentages',default=1.0)
+    parser.add_argument('--subsample_seed',type=int,help='Seed of the random subsampling, the same seed selects the same reads',default=0)
+    parser.add_argument('--adaptive_tolerance',type=float,help='Stop the analysis once the 95%% confidence interval of the percentage of each class (unmodified, NHEJ, HDR, mixed) is narrower than this value (in percentage points), the reads are processed in random batches. 0 to analyze all the reads',default=0)
+    parser.add_argument('--adaptive_batch_size',type=int,help='Number of reads in each batch with --adaptive_tolerance',default=10000)
+    parser.add_argument('--quick_estimate',help='Estimate the editing around each cut point in few seconds without aligning the reads, from the reads containing the anchors flanking the cut point with an intact or a disrupted sequence between them. No other analysis is performed',action='store_true')
+    parser.add_argument('--quick_estimate_window',type=int,help='Number of bases on each side of the cut point that must be intact for the quick estimate',default=10)
+    parser.add_argument('--quick_estimate_anchor_size',type=int,help='Size of the anchors flanking the window used by the quick estimate',default=15)
+    parser.add_argument('--umi_regex',type=str,help='Regular expression matching the UMI in the read header (the first group is used, if present). The reads sharing the same UMI are collapsed in one consensus read before the alignment',default='')
+    parser.add_argument('--umi_length',type=int,help='Length of the UMI at the beginning of each read (after the preprocessing). The UMI is removed and the reads sharing the same UMI are collapsed in one consensus read before the alignment',default=0)
+    parser.add_argument('--umi_min_family_size',type=int,help='Minimum number of reads sharing a UMI to report the consensus read',default=1)
+    parser.add_argument('--umi_n_buckets',type=int,help='Number of temporary files used to group the reads by UMI, increase it to reduce the memory used for large files',default=16)
+    parser.add_argument('--prescreen_reads',help='Discard before the alignment the reads that cannot reach the --min_identity_score threshold (for example primer dimers and off-target products), using the k-mers shared with the amplicon. The discarded reads would not be aligned anyway, so the results do not change',action='store_true')
+    parser.add_argument('--prescreen_kmer_size',type=int,help='Size of the k-mers used by --prescreen_reads',default=10)
+    parser.add_argument('--prescreen_write_rejected',help='Write the reads discarded by --prescreen_reads in the file Reads_rejected_by_prescreen.fastq.gz',action='store_true')
+    parser.add_argument('--cluster_near_duplicates',help='Derive the alignment of reads differing by few substitutions from a more abundant read instead of aligning them, reads with differences inside the quantification window are always aligned',action='store_true')
+    parser.add_argument('--max_cluster_distance',type=int,help='Maximum number of substitutions between a read and the read used to derive its alignment',default=2)
+    parser.add_argument('--write_reads_by_class',help='Write the reads of each class (unmodified, NHEJ, HDR, mixed and, with --coding_seq, frameshift and in-frame) in separate gzipped files',action='store_true')
+    parser.add_argument('--reads_by_class_format',type=str,help='Format of the files written by --write_reads_by_class',choices=['fastq','fasta'],default='fastq')
+    parser.add_argument('--write_bam',help='Write the alignments of the reads to the amplicon in a sorted and indexed bam file (CRISPResso_alignments.bam) with the class of each read in the XC tag, samtools is required',action='store_true')
+    parser.add_argument('--write_hdf5',help='Write also the effect vectors, the histograms, the alleles table and the quantification in a single HDF5 file (CRISPResso_results.h5), PyTables is required',action='store_true')
+    parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
+    parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
+    parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+    parser.add_argument('--plot_level',type=str,help='Figures to create: none, only the summary figures (1a, 2, 4a and 5) or all the figures',choices=['none','summary','full'],default='full')
+    parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
+    Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)
+    parser.add_argument('--offset_around_cut_to_plot',  type=int, help='Offset to use to summarize alleles around the cut site in the alleles table plot.', default=20)
+    parser.add_argument('--min_frequency_alleles_around_cut_to_plot', type=float, help='Minimum %% reads required to report an allele in the alleles table plot.', default=0.2)
+    parser.add_argument('--max_rows_alleles_around_cut_to_plot',  type=int, help='Maximum number of rows to report in the alleles table plot. ', default=50)
+    parser.add_argument('--vector_alleles_table',help='Draw each nucleotide of the alleles table plot as a vector element instead of drawing the table as an image, slower for large tables',action='store_true')
+    parser.add_argument('--debug', action='store_true', help='Print stack trace on error.')
+
+    return parser
+
+
+def run_crispresso_analysis(analysis_args,df_alignments=None,run_info=None,sweep_parameter_names=None,sweep_parameter_sets=None):
+             '''
+             Run the analysis on the reads (or on the alignments of a previous run for CRISPResso requantify) with the parameters in analysis_args
+             '''
              #global variables for the multiprocessing
              global args
              global include_idxs
+             global include_idxs_per_cut
              global len_amplicon
              global exon_positions
              global splicing_positions
 
-             parser = argparse.ArgumentParser(description='CRISPResso Parameters',formatter_class=argparse.ArgumentDefaultsHelpFormatter)
-             parser.add_argument('-r1','--fastq_r1', type=str,  help='First fastq file', required=True,default='Fastq filename' )
-             parser.add_argument('-r2','--fastq_r2', type=str,  help='Second fastq file for paired end reads',default='')
-             parser.add_argument('-a','--amplicon_seq', type=str,  help='Amplicon Sequence', required=True)
-
-             #optional
-             parser.add_argument('-g','--guide_seq',  help="sgRNA sequence, if more than one, please separate by comma/s. Note that the sgRNA needs to be input as the guide RNA sequence (usually 20 nt) immediately adjacent to but not including the PAM sequence (5' of NGG for SpCas9). If the PAM is found on the opposite strand with respect to the Amplicon Sequence, ensure the sgRNA sequence is also found on the opposite strand. The CRISPResso convention is to depict the expected cleavage position using the value of the parameter cleavage_offset nt  3' from the end of the guide. In addition, the use of alternate nucleases to SpCas9 is supported. For example, if using the Cpf1 system, enter the sequence (usually 20 nt) immediately 3' of the PAM sequence and explicitly set the cleavage_offset parameter to 1, since the default setting of -3 is suitable only for SpCas9.", default='')
-             parser.add_argument('-e','--expected_hdr_amplicon_seq',  help='Amplicon sequence expected after HDR', default='')
-             parser.add_argument('-d','--donor_seq',  help='Donor Sequence. This optional input comprises a subsequence of the expected HDR amplicon to be highlighted in plots.', default='')
-             parser.add_argument('-c','--coding_seq',  help='Subsequence/s of the amplicon sequence covering one or more coding sequences for the frameshift analysis.If more than one (for example, split by intron/s), please separate by comma.', default='')
-             parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
-             parser.add_argument('-s','--min_single_bp_quality', type=int, help='Minimum single bp score (phred33) to keep a read', default=0)
-             parser.add_argument('--min_identity_score', type=float, help='Minimum identity score for the alignment', default=60.0)
-             parser.add_argument('-n','--name',  help='Output name', default='')
-             parser.add_argument('-o','--output_folder',  help='', default='')
-             parser.add_argument('--split_paired_end',help='Splits a single fastq file contating paired end reads in two files before running CRISPResso',action='store_true')
-             parser.add_argument('--trim_sequences',help='Enable the trimming of Illumina adapters with Trimmomatic',action='store_true')
-             parser.add_argument('--trimmomatic_options_string', type=str, help='Override options for Trimmomatic',default=' ILLUMINACLIP:%s:0:90:10:0:true MINLEN:40' % get_data('NexteraPE-PE.fa'))
-             parser.add_argument('--min_paired_end_reads_overlap',  type=int, help='Parameter for the FLASH read merging step. Minimum required overlap length between two reads to provide a confident overlap. ', default=4)
-             parser.add_argument('--max_paired_end_reads_overlap',  type=int, help='Parameter for the FLASH merging step. Maximum overlap length expected in approximately 90%% of read pairs. Please see the FLASH manual for more information.', default=100)    
-             parser.add_argument('--hide_mutations_outside_window_NHEJ',help='This parameter allows to visualize only the mutations overlapping the cleavage site and used to classify a read as NHEJ. This parameter has no effect on the quanitification of the NHEJ. It  may be helpful to mask a pre-existing and known mutations or sequencing errors outside the window used for quantification of NHEJ events.',action='store_true')
-             parser.add_argument('-w','--window_around_sgrna', type=int, help='Window(s) in bp around the cleavage position (half on on each side) as determined by the provide guide RNA sequence to quantify the indels. Any indels outside this window are excluded. A value of 0 disables this filter.', default=1)
-             parser.add_argument('--cleavage_offset', type=int, help="Cleavage offset to use within respect to the 3' end of the provided sgRNA sequence. Remember that the sgRNA sequence must be entered without the PAM. The default is -3 and is suitable for the SpCas9 system. For alternate nucleases, other cleavage offsets may be appropriate, for example, if using Cpf1 this parameter would be set to 1.", default=-3)
-             parser.add_argument('--exclude_bp_from_left', type=int, help='Exclude bp from the left side of the amplicon sequence for the quantification of the indels', default=15)
-             parser.add_argument('--exclude_bp_from_right', type=int, help='Exclude bp from the right side of the amplicon sequence for the quantification of the indels', default=15)
-             parser.add_argument('--hdr_perfect_alignment_threshold',  type=float, help='Sequence homology %% for an HDR occurrence', default=98.0)
-             parser.add_argument('--ignore_substitutions',help='Ignore substitutions events for the quantification and visualization',action='store_true')
-             parser.add_argument('--ignore_insertions',help='Ignore insertions events for the quantification and visualization',action='store_true')
-             parser.add_argument('--ignore_deletions',help='Ignore deletions events for the quantification and visualization',action='store_true')
-             parser.add_argument('--needle_options_string',type=str,help='Override options for the Needle aligner',default='-gapopen=10 -gapextend=0.5  -awidth3=5000')
-             parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
-             parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
-             parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
-             parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
-             Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)
-             parser.add_argument('--offset_around_cut_to_plot',  type=int, help='Offset to use to summarize alleles around the cut site in the alleles table plot.', default=20)
-             parser.add_argument('--min_frequency_alleles_around_cut_to_plot', type=float, help='Minimum %% reads required to report an allele in the alleles table plot.', default=0.2)
-             parser.add_argument('--max_rows_alleles_around_cut_to_plot',  type=int, help='Maximum number of rows to report in the alleles table plot. ', default=50)
-             parser.add_argument('--debug', action='store_true', help='Print stack trace on error.')
-
-             args = parser.parse_args()
-
-             #check files
-             check_file(args.fastq_r1)
-             if args.fastq_r2:
-                     check_file(args.fastq_r2)
+             args=analysis_args
+             REQUANTIFY=df_alignments is not None
+
+             parsed_args=vars(args).copy()
+
+             #check files and programs, not needed if we start from the alignments of a previous run
+             if not REQUANTIFY:
+                 check_file(args.fastq_r1)
+                 if args.fastq_r2:
+                         check_file(args.fastq_r2)
+                 check_required_programs(args)
+
+             #check the optional library before the analysis
+             if args.write_hdf5:
+                 check_library('tables')
 
              #normalize name and remove not allowed characters
              if args.name:
@@ -903,44 +2320,17 @@ def main():
              len_amplicon=len(args.amplicon_seq)
 
              if args.guide_seq:
-                     cut_points=[]
-                     sgRNA_intervals=[]
-                     offset_plots=[]
-                     sgRNA_sequences=[]
-
-
                      args.guide_seq=args.guide_seq.strip().upper()
 
-                     for current_guide_seq in args.guide_seq.split(','):
-
-                         if current_guide_seq in args.amplicon_seq:
-                            offset_plots.append(1)
-                         else:
-                            offset_plots.append(0)
-
-
-                         wrong_nt=find_wrong_nt(current_guide_seq)
-                         if wrong_nt:
-                            raise NTException('The sgRNA sequence contains wrong characters:%s'  % ' '.join(wrong_nt))
-
-                         offset_fw=args.cleavage_offset+len(current_guide_seq)-1
-                         offset_rc=(-args.cleavage_offset)-1
-                         cut_points+=[m.start() + offset_fw for m in re.finditer(current_guide_seq, args.amplicon_seq)]+[m.start() + offset_rc for m in re.finditer(reverse_complement(current_guide_seq), args.amplicon_seq)]
-                         sgRNA_intervals+=[(m.start(),m.start()+len(current_guide_seq)-1) for m in re.finditer(current_guide_seq, args.amplicon_seq)]+[(m.start(),m.start()+len(current_guide_seq)-1) for m in re.finditer(reverse_complement(current_guide_seq), args.amplicon_seq)]
-                         sgRNA_sequences.append(current_guide_seq)
-
-                     offset_plots=np.array(offset_plots)
-
-                     if not cut_points:
-                         raise SgRNASequenceException('The guide sequence/s provided is(are) not present in the amplicon sequence! \n\nPlease check your input!')
-                     else:
-                         info('Cut Points from guide seq:%s' % cut_points)
+                     cut_points,sgRNA_intervals,offset_plots,sgRNA_sequences,cut_point_sgRNAs=get_cut_points(args.guide_seq,args.amplicon_seq,args.cleavage_offset)
+                     info('Cut Points from guide seq:%s' % cut_points)
 
              else:
                      cut_points=[]
                      sgRNA_intervals=[]
                      offset_plots=np.array([])
                      sgRNA_sequences=[]
+                     cut_point_sgRNAs=[]
 
 
 
@@ -1065,424 +2455,269 @@ def main():
 
 
 
-             if args.split_paired_end:
-
-                if args.fastq_r2!='':
-                        raise Exception('The option --split_paired_end is available only when a single fastq file is specified!')
-                else:
-                        info('Splitting paired end single fastq file in two files...')
-                        args.fastq_r1,args.fastq_r2=split_paired_end_reads_single_file(args.fastq_r1,
-                                                                                    output_filename_r1=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r1.fastq.gz'),
-                                                                                    output_filename_r2=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_splitted_r2.fastq.gz'),)
-                        splitted_files_to_remove=[args.fastq_r1,args.fastq_r2]
-
-                        info('Done!')
-
-             if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
-                info('Filtering reads with average bp quality < %d and single bp quality < %d ...' % (args.min_average_read_quality,args.min_single_bp_quality))
-                if args.fastq_r2!='':
-                        args.fastq_r1,args.fastq_r2=filter_pe_fastq_by_qual(args.fastq_r1,
-                                                                         args.fastq_r2,
-                                                                         output_filename_r1=_jp(os.path.basename(args.fastq_r1.replace('.fastq','')).replace('.gz','')+'_filtered.fastq.gz'),
-                                                                         output_filename_r2=_jp(os.path.basename(args.fastq_r2.replace('.fastq','')).replace('.gz','')+'_filtered.fastq.gz'),
-                                                                         min_bp_quality=args.min_average_read_quality,
-                                                                         min_single_bp_quality=args.min_single_bp_quality,
-                                                                         )
-                else:
-                        args.fastq_r1=filter_se_fastq_by_qual(args.fastq_r1,
-                                                                   output_filename=_jp(os.path.basename(args.fastq_r1).replace('.fastq','').replace('.gz','')+'_filtered.fastq.gz'),
-                                                                   min_bp_quality=args.min_average_read_quality,
-                                                                   min_single_bp_quality=args.min_single_bp_quality,
-                                                                   )
-
+             if args.quick_estimate and not REQUANTIFY:
+                 if not cut_points:
+                     raise SgRNASequenceException('Please provide the sgRNA sequence (-g) to use --quick_estimate.')
 
+                 info('Estimating the editing without alignment...')
+                 N_READS,n_intact,n_disrupted=quick_editing_estimate(args.fastq_r1,args.fastq_r2,args.amplicon_seq,cut_points,
+                                                                     window=args.quick_estimate_window,anchor_size=args.quick_estimate_anchor_size)
 
-             if args.fastq_r2=='': #single end reads
+                 quick_estimate_data=[]
+                 for idx_cut,cut_p in enumerate(cut_points):
+                     n_with_anchors=n_intact[idx_cut]+n_disrupted[idx_cut]
+                     ci_low,ci_high=wilson_interval(n_disrupted[idx_cut],n_with_anchors)
+                     quick_estimate_data.append([cut_point_sgRNAs[idx_cut],cut_p,N_READS,n_with_anchors,n_intact[idx_cut],n_disrupted[idx_cut],
+                                                 100.0*n_disrupted[idx_cut]/n_with_anchors if n_with_anchors else np.nan,ci_low,ci_high])
+                     info('%s (cut point %d): %.2f%% disrupted (95%% CI %.2f-%.2f%%) in %d reads with the anchors.' % (cut_point_sgRNAs[idx_cut],cut_p,
+                                                                                                               quick_estimate_data[-1][6],ci_low,ci_high,n_with_anchors))
 
-                 #check if we need to trim
-                 if not args.trim_sequences:
-                     #create a symbolic link
-                     symlink_filename=_jp(os.path.basename(args.fastq_r1))
-                     force_symlink(os.path.abspath(args.fastq_r1),symlink_filename)
-                     output_forward_filename=symlink_filename
-                 else:
-                     output_forward_filename=_jp('reads.trimmed.fq.gz')
-                     #Trimming with trimmomatic
-                     cmd='java -jar %s SE -phred33 %s  %s %s >>%s 2>&1'\
-                     % (get_data('trimmomatic-0.33.jar'),args.fastq_r1,
-                        output_forward_filename,
-                        args.trimmomatic_options_string.replace('NexteraPE-PE.fa','TruSeq3-SE.fa'),
-                        log_filename)
-                     #print cmd
-                     TRIMMOMATIC_STATUS=sb.call(cmd,shell=True)
+                 pd.DataFrame(quick_estimate_data,columns=['sgRNA','Cut_point','Reads','Reads_with_anchors','Intact','Disrupted','%Disrupted','CI_95_low','CI_95_high'])\
+                 .to_csv(_jp('Quick_estimate.txt'),sep='\t',header=True,index=None,float_format='%.2f')
 
-                     if TRIMMOMATIC_STATUS:
-                             raise TrimmomaticException('TRIMMOMATIC failed to run, please check the log file.')
+                 info('All Done!')
+                 return CRISPRessoResult(OUTPUT_DIRECTORY)
 
+             if not REQUANTIFY:
+                 processed_output_filename,N_READS_INPUT,N_READS_AFTER_PREPROCESSING,preprocessing_files_to_remove=preprocess_reads(args,OUTPUT_DIRECTORY,log_filename,len_amplicon)
 
-                 processed_output_filename=output_forward_filename
+                 if args.umi_regex or args.umi_length:
+                         if args.umi_regex and args.umi_length:
+                             raise UMIException('Please specify only one of the options --umi_regex and --umi_length.')
 
-             else:#paired end reads case
+                         info('Collapsing the reads sharing the same UMI...')
+                         umi_consensus_filename=_jp('reads.umi_consensus.fastq.gz')
+                         N_READS_WITH_UMI,N_READS_IN_UMI_FAMILIES,umi_family_sizes=collapse_umi_families(processed_output_filename,umi_consensus_filename,OUTPUT_DIRECTORY,
+                                                                                                       umi_regex=args.umi_regex,umi_length=args.umi_length,
+                                                                                                       min_family_size=args.umi_min_family_size,
+                                                                                                       n_buckets=max(1,args.umi_n_buckets))
+                         info('Found %d molecules (UMI families) in %d reads with UMI.' % (len(umi_family_sizes),N_READS_WITH_UMI))
 
-                 if not args.trim_sequences:
-                     output_forward_paired_filename=args.fastq_r1
-                     output_reverse_paired_filename=args.fastq_r2
+                         processed_output_filename=umi_consensus_filename
+                         preprocessing_files_to_remove.append(umi_consensus_filename)
                  else:
-                     info('Trimming sequences with Trimmomatic...')
-                     output_forward_paired_filename=_jp('output_forward_paired.fq.gz')
-                     output_forward_unpaired_filename=_jp('output_forward_unpaired.fq.gz')
-                     output_reverse_paired_filename=_jp('output_reverse_paired.fq.gz')
-                     output_reverse_unpaired_filename=_jp('output_reverse_unpaired.fq.gz')
-
-                     #Trimming with trimmomatic
-                     cmd='java -jar %s PE -phred33 %s  %s %s  %s  %s  %s %s >>%s 2>&1'\
-                     % (get_data('trimmomatic-0.33.jar'),
-                             args.fastq_r1,args.fastq_r2,output_forward_paired_filename,
-                             output_forward_unpaired_filename,output_reverse_paired_filename,
-                             output_reverse_unpaired_filename,args.trimmomatic_options_string,log_filename)
-                     #print cmd
-                     TRIMMOMATIC_STATUS=sb.call(cmd,shell=True)
-                     if TRIMMOMATIC_STATUS:
-                             raise TrimmomaticException('TRIMMOMATIC failed to run, please check the log file.')
-
-                     info('Done!')
+                         umi_family_sizes=None
+
+                 info('Preparing files for the alignment...')
+                 #we align only the unique sequences, most of the reads of an amplicon experiment are identical
+                 #to write the reads of each class or the bam file the reads used are saved while they are loaded,
+                 #so their names and qualities are not kept in memory
+                 KEEP_READS=args.write_reads_by_class or args.write_bam
+                 reads=read_fastq(processed_output_filename)
+
+                 SUBSAMPLING=args.max_reads>0 or args.subsample_fraction<1
+                 if SUBSAMPLING:
+                         if not 0<args.subsample_fraction<=1:
+                             raise Exception('The subsample fraction must be greater than 0 and at most 1.')
+
+                         info('Subsampling the reads...')
+                         reads,N_READS_BEFORE_SUBSAMPLING=subsample_reads(reads,max_reads=args.max_reads,fraction=args.subsample_fraction,seed=args.subsample_seed)
+                         info('Selected %d of %d reads.' % (len(reads),N_READS_BEFORE_SUBSAMPLING))
+
+                 read_ids=[]
+                 read_seqs=[]
+                 if KEEP_READS:
+                         kept_reads_filename=_jp('Reads_used.fastq.gz')
+                         kept_reads_handle=gzip.open(kept_reads_filename,'w+',1)
+                 for read_id,read_seq,read_qual in reads:
+                         read_ids.append(read_id)
+                         read_seqs.append(read_seq)
+                         if KEEP_READS:
+                             kept_reads_handle.write('@%s\n%s\n+\n%s\n' % (read_id,read_seq,read_qual))
+                 del reads
+                 if KEEP_READS:
+                         kept_reads_handle.close()
+
+                 read_counts=Counter(read_seqs)
+                 unique_sequences=[seq for seq,count in read_counts.most_common()]
+                 info('Found %d unique sequences in %d reads.' % (len(unique_sequences),len(read_seqs)))
+
+                 N_READS_REJECTED_BY_PRESCREEN=0
+                 if args.prescreen_reads:
+                         if args.prescreen_kmer_size<2:
+                             raise Exception('The k-mer size for the prescreen must be at least 2.')
+
+                         info('Discarding the reads that cannot reach the minimum identity score...')
+                         alignment_prescreen=AlignmentPrescreen([args.amplicon_seq,args.expected_hdr_amplicon_seq] if args.expected_hdr_amplicon_seq else [args.amplicon_seq],
+                                                                k=args.prescreen_kmer_size)
+                         rejected_sequences=set([seq for seq in unique_sequences if not alignment_prescreen.can_align(seq,args.min_identity_score)])
+                         unique_sequences=[seq for seq in unique_sequences if seq not in rejected_sequences]
+                         N_READS_REJECTED_BY_PRESCREEN=sum([read_counts[seq] for seq in rejected_sequences])
+                         info('Discarded %d reads (%d unique sequences).' % (N_READS_REJECTED_BY_PRESCREEN,len(rejected_sequences)))
+
+                         if args.prescreen_write_rejected:
+                             with gzip.open(_jp('Reads_rejected_by_prescreen.fastq.gz'),'w+') as outfile:
+                                 for read_header,read_seq,read_qual in read_fastq(processed_output_filename,full_header=True):
+                                     if read_seq in rejected_sequences:
+                                         outfile.write('@%s\n%s\n+\n%s\n' % (read_header,read_seq,read_qual))
+
+                         del rejected_sequences
+
+                 if args.alignment_cache_dir:
+                         alignment_cache=AlignmentCache(args.alignment_cache_dir,args.amplicon_seq,args.expected_hdr_amplicon_seq,
+                                                        args.needle_options_string,args.min_identity_score,
+                                                        max_size=int(args.alignment_cache_max_size*1024*1024))
+                 else:
+                         alignment_cache=None
+                 info('Done!')
 
+                 window_idxs=get_include_idxs(cut_points,len_amplicon,args.window_around_sgrna,args.exclude_bp_from_left,args.exclude_bp_from_right)
 
-                 info('Estimating average read length...')
-                 if get_n_reads_fastq(output_forward_paired_filename):
-                     avg_read_length=get_avg_read_lenght_fastq(output_forward_paired_filename)
-                     std_fragment_length=int(len_amplicon*0.1)
+                 def align_unique_sequences(sequences,alignment_database_id):
+                         if args.cluster_near_duplicates:
+                                 return align_sequences_clustering_near_duplicates(sequences,args,_jp,alignment_database_id,log_filename,window_idxs,alignment_cache)
+                         else:
+                                 return align_sequences(sequences,args,_jp,alignment_database_id,log_filename,alignment_cache)
+
+                 info('Aligning sequences...')
+                 #Alignment here
+                 ADAPTIVE_STOPPING=args.adaptive_tolerance>0
+                 if ADAPTIVE_STOPPING:
+                         info('Aligning the reads in batches of %d until the estimates converge...' % args.adaptive_batch_size)
+                         include_idxs=window_idxs
+                         include_idxs_per_cut=[get_include_idxs([cut_p],len_amplicon,args.window_around_sgrna,args.exclude_bp_from_left,args.exclude_bp_from_right) for cut_p in cut_points]
+
+                         alignments,needle_output_filenames,alignment_intermediate_filenames,used_read_idxs=align_until_convergence(read_seqs,
+                                                                                    lambda sequences,idx_batch: align_unique_sequences(sequences,'%s_batch_%d' % (database_id,idx_batch)),
+                                                                                    cut_points,set(unique_sequences),batch_size=max(1,args.adaptive_batch_size),
+                                                                                    tolerance=args.adaptive_tolerance,seed=args.subsample_seed)
+
+                         N_READS_BEFORE_ADAPTIVE_STOPPING=len(read_seqs)
+                         read_ids=[read_ids[idx_read] for idx_read in used_read_idxs]
+                         read_seqs=[read_seqs[idx_read] for idx_read in used_read_idxs]
+                         read_counts=Counter(read_seqs)
+                         unique_sequences=[seq for seq,count in read_counts.most_common() if seq in alignments]
+
+                         if args.prescreen_reads:
+                             N_READS_REJECTED_BY_PRESCREEN=sum([count for seq,count in read_counts.iteritems() if seq not in alignments])
+                         del used_read_idxs
+                         info('Used %d of %d reads.' % (len(read_seqs),N_READS_BEFORE_ADAPTIVE_STOPPING))
                  else:
-                    raise NoReadsAfterQualityFiltering('No reads survived the average or single bp quality filtering.')
-
-                 #Merging with Flash
-                 info('Merging paired sequences with Flash...')
-                 cmd='flash %s %s --allow-outies --max-overlap %d --min-overlap %d -f %d -r %d -s %d  -z -d %s >>%s 2>&1' %\
-                 (output_forward_paired_filename,
-                  output_reverse_paired_filename,
-                  args.max_paired_end_reads_overlap,
-                  args.min_paired_end_reads_overlap,
-                  len_amplicon,avg_read_length,
-                  std_fragment_length,
-                  OUTPUT_DIRECTORY,log_filename)
-
-                 FLASH_STATUS=sb.call(cmd,shell=True)
-                 if FLASH_STATUS:
-                     raise FlashException('Flash failed to run, please check the log file.')
+                         alignments,needle_output_filenames,alignment_intermediate_filenames=align_unique_sequences(unique_sequences,database_id)
 
+                 if alignment_cache:
+                         alignment_cache.close()
                  info('Done!')
 
-                 flash_hist_filename=_jp('out.hist')
-                 flash_histogram_filename=_jp('out.histogram')
-                 flash_not_combined_1_filename=_jp('out.notCombined_1.fastq.gz')
-                 flash_not_combined_2_filename=_jp('out.notCombined_2.fastq.gz')
-
-                 processed_output_filename=_jp('out.extendedFrags.fastq.gz')
+                 N_TOTAL_ALSO_UNALIGNED=len(read_ids)*1.0
 
-             #count reads
-             N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
-             N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
-             if N_READS_AFTER_PREPROCESSING == 0:
-                 raise NoReadsAfterQualityFiltering('No reads in input or no reads survived the average or single bp quality filtering.')
+                 #back from the unique sequences to the reads, filtering out not aligned reads
+                 not_aligned_record=('NA',0.0,None,'','','','')
+                 needle_alignment_data=[]
+                 n_umi_reads=[]
+                 umi_family_sizes_by_seq=defaultdict(list)
+                 for read_id,read_seq in itertools.izip(read_ids,read_seqs):
+                         orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq=alignments.get(read_seq,not_aligned_record)
 
-             info('Preparing files for the alignment...')
-             #parsing flash output and prepare the files for alignment
+                         if orientation=='NA':
+                             continue
 
+                         if umi_family_sizes is not None:
+                             n_umi_reads.append(umi_family_sizes[read_id])
+                             umi_family_sizes_by_seq[read_seq].append(umi_family_sizes[read_id])
 
-             database_fasta_filename=_jp('%s_database.fa' % database_id)
-             needle_output_filename=_jp('needle_output_%s.txt.gz' % database_id)
+                         #fix for duplicates when rc alignment
+                         if orientation=='RC':
+                             read_id='_'.join([read_id,'RC'])
 
+                         needle_alignment_data.append([read_id,score_ref,length,ref_seq,align_str,align_seq,score_repaired])
 
-             #write .fa file only for amplicon the rest we pipe trough awk on the fly!
+                 del read_ids,read_seqs
 
-             with open(database_fasta_filename,'w+') as outfile:
-                     outfile.write('>%s\n%s\n' % (database_id,args.amplicon_seq))
-
-             if args.expected_hdr_amplicon_seq:
-                     database_repair_fasta_filename=_jp('%s_database_repair.fa' % database_id)
-                     needle_output_repair_filename=_jp('needle_output_repair_%s.txt.gz' % database_id)
+                 df_needle_alignment=pd.DataFrame(needle_alignment_data,columns=['ID','score_ref','length','ref_seq','align_str','align_seq','score_repaired']).set_index('ID')
+                 del needle_alignment_data
 
-                     with open(database_repair_fasta_filename,'w+') as outfile:
-                             outfile.write('>%s\n%s\n' % (database_id,args.expected_hdr_amplicon_seq))
-             info('Done!')
+                 if umi_family_sizes is not None:
+                     #number of reads supporting each molecule
+                     df_needle_alignment['n_umi_reads']=n_umi_reads
+                 del n_umi_reads
 
-             def parse_needle_output(needle_filename,name='seq',just_score=False):
-                     needle_data=[]
+                 #save a compact version of the alignments (one row for each unique sequence) for CRISPResso requantify
+                 alignments_data=[]
+                 for idx_seq,seq in enumerate(unique_sequences):
+                         orientation,score_ref,score_repaired,length,ref_seq,align_str,align_seq=alignments.get(seq,not_aligned_record)
+                         if orientation!='NA':
+                             alignments_data.append(['u%d' % idx_seq,orientation,read_counts[seq],score_ref,score_repaired,length,ref_seq,align_str,align_seq])
 
-                     try:
-                         needle_infile=gzip.open(needle_filename)
+                 df_alignments=pd.DataFrame(alignments_data,columns=['ID','orientation','n_reads','score_ref','score_repaired','length','ref_seq','align_str','align_seq']).set_index('ID')
 
-                         line=needle_infile.readline()
-                         while line:
+                 if umi_family_sizes is not None:
+                     #the size of the family of each molecule, in the order used by expand_alignments_to_reads
+                     df_alignments['umi_family_sizes']=[','.join(map(str,umi_family_sizes_by_seq[seq])) for seq in unique_sequences if seq in umi_family_sizes_by_seq]
 
-                                 while line and ('# Aligned_sequences' not  in line):
-                                         line=needle_infile.readline()
+                 del alignments_data,alignments,read_counts,umi_family_sizes_by_seq
 
-                                 if line:
-                                         #print line
-                                         needle_infile.readline() #skip another line
+                 run_info={'version':__version__,
+                           'args':parsed_args,
+                           'database_id':database_id,
+                           'n_reads_input':N_READS_INPUT,
+                           'n_reads_after_preprocessing':N_READS_AFTER_PREPROCESSING,
+                           'n_total_also_unaligned':N_TOTAL_ALSO_UNALIGNED}
 
-                                         line=needle_infile.readline()
-                                         id_seq=line.split()[-1].replace('_',':')
+                 if args.prescreen_reads:
+                     run_info['n_reads_rejected_by_prescreen']=N_READS_REJECTED_BY_PRESCREEN
 
-                                         for _ in range(5):
-                                                 needle_infile.readline()
+                 if ADAPTIVE_STOPPING:
+                     run_info['n_reads_before_subsampling']=N_READS_BEFORE_SUBSAMPLING if SUBSAMPLING else N_READS_BEFORE_ADAPTIVE_STOPPING
+                     run_info['n_reads_before_adaptive_stopping']=N_READS_BEFORE_ADAPTIVE_STOPPING
+                 elif SUBSAMPLING:
+                     run_info['n_reads_before_subsampling']=N_READS_BEFORE_SUBSAMPLING
 
-                                         line=needle_infile.readline()
+                 if umi_family_sizes is not None:
+                     run_info['n_reads_with_umi']=N_READS_WITH_UMI
+                     run_info['n_reads_in_umi_families']=N_READS_IN_UMI_FAMILIES
 
-                                         identity_seq=eval(line.strip().split(' ')[-1].replace('%','').replace(')','').replace('(',''))
+             else:
+                 #we start from the alignments of a previous run
+                 N_READS_INPUT=run_info['n_reads_input']
+                 N_READS_AFTER_PREPROCESSING=run_info['n_reads_after_preprocessing']
+                 N_TOTAL_ALSO_UNALIGNED=run_info['n_total_also_unaligned']
 
-                                         if just_score:
-                                                 needle_data.append([id_seq,identity_seq])
-                                         else:
-                                                 for _ in range(7):
-                                                         needle_infile.readline()
+                 run_info['args']=parsed_args
+                 run_info['database_id']=database_id
 
-                                                 line=needle_infile.readline()
-                                                 aln_ref_seq=line.split()[2]
+                 if sweep_parameter_sets:
+                     #for the sweep we classify each unique sequence once and we weight it by the number of reads
+                     df_needle_alignment=df_alignments[['n_reads','score_ref','length','ref_seq','align_str','align_seq','score_repaired']].copy()
+                 else:
+                     df_needle_alignment=expand_alignments_to_reads(df_alignments)
 
+             save_crispresso_alignments(OUTPUT_DIRECTORY,df_alignments,run_info)
 
-                                                 aln_str=needle_infile.readline()[21:].rstrip('\n')
-                                                 line=needle_infile.readline()
-                                                 aln_query_seq=line.split()[2]
-                                                 aln_query_len=line.split()[3]
-                                                 needle_data.append([id_seq,identity_seq,aln_query_len,aln_ref_seq,aln_str,aln_query_seq])
+             #check for duplicates
+             try:
+                assert df_needle_alignment.shape[0]== df_needle_alignment.index.unique().shape[0]
+             except:
+                raise DuplicateSequenceIdException('The .fastq file/s contain/s duplicate sequence IDs')
 
-                         if just_score:
-                                 needle_infile.close()
-                                 return pd.DataFrame(needle_data,columns=['ID','score_'+name]).set_index('ID')
-                         else:
-                                 needle_infile.close()
-                                 return pd.DataFrame(needle_data,columns=['ID','score_'+name,'length','ref_seq','align_str','align_seq']).set_index('ID')
-                     except:
-                         raise NeedleException('Failed to parse the output of needle!')
 
+             #Initializations
+             info('Quantifying indels/substitutions...')
 
+             N_TOTAL=df_needle_alignment.shape[0]*1.0
 
-             info('Aligning sequences...')
-             #Alignment here
+             if N_TOTAL==0:
+                 raise NoReadsAlignedException('Zero sequences aligned, please check your amplicon sequence')
+                 error('Zero sequences aligned')
 
-             cmd=(('cat %s |'% processed_output_filename )+\
-             (' gunzip |' if processed_output_filename.endswith('.gz') else ' '))+\
-             r''' awk 'NR % 4 == 1 {print ">" $0} NR % 4 ==2 {print $0}' '''+\
-             " | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-             %(database_fasta_filename,args.needle_options_string,log_filename,needle_output_filename)
+             if 'N' in args.amplicon_seq:
+                 info('Your amplicon sequence contains one or more N, excluding these bp for the indel quantification...')
 
-             NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-             if NEEDLE_OUTPUT:
-                     raise NeedleException('Needle failed to run, please check the log file.')
+             df_needle_alignment=prepare_alignments_for_quantification(df_needle_alignment,cut_points)
 
+             if sweep_parameter_sets:
+                 info('Quantifying %d parameter sets...' % len(sweep_parameter_sets))
+                 df_sweep=requantify_sweep(df_needle_alignment,sweep_parameter_names,sweep_parameter_sets,cut_points,cut_point_sgRNAs)
+                 df_sweep.to_csv(_jp('Requantification_sweep.txt'),sep='\t',index=False,float_format='%.2f')
+                 info('Done!')
 
-             #If we have a donor sequence we just compare the fq in the two cases and see which one alignes better
-             if args.expected_hdr_amplicon_seq:
+                 info('All Done!')
+                 return CRISPRessoResult(OUTPUT_DIRECTORY)
 
-                     cmd_repair=(('cat %s |'% processed_output_filename )+\
-                     (' gunzip |' if processed_output_filename.endswith('.gz') else ' '))+\
-                     r''' awk 'NR % 4 == 1 {print ">" $0} NR % 4 ==2 {print $0}' '''+\
-                     " | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                     %(database_repair_fasta_filename,args.needle_options_string,log_filename,needle_output_repair_filename)
-                     NEEDLE_OUTPUT=sb.call(cmd_repair,shell=True)
 
-                     if NEEDLE_OUTPUT:
-                             raise NeedleException('Needle failed to run, please check the log file.')
-                     info('Done!')
-
-             #merge the flow
-             if args.expected_hdr_amplicon_seq:
-                    df_database=parse_needle_output(needle_output_filename,'ref')
-                    df_database_repair=parse_needle_output(needle_output_repair_filename,'repaired',just_score=True)
-
-                    df_database_and_repair=df_database.join(df_database_repair)
-
-                    del df_database
-                    del df_database_repair
-
-                    #filter bad alignments
-
-                    N_TOTAL_ALSO_UNALIGNED=df_database_and_repair.shape[0]*1.0
-
-                    #find reads that failed to align and try on the reverse complement
-                    sr_not_aligned=df_database_and_repair.ix[(df_database_and_repair.score_ref <args.min_identity_score)\
-                                      & (df_database_and_repair.score_ref< args.min_identity_score)]\
-                                     .align_seq.apply(lambda x: x.replace('_',''))
-
-                    #filter out not aligned reads
-                    df_database_and_repair=\
-                    df_database_and_repair.ix[\
-                        (df_database_and_repair.score_ref>args.min_identity_score)\
-                        |(df_database_and_repair.score_repaired>args.min_identity_score)]
-
-                    df_database_and_repair['score_diff']=df_database_and_repair.score_ref-df_database_and_repair.score_repaired
-
-                    df_needle_alignment=df_database_and_repair
-
-                    del df_database_and_repair
-
-             else:
-                    df_needle_alignment=parse_needle_output(needle_output_filename,'ref')
-                    N_TOTAL_ALSO_UNALIGNED=df_needle_alignment.shape[0]*1.0
-
-                    sr_not_aligned=df_needle_alignment.ix[(df_needle_alignment.score_ref <args.min_identity_score)]\
-                                     .align_seq.apply(lambda x: x.replace('_',''))
-                    #filter out not aligned reads
-                    df_needle_alignment=df_needle_alignment.ix[df_needle_alignment.score_ref>args.min_identity_score]
-
-
-
-             #check if the not aligned reads are in the reverse complement
-             if sr_not_aligned.count():
-                 #write fastq_not_aligned
-                 fasta_not_aligned_filename=_jp('not_aligned_amplicon_forward.fa.gz')
-
-                 outfile=gzip.open(fasta_not_aligned_filename,'w+')
-                 for x in sr_not_aligned.iteritems():
-                    outfile.write('>%s\n%s\n' % (x[0],x[1]))
-
-                 #write reverse complement of ampl and expected amplicon
-                 database_rc_fasta_filename=_jp('%s_database_rc.fa' % database_id)
-                 needle_output_rc_filename=_jp('needle_output_rc_%s.txt.gz' % database_id)
-
-                 info('Align sequences to reverse complement of the amplicon...')
-
-                 with open(database_rc_fasta_filename,'w+') as outfile:
-                         outfile.write('>%s\n%s\n' % (database_id,reverse_complement(args.amplicon_seq)))
-
-                 if args.expected_hdr_amplicon_seq:
-                         database_repair_rc_fasta_filename=_jp('%s_database_repair_rc.fa' % database_id)
-                         needle_output_repair_rc_filename=_jp('needle_output_repair_rc_%s.txt.gz' % database_id)
-
-                         with open(database_repair_rc_fasta_filename,'w+') as outfile:
-                                 outfile.write('>%s\n%s\n' % (database_id,reverse_complement(args.expected_hdr_amplicon_seq)))
-                 info('Done!')
-
-
-                 #Now we do the alignment
-                 cmd="zcat < %s | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                 %(fasta_not_aligned_filename,database_rc_fasta_filename,args.needle_options_string,log_filename,needle_output_rc_filename)
-
-                 NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-                 if NEEDLE_OUTPUT:
-                         raise NeedleException('Needle failed to run, please check the log file.')
-
-                 if args.expected_hdr_amplicon_seq:
-                    cmd="zcat < %s | sed 's/:/_/g' | needle -asequence=%s -bsequence=/dev/stdin -outfile=/dev/stdout %s 2>> %s  | gzip >%s"\
-                    %(fasta_not_aligned_filename,database_repair_rc_fasta_filename,args.needle_options_string,log_filename,needle_output_repair_rc_filename)
-
-                    NEEDLE_OUTPUT=sb.call(cmd,shell=True)
-                    if NEEDLE_OUTPUT:
-                         raise NeedleException('Needle failed to run, please check the log file.')
-
-
-                 #merge the flow rev
-                 if args.expected_hdr_amplicon_seq:
-                            df_database_rc=parse_needle_output(needle_output_rc_filename,'ref')
-                            df_database_repair_rc=parse_needle_output(needle_output_repair_rc_filename,'repaired',just_score=True)
-
-                            df_database_and_repair_rc=df_database_rc.join(df_database_repair_rc)
-
-                            del df_database_rc
-                            del df_database_repair_rc
-
-                            #filter bad alignments also to rc
-
-
-                            df_database_and_repair_rc=\
-                            df_database_and_repair_rc.ix[\
-                                (df_database_and_repair_rc.score_ref>args.min_identity_score)\
-                                |(df_database_and_repair_rc.score_repaired>args.min_identity_score)]
-
-                            df_database_and_repair_rc['score_diff']=df_database_and_repair_rc.score_ref-df_database_and_repair_rc.score_repaired
-
-                            df_needle_alignment_rc=df_database_and_repair_rc
-
-                            del df_database_and_repair_rc
-
-                 else:
-                            df_needle_alignment_rc=parse_needle_output(needle_output_rc_filename,'ref')
-
-                            #filter out not aligned reads
-                            df_needle_alignment_rc=df_needle_alignment_rc.ix[df_needle_alignment_rc.score_ref>args.min_identity_score]
-
-                 #reverse complement and invert the align string so we have everything in the positive strand
-                 df_needle_alignment_rc['ref_seq']=df_needle_alignment_rc['ref_seq'].apply(reverse_complement)
-                 df_needle_alignment_rc['align_seq']=df_needle_alignment_rc['align_seq'].apply(reverse_complement)
-                 df_needle_alignment_rc['align_str']=df_needle_alignment_rc['align_str'].apply(lambda x: x[::-1])
-
-
-                 #fix for duplicates when rc alignment
-                 df_needle_alignment_rc.index=map(lambda x:'_'.join([x,'RC']),df_needle_alignment_rc.index)
-
-
-                 #append the RC reads to the aligned reads in the original orientation
-                 df_needle_alignment=df_needle_alignment.append(df_needle_alignment_rc)
-
-                 del df_needle_alignment_rc
-
-
-             #check for duplicates
-             try:
-                assert df_needle_alignment.shape[0]== df_needle_alignment.index.unique().shape[0]
-             except:
-                raise DuplicateSequenceIdException('The .fastq file/s contain/s duplicate sequence IDs')
-
-
-             #Initializations
-             info('Quantifying indels/substitutions...')
-             df_needle_alignment['UNMODIFIED']=(df_needle_alignment.score_ref==100)
-
-             #the rest we have to look one by one to potentially exclude regions
-             df_needle_alignment['MIXED']=False
-             df_needle_alignment['HDR']=False
-             df_needle_alignment['NHEJ']=False
-
-             df_needle_alignment['n_mutated']=0
-             df_needle_alignment['n_inserted']=0
-             df_needle_alignment['n_deleted']=0
-
-             N_TOTAL=df_needle_alignment.shape[0]*1.0
-
-             if N_TOTAL==0:
-                 raise NoReadsAlignedException('Zero sequences aligned, please check your amplicon sequence')
-                 error('Zero sequences aligned')
-
-             #remove the mutations in bp equal to 'N'
-             if 'N' in args.amplicon_seq:
-
-                 info('Your amplicon sequence contains one or more N, excluding these bp for the indel quantification...')
-
-                 def ignore_N_in_alignment(row):
-                     row['align_str']=''.join([('|' if  (row['ref_seq'][idx]=='N') else c ) for idx,c in enumerate(row['align_str'])])
-                     if len(set(row['align_str']))==1:
-                         row['UNMODIFIED']=True
-
-                     return row
-
-                 df_needle_alignment=df_needle_alignment.apply(ignore_N_in_alignment,axis=1)
-
-
-
-             #####QUANTIFICATION START
-             def compute_ref_positions(ref_seq):
-                     pos_idxs=[]
-                     idx=0
-                     for c in ref_seq:
-                             if c in set(['A','T','C','G','N']):
-                                     pos_idxs.append(idx)
-                                     idx+=1
-                             else:
-                                     if idx==0:
-                                             pos_idxs.append(-1)
-                                     else:
-                                             pos_idxs.append(-idx)
-                     return np.array(pos_idxs)
-
-             #compute positions relative to alignmnet
-             df_needle_alignment['ref_positions']=df_needle_alignment['ref_seq'].apply(compute_ref_positions)
-
-
-             #INITIALIZATIONS
-             re_find_indels=re.compile("(-*-)")
-             re_find_substitutions=re.compile("(\.*\.)")
+             #INITIALIZATIONS
+             re_find_indels=re.compile("(-*-)")
+             re_find_substitutions=re.compile("(\.*\.)")
 
              effect_vector_insertion=np.zeros(len_amplicon)
              effect_vector_deletion=np.zeros(len_amplicon)
@@ -1507,33 +2742,15 @@ def main():
              avg_vector_del_all=np.zeros(len_amplicon)
              avg_vector_ins_all=np.zeros(len_amplicon)
 
-             #look around the sgRNA(s) only?
-             if cut_points and args.window_around_sgrna>0:
-                include_idxs=[]
-                half_window=max(1,args.window_around_sgrna/2)
-                for cut_p in cut_points:
-                    st=max(0,cut_p-half_window+1)
-                    en=min(len(args.amplicon_seq)-1,cut_p+half_window+1)
-                    include_idxs.append(range(st,en))
-             else:
-                include_idxs=range(len(args.amplicon_seq))
-
-             exclude_idxs=[]
-
-             if args.exclude_bp_from_left:
-                exclude_idxs+=range(args.exclude_bp_from_left)
+             effect_vector_insertion_per_cut=np.zeros((len(cut_points),len_amplicon))
+             effect_vector_deletion_per_cut=np.zeros((len(cut_points),len_amplicon))
+             effect_vector_mutation_per_cut=np.zeros((len(cut_points),len_amplicon))
 
-             if args.exclude_bp_from_right:
-                exclude_idxs+=range(len_amplicon)[-args.exclude_bp_from_right:]
-
-
-
-
-             #flatten the arrays to avoid errors with old numpy library
-             include_idxs=np.ravel(include_idxs)
-             exclude_idxs=np.ravel(exclude_idxs)
+             #look around the sgRNA(s) only?
+             include_idxs=get_include_idxs(cut_points,len_amplicon,args.window_around_sgrna,args.exclude_bp_from_left,args.exclude_bp_from_right)
 
-             include_idxs=set(np.setdiff1d(include_idxs,exclude_idxs))
+             #and the window of each cut point for the quantification of each sgRNA
+             include_idxs_per_cut=[get_include_idxs([cut_p],len_amplicon,args.window_around_sgrna,args.exclude_bp_from_left,args.exclude_bp_from_right) for cut_p in cut_points]
 
 
              #handy generator to split in chunks the dataframe, np.split_array is slow!
@@ -1554,7 +2771,8 @@ def main():
                      effect_vector_mutation_mixed_chunk,effect_vector_insertion_hdr_chunk,effect_vector_deletion_hdr_chunk,effect_vector_mutation_hdr_chunk,\
                      effect_vector_insertion_noncoding_chunk,effect_vector_deletion_noncoding_chunk,effect_vector_mutation_noncoding_chunk,hist_inframe_chunk,\
                      hist_frameshift_chunk,avg_vector_del_all_chunk,avg_vector_ins_all_chunk,MODIFIED_FRAMESHIFT_chunk,MODIFIED_NON_FRAMESHIFT_chunk,NON_MODIFIED_NON_FRAMESHIFT_chunk,\
-                     SPLICING_SITES_MODIFIED_chunk=result
+                     SPLICING_SITES_MODIFIED_chunk,effect_vector_insertion_per_cut_chunk,effect_vector_deletion_per_cut_chunk,\
+                     effect_vector_mutation_per_cut_chunk=result
 
                      chunks_computed.append(df_needle_alignment_chunk)
                      effect_vector_insertion+=effect_vector_insertion_chunk
@@ -1578,6 +2796,9 @@ def main():
                      MODIFIED_NON_FRAMESHIFT+=MODIFIED_NON_FRAMESHIFT_chunk
                      NON_MODIFIED_NON_FRAMESHIFT+=NON_MODIFIED_NON_FRAMESHIFT_chunk
                      SPLICING_SITES_MODIFIED+=SPLICING_SITES_MODIFIED_chunk
+                     effect_vector_insertion_per_cut+=effect_vector_insertion_per_cut_chunk
+                     effect_vector_deletion_per_cut+=effect_vector_deletion_per_cut_chunk
+                     effect_vector_mutation_per_cut+=effect_vector_mutation_per_cut_chunk
 
                 pool.close()
                 pool.join()
@@ -1594,7 +2815,9 @@ def main():
                  effect_vector_deletion_noncoding,effect_vector_mutation_noncoding,\
                  hist_inframe,hist_frameshift,avg_vector_del_all,\
                  avg_vector_ins_all,MODIFIED_FRAMESHIFT,MODIFIED_NON_FRAMESHIFT,\
-                 NON_MODIFIED_NON_FRAMESHIFT,SPLICING_SITES_MODIFIED= process_df_chunk(df_needle_alignment)
+                 NON_MODIFIED_NON_FRAMESHIFT,SPLICING_SITES_MODIFIED,\
+                 effect_vector_insertion_per_cut,effect_vector_deletion_per_cut,\
+                 effect_vector_mutation_per_cut= process_df_chunk(df_needle_alignment)
 
 
              N_MODIFIED=df_needle_alignment['NHEJ'].sum()
@@ -1602,6 +2825,29 @@ def main():
              N_MIXED_HDR_NHEJ=df_needle_alignment['MIXED'].sum()
              N_REPAIRED=df_needle_alignment['HDR'].sum()
 
+             if args.write_reads_by_class:
+                 if REQUANTIFY:
+                     warn('The reads are not available when requantifying, the option --write_reads_by_class is ignored.')
+                 else:
+                     info('Writing the reads of each class...')
+                     write_reads_by_class(df_needle_alignment,kept_reads_filename,_jp('Reads_'),args.reads_by_class_format,
+                                          ['UNMODIFIED','NHEJ','HDR','MIXED']+(['FRAMESHIFT','INFRAME'] if PERFORM_FRAMESHIFT_ANALYSIS else []))
+
+             if args.write_bam:
+                 info('Writing the alignments in a bam file...')
+                 check_program('samtools')
+
+                 with open(_jp('Amplicon.fa'),'w+') as outfile:
+                     outfile.write('>%s\n%s\n' % (database_id,args.amplicon_seq))
+
+                 #when requantifying the reads are not available, the bam file has the sequences but not the qualities
+                 write_alignments_bam(df_needle_alignment,_jp('CRISPResso_alignments.bam'),database_id,args.amplicon_seq,
+                                      reads_filename=None if REQUANTIFY else kept_reads_filename,
+                                      classes=['UNMODIFIED','NHEJ','HDR','MIXED']+(['FRAMESHIFT','INFRAME'] if PERFORM_FRAMESHIFT_ANALYSIS else []))
+
+             if not REQUANTIFY and KEEP_READS:
+                 os.remove(kept_reads_filename)
+
              #disable known division warning
              with np.errstate(divide='ignore',invalid='ignore'):
 
@@ -1657,6 +2903,11 @@ def main():
 
 
              info('Making Plots...')
+             #the figures are drawn at the end from the plot data collected in figure_jobs
+             figure_jobs=[]
+             def add_figure_job(figure_id,plot_function_name,output_filename,**plot_kwargs):
+                 figure_jobs.append((figure_id,plot_function_name,plot_kwargs,output_filename))
+
              #plot effective length
              if args.guide_seq:
                  min_cut=min(cut_points)
@@ -1672,130 +2923,16 @@ def main():
              hlengths=hlengths[:-1]
              center_index=np.nonzero(hlengths==0)[0][0]
 
-             fig=plt.figure(figsize=(8.3,8))
-
-             plt.bar(0,hdensity[center_index],color='red',linewidth=0)
-             #plt.hold(True)
-             barlist=plt.bar(hlengths,hdensity,align='center',linewidth=0)
-             barlist[center_index].set_color('r')
-             plt.xlim([xmin,xmax])
-             plt.ylabel('Sequences (no.)')
-             plt.xlabel('Indel size (bp)')
-             plt.ylim([0,hdensity.max()*1.2])
-             plt.title('Indel size distribution')
-             lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
-             #lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(3)
-             lgd.legendHandles[1].set_height(3)
-             plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('1a.Indel_size_distribution_n_sequences.png'),bbox_inches='tight')
-
-
-             plt.figure(figsize=(8.3,8))
-             plt.bar(0,hdensity[center_index]/(float(hdensity.sum()))*100.0,color='red',linewidth=0)
-             #plt.hold(True)
-             barlist=plt.bar(hlengths,hdensity/(float(hdensity.sum()))*100.0,align='center',linewidth=0)
-             barlist[center_index].set_color('r')
-             plt.xlim([xmin,xmax])
-             plt.title('Indel size distribution')
-             plt.ylabel('Sequences (%)')
-             plt.xlabel('Indel size (bp)')
-             #lgd=plt.legend(['No indel','Indel'])
-             lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(3)
-             lgd.legendHandles[1].set_height(3)
-
-             plt.savefig(_jp('1b.Indel_size_distribution_percentage.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('1b.Indel_size_distribution_percentage.png'),bbox_inches='tight')
-
+             add_figure_job('1a','plot_indel_size_distribution','1a.Indel_size_distribution_n_sequences',
+                            hdensity=hdensity,hlengths=hlengths,center_index=center_index,xmin=xmin,xmax=xmax,percentage=False)
+             add_figure_job('1b','plot_indel_size_distribution','1b.Indel_size_distribution_percentage',
+                            hdensity=hdensity,hlengths=hlengths,center_index=center_index,xmin=xmin,xmax=xmax,percentage=True)
 
              ####PIE CHARTS FOR HDR/NHEJ/MIXED/EVENTS###
-
-             if args.expected_hdr_amplicon_seq:
-
-
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([N_UNMODIFIED,N_MIXED_HDR_NHEJ,N_MODIFIED,N_REPAIRED],\
-                                                                   labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
-                                                                           'Mixed HDR-NHEJ\n(%d reads)' %N_MIXED_HDR_NHEJ,
-                                                                           'NHEJ\n(%d reads)' % N_MODIFIED, \
-                                                                           'HDR\n(%d reads)' %N_REPAIRED,
-                                                                           ],\
-                                                                   explode=(0,0,0,0),\
-                                                                   colors=[(1,0,0,0.2),(0,1,1,0.2),(0,0,1,0.2),(0,1,0,0.2)],autopct='%1.1f%%')
-
-                 if cut_points or args.donor_seq:
-                    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                    #plt.hold(True)
-
-                    if args.donor_seq:
-                        ax2.plot(core_donor_seq_st_en,[0,0],'-',lw=10,c=(0,1,0,0.5),label='Donor Sequence')
-
-                    if cut_points:
-                        ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=24,label='Predicted Cas9 cleavage site/s')
-
-                    for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                         if idx==0:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA')
-                         else:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_')
-
-                    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
-                    plt.xlim(0,len_amplicon)
-                    plt.axis('off')
-
-
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('2.Unmodified_NHEJ_HDR_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
-             else:
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100],\
-                                                   labels=['Unmodified\n(%d reads)' %N_UNMODIFIED,\
-                                                           'NHEJ\n(%d reads)' % N_MODIFIED],\
-                                                   explode=(0,0),colors=[(1,0,0,0.2),(0,0,1,0.2)],autopct='%1.1f%%')
-
-                 if cut_points:
-                    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                    #plt.hold(True)
-
-
-                    for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                         if idx==0:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                         else:
-                            ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                    ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=12,label='Predicted Cas9 cleavage site/s')
-                    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1,prop={'size':'large'})
-                    plt.xlim(0,len_amplicon)
-                    plt.axis('off')
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('2.Unmodified_NHEJ_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
-
-             ###############################################################################################################################################
-
-
-             ###############################################################################################################################################
+             add_figure_job('2','plot_editing_pie_chart','2.Unmodified_NHEJ_HDR_pie_chart' if args.expected_hdr_amplicon_seq else '2.Unmodified_NHEJ_pie_chart',
+                            n_unmodified=N_UNMODIFIED,n_modified=N_MODIFIED,n_repaired=N_REPAIRED,n_mixed_hdr_nhej=N_MIXED_HDR_NHEJ,n_total=N_TOTAL,
+                            expected_hdr=bool(args.expected_hdr_amplicon_seq),len_amplicon=len_amplicon,cut_points=cut_points,offset_plots=offset_plots,
+                            sgRNA_intervals=sgRNA_intervals,donor_interval=core_donor_seq_st_en if args.donor_seq else None)
 
              #(3) a graph of frequency of deletions and insertions of various sizes (deletions could be consider as negative numbers and insertions as positive);
 
@@ -1812,488 +2949,91 @@ def main():
              range_ins=calculate_range(df_needle_alignment,'n_inserted')
              range_del=calculate_range(df_needle_alignment,'n_deleted')
 
-             y_values_mut,x_bins_mut=plt.histogram(df_needle_alignment['n_mutated'],bins=range(0,range_mut))
-             y_values_ins,x_bins_ins=plt.histogram(df_needle_alignment['n_inserted'],bins=range(0,range_ins))
-             y_values_del,x_bins_del=plt.histogram(df_needle_alignment['n_deleted'],bins=range(0,range_del))
-
-             fig=plt.figure(figsize=(26,6.5))
-
-
-             ax=fig.add_subplot(1,3,1)
-             ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(x_bins_ins[:-1],y_values_ins,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-
-             plt.title('Insertions')
-             plt.xlabel('Size (bp)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-insertion','Insertion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmin=-1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-             ax=fig.add_subplot(1,3,2)
-             ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(-x_bins_del[:-1],y_values_del,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-             plt.title('Deletions')
-             plt.xlabel('Size (bp)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-deletion','Deletion'][::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmax=1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-
-
-             ax=fig.add_subplot(1,3,3)
-             ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
-             barlist=ax.bar(x_bins_mut[:-1],y_values_mut,align='center',linewidth=0,color=(0,0,1))
-             barlist[0].set_color('r')
-             plt.title('Substitutions')
-             plt.xlabel('Positions substituted (number)')
-             plt.ylabel('Sequences % (no.)')
-             lgd=plt.legend(['Non-substitution','Substitution'][::-1] ,bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
-             lgd.legendHandles[0].set_height(6)
-             lgd.legendHandles[1].set_height(6)
-             plt.xlim(xmin=-1)
-             y_label_values= np.round(np.linspace(0, min(N_TOTAL,max(ax.get_yticks())),6))# np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/N_TOTAL*100,n_reads) for n_reads in y_label_values])
-
-
-             plt.tight_layout()
-
-             plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.pdf'),bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('3.Insertion_Deletion_Substitutions_size_hist.png'),bbox_inches='tight')
-
+             y_values_mut,x_bins_mut=np.histogram(df_needle_alignment['n_mutated'],bins=range(0,range_mut))
+             y_values_ins,x_bins_ins=np.histogram(df_needle_alignment['n_inserted'],bins=range(0,range_ins))
+             y_values_del,x_bins_del=np.histogram(df_needle_alignment['n_deleted'],bins=range(0,range_del))
 
+             add_figure_job('3','plot_indel_size_histograms','3.Insertion_Deletion_Substitutions_size_hist',
+                            x_bins_ins=x_bins_ins,y_values_ins=y_values_ins,x_bins_del=x_bins_del,y_values_del=y_values_del,
+                            x_bins_mut=x_bins_mut,y_values_mut=y_values_mut,n_total=N_TOTAL)
 
              #(4) another graph with the frequency that each nucleotide within the amplicon was modified in any way (perhaps would consider insertion as modification of the flanking nucleotides);
 
              #Indels location Plots
+             location_kwargs=dict(len_amplicon=len_amplicon,n_total=N_TOTAL,cut_points=cut_points,offset_plots=offset_plots,sgRNA_intervals=sgRNA_intervals)
 
-             plt.figure(figsize=(10,10))
-
-             y_max=max(effect_vector_any)*1.2
-
-             plt.plot(effect_vector_any,'r',lw=3,label='Combined Insertions/Deletions/Substitutions')
-             #plt.hold(True)
-
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                 for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                     if idx==0:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                     else:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-
-             lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.23),ncol=1, fancybox=True, shadow=True)
-             ylabel_values = np.arange(0,1,1.0/6.0)
-             if y_max > 0:
-                 y_label_values=np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/float(N_TOTAL)*100, n_reads) for n_reads in y_label_values])
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-             plt.title('Mutation position distribution')
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Sequences % (no.)')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len(args.amplicon_seq)-1)
-             plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('4a.Combined_Insertion_Deletion_Substitution_Locations.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
+             add_figure_job('4a','plot_combined_mutation_locations','4a.Combined_Insertion_Deletion_Substitution_Locations',
+                            effect_vector_any=effect_vector_any,**location_kwargs)
 
              #NHEJ
-             plt.figure(figsize=(10,10))
-             plt.plot(effect_vector_insertion,'r',lw=3,label='Insertions')
-             #plt.hold(True)
-             plt.plot(effect_vector_deletion,'m',lw=3,label='Deletions')
-             plt.plot(effect_vector_mutation,'g',lw=3,label='Substitutions')
-
-             y_max=max(max(effect_vector_insertion),max(effect_vector_deletion),max(effect_vector_mutation))*1.2
-
-
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                 for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                     if idx==0:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                     else:
-                        plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-             lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-             ylabel_values = np.arange(0,1,1.0/6.0)
-             if y_max > 0:
-                 y_label_values=np.arange(0,y_max,y_max/6.0)
-             plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MODIFIED)*100, n_reads) for n_reads in y_label_values])
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Sequences: % Total ( % NHEJ, no. )')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len(args.amplicon_seq)-1)
-
-             plt.title('Mutation position distribution of NHEJ')
-             plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                     plt.savefig(_jp('4b.Insertion_Deletion_Substitution_Locations_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
+             add_figure_job('4b','plot_mutation_locations','4b.Insertion_Deletion_Substitution_Locations_NHEJ',
+                            effect_vector_insertion=effect_vector_insertion,effect_vector_deletion=effect_vector_deletion,effect_vector_mutation=effect_vector_mutation,
+                            n_class=N_MODIFIED,class_label='NHEJ',title='Mutation position distribution of NHEJ',**location_kwargs)
 
              if args.expected_hdr_amplicon_seq:
-
                  #HDR
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_hdr,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_hdr,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_hdr,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_hdr),max(effect_vector_deletion_hdr),max(effect_vector_mutation_hdr))*1.2
-
-                 if cut_points:
-
-                         for idx,cut_point in enumerate(cut_points):
-                             if idx==0:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                             else:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 ylabel_values = np.arange(0,1,1.0/6.0)
-                 if y_max > 0:
-                     y_label_values=np.arange(0,y_max,y_max/6).astype(int)
-                 plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_REPAIRED)*100, n_reads) for n_reads in y_label_values])
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences: % Total ( % HDR, no. )')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Mutation position distribution of HDR')
-                 plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('4c.Insertion_Deletion_Substitution_Locations_HDR.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
+                 add_figure_job('4c','plot_mutation_locations','4c.Insertion_Deletion_Substitution_Locations_HDR',
+                                effect_vector_insertion=effect_vector_insertion_hdr,effect_vector_deletion=effect_vector_deletion_hdr,effect_vector_mutation=effect_vector_mutation_hdr,
+                                n_class=N_REPAIRED,class_label='HDR',title='Mutation position distribution of HDR',**location_kwargs)
 
                  #MIXED
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_mixed,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_mixed,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_mixed,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_mixed),max(effect_vector_deletion_mixed),max(effect_vector_mutation_mixed))*1.2
-
-                 if cut_points:
-
-                         for idx,cut_point in enumerate(cut_points):
-                             if idx==0:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                             else:
-                                     plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 ylabel_values = np.arange(0,1,1.0/6.0)
-                 if y_max > 0:
-                     y_label_values=np.arange(0,y_max,y_max/6).astype(int)
-                 plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(N_TOTAL)*100,n_reads/float(N_MIXED_HDR_NHEJ)*100, n_reads) for n_reads in y_label_values])
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences: % Total ( % mixed HDR-NHEJ, no. )')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Mutation position distribution of mixed HDR-NHEJ')
-                 plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ.png'),bbox_extra_artists=(lgd,), bbox_inches='tight',pad=1)
-
-
-            #Position dependent indels plot
-             fig=plt.figure(figsize=(24,10))
-             ax1=fig.add_subplot(1,2,1)
-             markerline, stemlines, baseline=ax1.stem(avg_vector_ins_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
-             plt.setp(markerline, 'markerfacecolor', 'r', 'markersize', 8)
-             plt.setp(baseline, 'linewidth', 0)
-             plt.setp(stemlines, 'color', 'r','linewidth',3)
-             #plt.hold(True)
-             y_max=max(avg_vector_ins_all)*1.2
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             ax1.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Average insertion length')
-             plt.ylim(0,max(1,y_max))
-             plt.xlim(xmax=len_amplicon-1)
-             ax1.set_title('Position dependent insertion size')
-             plt.tight_layout()
-
-             ax2=fig.add_subplot(1,2,2)
-             markerline, stemlines, baseline=ax2.stem(avg_vector_del_all,'r',lw=3,markerfmt="s",markerline=None,s=50)
-             plt.setp(markerline, 'markerfacecolor', 'm', 'markersize', 8)
-             plt.setp(baseline, 'linewidth', 0)
-             plt.setp(stemlines, 'color', 'm','linewidth',3)
-             #plt.hold(True)
-             y_max=max(avg_vector_del_all)*1.2
-             if cut_points:
-
-                 for idx,cut_point in enumerate(cut_points):
-                     if idx==0:
-                             ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                     else:
-                             ax2.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-             plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-             plt.xlabel('Reference amplicon position (bp)')
-             plt.ylabel('Average deletion length')
-
-             plt.ylim(ymin=0,ymax=max(1,y_max))
-             plt.xlim(xmax=len_amplicon-1)
-             ax2.set_title('Position dependent deletion size')
-
-             plt.tight_layout()
-
-
-             plt.savefig(_jp('4e.Position_dependent_average_indel_size.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-             if args.save_also_png:
-                 plt.savefig(_jp('4e.Position_dependent_average_indel_size.png'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+                 add_figure_job('4d','plot_mutation_locations','4d.Insertion_Deletion_Substitution_Locations_Mixed_HDR_NHEJ',
+                                effect_vector_insertion=effect_vector_insertion_mixed,effect_vector_deletion=effect_vector_deletion_mixed,effect_vector_mutation=effect_vector_mutation_mixed,
+                                n_class=N_MIXED_HDR_NHEJ,class_label='mixed HDR-NHEJ',title='Mutation position distribution of mixed HDR-NHEJ',**location_kwargs)
 
+             #Position dependent indels plot
+             add_figure_job('4e','plot_position_dependent_indel_size','4e.Position_dependent_average_indel_size',
+                            avg_vector_ins_all=avg_vector_ins_all,avg_vector_del_all=avg_vector_del_all,len_amplicon=len_amplicon,
+                            cut_points=cut_points,offset_plots=offset_plots)
 
              if PERFORM_FRAMESHIFT_ANALYSIS:
                  #make frameshift plots
-                 fig=plt.figure(figsize=(12*1.5,14.5*1.5))
-                 ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
-                 patches, texts, autotexts =ax1.pie([MODIFIED_FRAMESHIFT,\
-                                                    MODIFIED_NON_FRAMESHIFT,\
-                                                    NON_MODIFIED_NON_FRAMESHIFT],\
-                                                    labels=['Frameshift mutation\n(%d reads)' %MODIFIED_FRAMESHIFT,\
-                                                           'In-frame mutation\n(%d reads)' % MODIFIED_NON_FRAMESHIFT,\
-                                                           'Noncoding mutation\n(%d reads)' %NON_MODIFIED_NON_FRAMESHIFT],\
-                                                    explode=(0.0,0.0,0.0),\
-                                                    colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99215686,  0.73333333,  0.51764706,0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
-                                                    autopct='%1.1f%%')
-
-                 ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
-                 ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
-                 #plt.hold(True)
-
-                 for idx,exon_interval in enumerate(exon_intervals):
-                     if idx==0:
-                         ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='Coding sequence/s',solid_capstyle='butt')
-                     else:
-                         ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='_nolegend_',solid_capstyle='butt')
-
-                 if cut_points:
-                    ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=25,label='Predicted Cas9 cleavage site/s')
-
-                 plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
-                 plt.xlim(0,len_amplicon)
-                 plt.axis('off')
-
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('5.Frameshift_In-frame_mutations_pie_chart.png'),pad_inches=1,bbox_inches='tight')
-
-
-                 #profiles-----------------------------------------------------------------------------------
-                 fig=plt.figure(figsize=(22,10))
-                 ax1=fig.add_subplot(2,1,1)
-                 x,y=map(np.array,zip(*[a for a in hist_frameshift.iteritems()]))
-                 y=y/float(sum(hist_frameshift.values()))*100
-                 ax1.bar(x-0.5,y)
-                 ax1.set_xlim(-30.5,30.5)
-                 ax1.set_frame_on(False)
-                 ax1.set_xticks([idx for idx in range(-30,31) if idx % 3])
-                 ax1.tick_params(which='both',      # both major and minor ticks are affected
-                    bottom='off',      # ticks along the bottom edge are off
-                    top='off',         # ticks along the top edge are off
-                    labelbottom='on') # labels along the bottom edge are off)
-                 ax1.yaxis.tick_left()
-                 xmin, xmax = ax1.get_xaxis().get_view_interval()
-                 ymin, ymax = ax1.get_yaxis().get_view_interval()
-                 ax1.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if idx % 3]],rotation='vertical')
-                 plt.title('Frameshift profile')
-                 ax1.tick_params(axis='both', which='major', labelsize=32)
-                 ax1.tick_params(axis='both', which='minor', labelsize=32)
-                 plt.tight_layout()
-                 plt.ylabel('%')
-
-                 ax2=fig.add_subplot(2,1,2)
-                 x,y=map(np.array,zip(*[a for a in hist_inframe.iteritems()]))
-                 y=y/float(sum(hist_inframe.values()))*100
-                 ax2.bar(x-0.5,y,color=(0,1,1,0.2))
-                 ax2.set_xlim(-30.5,30.5)
-                 ax2.set_frame_on(False)
-                 ax2.set_xticks([idx for idx in range(-30,31) if (idx % 3 ==0) ])
-                 ax2.tick_params(which='both',      # both major and minor ticks are affected
-                    bottom='off',      # ticks along the bottom edge are off
-                    top='off',         # ticks along the top edge are off
-                    labelbottom='on') # labels along the bottom edge are off)
-                 ax2.yaxis.tick_left()
-                 xmin, xmax = ax2.xaxis.get_view_interval()
-                 ymin, ymax = ax2.yaxis.get_view_interval()
-                 ax2.set_xticklabels([str(idx)  for idx in [idx for idx in range(-30,31) if (idx % 3==0)]],rotation='vertical')
-                 plt.title('In-frame profile')
-                 plt.tight_layout()
-                 plt.ylabel('%')
-                 ax2.tick_params(axis='both', which='major', labelsize=32)
-                 ax2.tick_params(axis='both', which='minor', labelsize=32)
-                 plt.tight_layout()
-
-                 plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('6.Frameshift_In-frame_mutation_profiles.png'),pad_inches=1,bbox_inches='tight')
-
-                 #-----------------------------------------------------------------------------------------------------------
-                 fig=plt.figure(figsize=(12*1.5,12*1.5))
-                 ax=fig.add_subplot(1,1,1)
-                 patches, texts, autotexts =ax.pie([SPLICING_SITES_MODIFIED,\
-                                                   (df_needle_alignment.shape[0] - SPLICING_SITES_MODIFIED)],\
-                                                   labels=['Potential splice sites modified\n(%d reads)' %SPLICING_SITES_MODIFIED,\
-                                                           'Unmodified\n(%d reads)' % (df_needle_alignment.shape[0]- SPLICING_SITES_MODIFIED)],\
-                                                   explode=(0.0,0),\
-                                                   colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
-                                                   autopct='%1.1f%%')
-                 proptease = fm.FontProperties()
-                 proptease.set_size('xx-large')
-                 plt.setp(autotexts, fontproperties=proptease)
-                 plt.setp(texts, fontproperties=proptease)
-                 plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.pdf'),pad_inches=1,bbox_inches='tight')
-                 if args.save_also_png:
-                     plt.savefig(_jp('8.Potential_Splice_Sites_pie_chart.png'),pad_inches=1,bbox_inches='tight')
+                 add_figure_job('5','plot_frameshift_pie_chart','5.Frameshift_In-frame_mutations_pie_chart',
+                                modified_frameshift=MODIFIED_FRAMESHIFT,modified_non_frameshift=MODIFIED_NON_FRAMESHIFT,
+                                non_modified_non_frameshift=NON_MODIFIED_NON_FRAMESHIFT,len_amplicon=len_amplicon,exon_intervals=exon_intervals,
+                                cut_points=cut_points,offset_plots=offset_plots)
 
-                 #non coding
-                 plt.figure(figsize=(10,10))
-                 plt.plot(effect_vector_insertion_noncoding,'r',lw=3,label='Insertions')
-                 #plt.hold(True)
-                 plt.plot(effect_vector_deletion_noncoding,'m',lw=3,label='Deletions')
-                 plt.plot(effect_vector_mutation_noncoding,'g',lw=3,label='Substitutions')
-
-                 y_max=max(max(effect_vector_insertion_noncoding),max(effect_vector_deletion_noncoding),max(effect_vector_mutation_noncoding))*1.2
+                 #profiles
+                 add_figure_job('6','plot_frameshift_profiles','6.Frameshift_In-frame_mutation_profiles',
+                                hist_frameshift=dict(hist_frameshift),hist_inframe=dict(hist_inframe))
 
+                 add_figure_job('8','plot_splice_sites_pie_chart','8.Potential_Splice_Sites_pie_chart',
+                                splicing_sites_modified=SPLICING_SITES_MODIFIED,n_reads=df_needle_alignment.shape[0])
 
-                 if cut_points:
-
-                     for idx,cut_point in enumerate(cut_points):
-                         if idx==0:
-                                 plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position')
-                         else:
-                                 plt.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='_nolegend_')
-
-                         for idx,sgRNA_int in enumerate(sgRNA_intervals):
-                             if idx==0:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA',solid_capstyle='butt')
-                             else:
-                                plt.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='_nolegend_',solid_capstyle='butt')
-
-                 lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
-                 plt.xticks(np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int) )
-
-                 plt.xlabel('Reference amplicon position (bp)')
-                 plt.ylabel('Sequences (no.)')
-                 plt.ylim(0,max(1,y_max))
-                 plt.xlim(xmax=len(args.amplicon_seq)-1)
-                 plt.title('Noncoding mutation position distribution')
-                 plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.pdf'),bbox_extra_artists=(lgd,), bbox_inches='tight')
-                 if args.save_also_png:
-                         plt.savefig(_jp('7.Insertion_Deletion_Substitution_Locations_Noncoding.png'),bbox_extra_artists=(lgd,), bbox_inches='tight')
+                 #non coding
+                 add_figure_job('7','plot_mutation_locations','7.Insertion_Deletion_Substitution_Locations_Noncoding',
+                                effect_vector_insertion=effect_vector_insertion_noncoding,effect_vector_deletion=effect_vector_deletion_noncoding,
+                                effect_vector_mutation=effect_vector_mutation_noncoding,n_class=None,class_label=None,
+                                title='Noncoding mutation position distribution',**location_kwargs)
 
              ##new plots alleles around cut_sites
 
-             for sgRNA,cut_point in zip(sgRNA_sequences,cut_points):
-                 #print sgRNA,cut_point
+             #the alleles around the cut sites are recomputed by CRISPResso replot, only the alleles are saved
+             df_alleles_to_plot=df_alleles[['Aligned_Sequence','Reference_Sequence','UNMODIFIED','#Reads','%Reads','ref_positions']]
+             save_plot_data(OUTPUT_DIRECTORY,{'version':__version__,
+                                              'args':vars(args),
+                                              'figure_jobs':figure_jobs,
+                                              'df_alleles':df_alleles_to_plot,
+                                              'sgRNA_sequences':sgRNA_sequences,
+                                              'cut_points':cut_points})
 
-                 df_allele_around_cut=get_dataframe_around_cut(df_alleles, cut_point,args.offset_around_cut_to_plot)
+             figure_jobs+=get_alleles_table_figure_jobs(OUTPUT_DIRECTORY,df_alleles_to_plot,args.amplicon_seq,sgRNA_sequences,cut_points,
+                                                        args.offset_around_cut_to_plot,args.min_frequency_alleles_around_cut_to_plot,
+                                                        args.max_rows_alleles_around_cut_to_plot,args.vector_alleles_table)
 
-                 #write alleles table to file
-                 df_allele_around_cut.to_csv(_jp('Alleles_frequency_table_around_cut_site_for_%s.txt' % sgRNA),sep='\t',header=True)
-                 plot_alleles_table(args.amplicon_seq,cut_point, df_allele_around_cut,sgRNA,OUTPUT_DIRECTORY,MIN_FREQUENCY=args.min_frequency_alleles_around_cut_to_plot,MAX_N_ROWS=args.max_rows_alleles_around_cut_to_plot)
+             #with --plot_level none the plotting libraries are not imported
+             if args.plot_level!='none':
+                 CRISPRessoPlot.render_figures(figure_jobs,OUTPUT_DIRECTORY,args.plot_level,['pdf','png'] if args.save_also_png else ['pdf'],args.n_processes)
 
              info('Done!')
 
-             if not args.keep_intermediate:
+             if not args.keep_intermediate and not REQUANTIFY:
                  info('Removing Intermediate files...')
 
-                 if args.fastq_r2!='':
-                     files_to_remove=[processed_output_filename,flash_hist_filename,flash_histogram_filename,\
-                                  flash_not_combined_1_filename,flash_not_combined_2_filename,\
-                                  database_fasta_filename]
-                 else:
-                     files_to_remove=[processed_output_filename,database_fasta_filename]
-
-                 if args.trim_sequences and args.fastq_r2!='':
-                     files_to_remove+=[output_forward_paired_filename,output_reverse_paired_filename,\
-                                                       output_forward_unpaired_filename,output_reverse_unpaired_filename]
+                 files_to_remove=preprocessing_files_to_remove+alignment_intermediate_filenames
 
                  if not args.dump:
-                     files_to_remove+=[needle_output_filename]
-                     if args.expected_hdr_amplicon_seq:
-                         files_to_remove+=[needle_output_repair_filename]
-
-                 if args.expected_hdr_amplicon_seq:
-                     files_to_remove+=[database_repair_fasta_filename,]
-
-                 if args.split_paired_end:
-                     files_to_remove+=splitted_files_to_remove
-
-                 if args.min_average_read_quality>0 or args.min_single_bp_quality>0:
-
-                    if args.fastq_r2!='':
-                             files_to_remove+=[args.fastq_r1,args.fastq_r2]
-                    else:
-                             files_to_remove+=[args.fastq_r1]
-
-                 if sr_not_aligned.count():
-                     files_to_remove+=[fasta_not_aligned_filename,database_rc_fasta_filename,needle_output_rc_filename]
-
-                     if args.expected_hdr_amplicon_seq:
-                            files_to_remove+=[database_repair_rc_fasta_filename,needle_output_repair_rc_filename]
-
+                     files_to_remove+=needle_output_filenames
 
                  for file_to_remove in files_to_remove:
                      try:
@@ -2306,7 +3046,9 @@ def main():
 
              #write effect vectors as plain text files
              info('Saving processed data...')
+             saved_vectors=[]
              def save_vector_to_file(vector,name):
+                     saved_vectors.append((name,vector))
                      np.savetxt(_jp('%s.txt' %name), np.vstack([(np.arange(len(vector))+1),vector]).T, fmt=['%d','%.18e'],delimiter='\t', newline='\n', header='amplicon position\teffect',footer='', comments='# ')
 
 
@@ -2331,14 +3073,55 @@ def main():
              mixed_mutated = np.sum(df_needle_alignment.ix[df_needle_alignment.MIXED,'n_mutated']>0)
 	     if np.isnan(mixed_mutated): mixed_mutated = 0
 
+             #on a subsample we report the percentages with their 95% confidence intervals, after the counts to keep the format parsable
+             if 'n_reads_before_subsampling' in run_info:
+                 get_ci_string=lambda n_reads: ' [%.2f%%, 95%% CI %.2f-%.2f%%]' % ((100.0*n_reads/N_TOTAL,)+wilson_interval(n_reads,N_TOTAL))
+             else:
+                 get_ci_string=lambda n_reads: ''
+
              with open(_jp('Quantification_of_editing_frequency.txt'),'w+') as outfile:
                      outfile.write(
-                     ('Quantification of editing frequency:\n\t- Unmodified:%d reads\n'  %N_UNMODIFIED)\
-                     +('\t- NHEJ:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)\n' % (N_MODIFIED, nhej_inserted, nhej_deleted, nhej_mutated))\
-                     +('\t- HDR:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)\n' % (N_REPAIRED, hdr_inserted, hdr_deleted, hdr_mutated))\
-                     +('\t- Mixed HDR-NHEJ:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)\n\n' % (N_MIXED_HDR_NHEJ, mixed_inserted, mixed_deleted, mixed_mutated))\
+                     ('Quantification of editing frequency:\n\t- Unmodified:%d reads%s\n'  % (N_UNMODIFIED,get_ci_string(N_UNMODIFIED)))\
+                     +('\t- NHEJ:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)%s\n' % (N_MODIFIED, nhej_inserted, nhej_deleted, nhej_mutated, get_ci_string(N_MODIFIED)))\
+                     +('\t- HDR:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)%s\n' % (N_REPAIRED, hdr_inserted, hdr_deleted, hdr_mutated, get_ci_string(N_REPAIRED)))\
+                     +('\t- Mixed HDR-NHEJ:%d reads (%d reads with insertions, %d reads with deletions, %d reads with substitutions)%s\n\n' % (N_MIXED_HDR_NHEJ, mixed_inserted, mixed_deleted, mixed_mutated, get_ci_string(N_MIXED_HDR_NHEJ)))\
                      +('Total Aligned:%d reads ' % N_TOTAL))
 
+                     if 'n_reads_before_adaptive_stopping' in run_info:
+                         outfile.write('\n\nReads used (adaptive stopping, tolerance %.2f%%):%d of %d reads after preprocessing (seed %d)' % (args.adaptive_tolerance,N_TOTAL_ALSO_UNALIGNED,run_info['n_reads_before_subsampling'],args.subsample_seed))
+                     elif 'n_reads_before_subsampling' in run_info:
+                         outfile.write('\n\nSubsampled reads:%d of %d reads after preprocessing (seed %d)' % (N_TOTAL_ALSO_UNALIGNED,run_info['n_reads_before_subsampling'],args.subsample_seed))
+
+             #with UMIs each read above is a molecule, we report also the number of sequenced reads supporting them
+             if 'n_umi_reads' in df_needle_alignment.columns:
+                 quantification_umi_data=[]
+                 for class_name,class_column in [('Unmodified','UNMODIFIED'),('NHEJ','NHEJ'),('HDR','HDR'),('Mixed HDR-NHEJ','MIXED')]:
+                     quantification_umi_data.append([class_name,df_needle_alignment[class_column].sum(),df_needle_alignment.ix[df_needle_alignment[class_column],'n_umi_reads'].sum()])
+                 quantification_umi_data.append(['Total Aligned',N_TOTAL,df_needle_alignment['n_umi_reads'].sum()])
+
+                 pd.DataFrame(quantification_umi_data,columns=['Class','Molecules','Reads'])\
+                 .to_csv(_jp('Quantification_of_editing_frequency_by_molecule.txt'),sep='\t',header=True,index=None,float_format='%d')
+
+
+             #quantification for each sgRNA (or for each cut point, if a sgRNA matches the amplicon more than once)
+             if cut_points:
+                 #the files are keyed by the index of the cut point, a sgRNA can give more cut points (even at the same position on the two strands)
+                 cut_point_labels=get_cut_point_labels(cut_point_sgRNAs)
+
+                 quantification_by_sgRNA_data=[]
+                 for idx_cut,cut_p in enumerate(cut_points):
+                     N_MODIFIED_CUT=df_needle_alignment['NHEJ_cut_%d' % idx_cut].sum()
+                     quantification_by_sgRNA_data.append([cut_point_sgRNAs[idx_cut],cut_p,int(N_TOTAL-N_MODIFIED_CUT-N_REPAIRED-N_MIXED_HDR_NHEJ),
+                                                          N_MODIFIED_CUT,N_REPAIRED,N_MIXED_HDR_NHEJ,int(N_TOTAL),N_MODIFIED_CUT/N_TOTAL*100])
+
+                 df_quantification_by_sgRNA=pd.DataFrame(quantification_by_sgRNA_data,columns=['sgRNA','Cut_point','Unmodified','NHEJ','HDR','Mixed HDR-NHEJ','Total Aligned','%NHEJ'])
+                 df_quantification_by_sgRNA.to_csv(_jp('Quantification_of_editing_frequency_by_sgRNA.txt'),sep='\t',header=True,index=None,float_format='%.2f')
+
+                 if len(cut_points)>1:
+                     for idx_cut,cut_point_label in enumerate(cut_point_labels):
+                         save_vector_to_file(effect_vector_insertion_per_cut[idx_cut],'effect_vector_insertion_NHEJ_for_%s' % cut_point_label)
+                         save_vector_to_file(effect_vector_deletion_per_cut[idx_cut],'effect_vector_deletion_NHEJ_for_%s' % cut_point_label)
+                         save_vector_to_file(effect_vector_mutation_per_cut[idx_cut],'effect_vector_substitution_NHEJ_for_%s' % cut_point_label)
 
              #write alleles table
              df_alleles.ix[:,:'%Reads'].to_csv(_jp('Alleles_frequency_table.txt'),sep='\t',header=True,index=None)
@@ -2347,6 +3130,18 @@ def main():
              with open(_jp('Mapping_statistics.txt'),'w+') as outfile:
                  outfile.write('READS IN INPUTS:%d\nREADS AFTER PREPROCESSING:%d\nREADS ALIGNED:%d' % (N_READS_INPUT,N_READS_AFTER_PREPROCESSING,N_TOTAL))
 
+                 if 'n_reads_before_adaptive_stopping' in run_info:
+                     outfile.write('\nREADS USED (ADAPTIVE STOPPING):%d' % N_TOTAL_ALSO_UNALIGNED)
+                 elif 'n_reads_before_subsampling' in run_info:
+                     outfile.write('\nREADS SUBSAMPLED:%d' % N_TOTAL_ALSO_UNALIGNED)
+
+                 if 'n_reads_rejected_by_prescreen' in run_info:
+                     outfile.write('\nREADS REJECTED BY THE PRESCREEN:%d' % run_info['n_reads_rejected_by_prescreen'])
+
+                 if 'n_reads_with_umi' in run_info:
+                     outfile.write('\nREADS WITH UMI:%d\nREADS IN UMI FAMILIES:%d\nMOLECULES ALIGNED:%d\nREADS OF THE MOLECULES ALIGNED:%d' \
+                                   % (run_info['n_reads_with_umi'],run_info['n_reads_in_umi_families'],N_TOTAL,df_needle_alignment['n_umi_reads'].sum()))
+
              if PERFORM_FRAMESHIFT_ANALYSIS:
                  with open(_jp('Frameshift_analysis.txt'),'w+') as outfile:
                          outfile.write('Frameshift analysis:\n\tNoncoding mutation:%d reads\n\tIn-frame mutation:%d reads\n\tFrameshift mutation:%d reads\n' %(NON_MODIFIED_NON_FRAMESHIFT, MODIFIED_NON_FRAMESHIFT ,MODIFIED_FRAMESHIFT))
@@ -2369,10 +3164,13 @@ def main():
              save_vector_to_file(avg_vector_del_all,'position_dependent_vector_avg_deletion_size')
 
 
-             pd.DataFrame(np.vstack([hlengths,hdensity]).T,columns=['indel_size','fq']).to_csv(_jp('indel_histogram.txt'),index=None,sep='\t')
-             pd.DataFrame(np.vstack([x_bins_ins[:-1],y_values_ins]).T,columns=['ins_size','fq']).to_csv(_jp('insertion_histogram.txt'),index=None,sep='\t')
-             pd.DataFrame(np.vstack([-x_bins_del[:-1],y_values_del]).T,columns=['del_size','fq']).to_csv(_jp('deletion_histogram.txt'),index=None,sep='\t')
-             pd.DataFrame(np.vstack([x_bins_mut[:-1],y_values_mut]).T,columns=['sub_size','fq']).to_csv(_jp('substitution_histogram.txt'),index=None,sep='\t')
+             histograms=[('indel',pd.DataFrame(np.vstack([hlengths,hdensity]).T,columns=['indel_size','fq'])),
+                         ('insertion',pd.DataFrame(np.vstack([x_bins_ins[:-1],y_values_ins]).T,columns=['ins_size','fq'])),
+                         ('deletion',pd.DataFrame(np.vstack([-x_bins_del[:-1],y_values_del]).T,columns=['del_size','fq'])),
+                         ('substitution',pd.DataFrame(np.vstack([x_bins_mut[:-1],y_values_mut]).T,columns=['sub_size','fq']))]
+
+             for histogram_name,df_histogram in histograms:
+                 df_histogram.to_csv(_jp('%s_histogram.txt' % histogram_name),index=None,sep='\t')
 
              if args.expected_hdr_amplicon_seq:
                  save_vector_to_file(effect_vector_insertion_mixed,'effect_vector_insertion_mixed_HDR_NHEJ')
@@ -2392,6 +3190,35 @@ def main():
              if offset_plots.any():
                   cp.dump(offset_plots,open( _jp('offset_plots.pickle'), 'wb' ) )
 
+             if args.write_hdf5:
+                 info('Writing the results in a HDF5 file...')
+
+                 df_quantification=pd.DataFrame([['Unmodified',N_UNMODIFIED,0,0,0],
+                                                 ['NHEJ',N_MODIFIED,nhej_inserted,nhej_deleted,nhej_mutated],
+                                                 ['HDR',N_REPAIRED,hdr_inserted,hdr_deleted,hdr_mutated],
+                                                 ['Mixed HDR-NHEJ',N_MIXED_HDR_NHEJ,mixed_inserted,mixed_deleted,mixed_mutated]],
+                                                columns=['Class','Reads','Reads_with_insertions','Reads_with_deletions','Reads_with_substitutions'])
+                 df_quantification['%Reads']=df_quantification['Reads']/N_TOTAL*100
+
+                 df_mapping_statistics=pd.DataFrame([[int(N_READS_INPUT),int(N_READS_AFTER_PREPROCESSING),int(N_TOTAL_ALSO_UNALIGNED),int(N_TOTAL)]],
+                                                    columns=['Reads_input','Reads_after_preprocessing','Reads_analyzed','Reads_aligned'])
+
+                 results_tables=[('histograms/%s' % histogram_name,df_histogram) for histogram_name,df_histogram in histograms]+\
+                                [('alleles',df_alleles.ix[:,:'%Reads'].reset_index(drop=True)),
+                                 ('quantification',df_quantification),
+                                 ('mapping_statistics',df_mapping_statistics)]
+
+                 if cut_points:
+                     results_tables+=[('quantification_by_sgRNA',df_quantification_by_sgRNA),
+                                      ('cut_points',pd.DataFrame([[sgRNA,cut_p,sgRNA_start,sgRNA_end] for sgRNA,cut_p,(sgRNA_start,sgRNA_end) in zip(cut_point_sgRNAs,cut_points,sgRNA_intervals)],
+                                                                 columns=['sgRNA','Cut_point','sgRNA_start','sgRNA_end'])),
+                                      ('sgRNAs',pd.DataFrame({'sgRNA':sgRNA_sequences,'offset_plot':offset_plots},columns=['sgRNA','offset_plot']))]
+
+                 results_metadata=dict(parsed_args)
+                 results_metadata['version']=__version__
+
+                 write_results_hdf5(_jp('CRISPResso_results.h5'),saved_vectors,results_tables,results_metadata)
+
              if args.dump:
                  info('Dumping all the processed data...')
                  np.savez(_jp('effect_vector_insertion_NHEJ'),effect_vector_insertion)
@@ -2419,6 +3246,749 @@ def main():
                      np.savez(_jp('effect_vector_substitution_HDR'),effect_vector_mutation_hdr)
 
              info('All Done!')
+
+             return CRISPRessoResult(OUTPUT_DIRECTORY,N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,N_TOTAL)
+
+
+###MULTIPLE AMPLICONS#####################
+
+class AmpliconKmerIndex(object):
+    '''
+    Index of the k-mers specific to each amplicon (on both strands), used to assign the reads to the amplicons without aligning them.
+    A read is assigned to the amplicon sharing the highest number of specific k-mers with it, if this number is at least min_kmers
+    and at least min_kmer_fraction of the k-mers of the read (the k-mers with Ns are not counted), and it is higher than the number
+    for any other amplicon by at least margin. With the fraction a read sharing only a primer with an amplicon is not assigned to it.
+    '''
+
+    def __init__(self,amplicon_seqs,k=10,min_kmers=1,margin=1,min_kmer_fraction=0.5):
+        self.k=k
+        self.min_kmers=min_kmers
+        self.margin=margin
+        self.min_kmer_fraction=min_kmer_fraction
+
+        kmer_amplicons=defaultdict(set)
+        for idx_amplicon,amplicon_seq in enumerate(amplicon_seqs):
+            for seq in [amplicon_seq,reverse_complement(amplicon_seq)]:
+                for i in range(len(seq)-k+1):
+                    kmer_amplicons[seq[i:i+k]].add(idx_amplicon)
+
+        #the k-mers shared by two or more amplicons are not informative
+        self.kmer_to_amplicon=dict([(kmer,amplicons.pop()) for kmer,amplicons in kmer_amplicons.iteritems() if len(amplicons)==1])
+
+        self.n_kmers_amplicons=np.zeros(len(amplicon_seqs),dtype=int)
+        for idx_amplicon in self.kmer_to_amplicon.itervalues():
+            self.n_kmers_amplicons[idx_amplicon]+=1
+
+    def assign(self,seq):
+        kmer_to_amplicon=self.kmer_to_amplicon
+        k=self.k
+
+        kmer_counts=defaultdict(int)
+        n_kmers_seq=0
+        for i in range(len(seq)-k+1):
+            kmer=seq[i:i+k]
+            if 'N' in kmer:
+                continue
+
+            n_kmers_seq+=1
+            idx_amplicon=kmer_to_amplicon.get(kmer)
+            if idx_amplicon is not None:
+                kmer_counts[idx_amplicon]+=1
+
+        if not kmer_counts:
+            return None
+
+        ranked_counts=sorted(kmer_counts.items(),key=lambda x: x[1],reverse=True)
+        idx_best,n_kmers_best=ranked_counts[0]
+        n_kmers_second=ranked_counts[1][1] if len(ranked_counts)>1 else 0
+
+        if n_kmers_best>=max(self.min_kmers,self.min_kmer_fraction*n_kmers_seq) and n_kmers_best-n_kmers_second>=self.margin:
+            return idx_best
+        else:
+            return None
+
+
+def load_amplicons_file(amplicons_filename,cleavage_offset):
+    '''
+    Load the amplicons description file, the same format used by CRISPRessoPooled
+    '''
+    df_template=pd.read_csv(amplicons_filename,names=[
+            'Name','Amplicon_Sequence','sgRNA',
+            'Expected_HDR','Coding_sequence'],comment='#',sep='\t',dtype={'Name':str})
+
+    #remove empty amplicons/lines
+    df_template.dropna(subset=['Amplicon_Sequence'],inplace=True)
+    df_template.dropna(subset=['Name'],inplace=True)
+    df_template=df_template.fillna('')
+
+    for column in ['Amplicon_Sequence','sgRNA','Expected_HDR','Coding_sequence']:
+        df_template[column]=df_template[column].apply(lambda x: str(x).strip().upper())
+
+    if not len(df_template.Amplicon_Sequence.unique())==df_template.shape[0]:
+        raise Exception('The amplicons should be all distinct!')
+
+    if not len(df_template.Name.unique())==df_template.shape[0]:
+        raise Exception('The amplicon names should be all distinct!')
+
+    df_template=df_template.set_index('Name')
+    df_template.index=df_template.index.to_series().str.replace(' ','_')
+
+    for idx,row in df_template.iterrows():
+
+        wrong_nt=find_wrong_nt(row.Amplicon_Sequence)
+        if wrong_nt:
+             raise NTException('The amplicon sequence %s contains wrong characters:%s' % (idx,' '.join(wrong_nt)))
+
+        if row.sgRNA:
+            try:
+                get_cut_points(row.sgRNA,row.Amplicon_Sequence,cleavage_offset)
+            except SgRNASequenceException:
+                warn('\nThe guide sequence/s provided: %s is(are) not present in the amplicon sequence:%s! \nNOTE: The guide will be ignored for the analysis. Please check your input!' % (row.sgRNA,row.Amplicon_Sequence))
+                df_template.ix[idx,'sgRNA']=''
+
+    return df_template
+
+
+def run_crispresso_on_amplicons(analysis_args):
+    '''
+    Preprocess the reads once, assign each read to its amplicon and run the analysis of each amplicon on its reads.
+    The paired end reads are assigned before merging them, each amplicon merges its read pairs with FLASH using
+    its own length as the analysis of a single amplicon does.
+    '''
+    args=analysis_args
+
+    check_file(args.fastq_r1)
+    if args.fastq_r2:
+            check_file(args.fastq_r2)
+    check_file(args.amplicons_file)
+    check_required_programs(args)
+
+    df_template=load_amplicons_file(args.amplicons_file,args.cleavage_offset)
+    info('Loaded %d amplicons from %s' % (df_template.shape[0],args.amplicons_file))
+
+    get_name_from_fasta=lambda  x: os.path.basename(x).replace('.fastq','').replace('.gz','')
+
+    if args.name:
+            database_id=slugify(args.name)
+    elif args.fastq_r2!='':
+            database_id='%s_%s' % (get_name_from_fasta(args.fastq_r1),get_name_from_fasta(args.fastq_r2))
+    else:
+            database_id='%s' % get_name_from_fasta(args.fastq_r1)
+
+    OUTPUT_DIRECTORY='CRISPResso_on_%s' % database_id
+
+    if args.output_folder:
+             OUTPUT_DIRECTORY=os.path.join(os.path.abspath(args.output_folder),OUTPUT_DIRECTORY)
+
+    _jp=lambda filename: os.path.join(OUTPUT_DIRECTORY,filename) #handy function to put a file in the output directory
+    log_filename=_jp('CRISPResso_RUNNING_LOG.txt')
+
+    try:
+             os.makedirs(OUTPUT_DIRECTORY)
+             info('Creating Folder %s' % OUTPUT_DIRECTORY)
+             info('Done!')
+    except:
+             warn('Folder %s already exists.' % OUTPUT_DIRECTORY)
+
+    finally:
+             logging.getLogger().addHandler(logging.FileHandler(log_filename))
+
+             with open(log_filename,'w+') as outfile:
+                 outfile.write('[Command used]:\nCRISPResso %s\n\n[Execution log]:\n' % ' '.join(sys.argv))
+
+    #the reads are preprocessed only once for all the amplicons, the paired end reads are merged later for each amplicon
+    avg_len_amplicon=int(df_template.Amplicon_Sequence.apply(len).mean())
+    processed_output_filename,N_READS_INPUT,N_READS_AFTER_PREPROCESSING,preprocessing_files_to_remove=preprocess_reads(args,OUTPUT_DIRECTORY,log_filename,avg_len_amplicon,merge_paired_end=False)
+    paired_end=isinstance(processed_output_filename,tuple)
+
+    info('Assigning the reads to the amplicons...')
+    amplicon_index=AmpliconKmerIndex(list(df_template.Amplicon_Sequence),k=args.amplicon_assignment_kmer_size,min_kmer_fraction=args.amplicon_assignment_min_kmer_fraction)
+
+    for idx_amplicon,amplicon_name in enumerate(df_template.index):
+        if amplicon_index.n_kmers_amplicons[idx_amplicon]==0:
+            warn('The amplicon %s has no specific %d-mers, no reads will be assigned to it.' % (amplicon_name,args.amplicon_assignment_kmer_size))
+
+    df_template['Demultiplexed_fastq.gz_filename']=[_jp('AMPL_%s.fastq.gz' % slugify(amplicon_name)) for amplicon_name in df_template.index]
+    amplicon_handles=[gzip.open(fastq_filename,'w+') for fastq_filename in df_template['Demultiplexed_fastq.gz_filename']]
+    n_reads_amplicons=np.zeros(df_template.shape[0],dtype=int)
+
+    if paired_end:
+        #the pairs are assigned with the k-mers of both mates, separated by Ns so no k-mer spans the two mates
+        df_template['Demultiplexed_fastq_r2.gz_filename']=[_jp('AMPL_%s_r2.fastq.gz' % slugify(amplicon_name)) for amplicon_name in df_template.index]
+        amplicon_handles_r2=[gzip.open(fastq_filename,'w+') for fastq_filename in df_template['Demultiplexed_fastq_r2.gz_filename']]
+        mates_separator='N'*args.amplicon_assignment_kmer_size
+        reads=itertools.izip(read_fastq(processed_output_filename[0],full_header=True),read_fastq(processed_output_filename[1],full_header=True))
+    else:
+        reads=((read,None) for read in read_fastq(processed_output_filename,full_header=True))
+
+    #most of the reads are identical, we assign each unique sequence only once
+    sequence_assignments={}
+    for (read_header,read_seq,read_qual),read_r2 in reads:
+        assignment_seq=read_seq if read_r2 is None else read_seq+mates_separator+read_r2[1]
+        if assignment_seq not in sequence_assignments:
+            sequence_assignments[assignment_seq]=amplicon_index.assign(assignment_seq)
+
+        idx_amplicon=sequence_assignments[assignment_seq]
+        if idx_amplicon is not None:
+            #the full header is kept, it may contain the UMI
+            amplicon_handles[idx_amplicon].write('@%s\n%s\n+\n%s\n' % (read_header,read_seq,read_qual))
+            if read_r2 is not None:
+                amplicon_handles_r2[idx_amplicon].write('@%s\n%s\n+\n%s\n' % read_r2)
+            n_reads_amplicons[idx_amplicon]+=1
+
+    for amplicon_handle in amplicon_handles+(amplicon_handles_r2 if paired_end else []):
+        amplicon_handle.close()
+
+    del sequence_assignments
+
+    N_READS_ASSIGNED=n_reads_amplicons.sum()
+    df_template['n_reads']=n_reads_amplicons
+    df_template['n_reads_assigned_%']=df_template['n_reads']/float(max(1,N_READS_ASSIGNED))*100
+    df_template.to_csv(_jp('REPORT_READS_ASSIGNED_TO_AMPLICONS.txt'),sep='\t')
+    info('%d/%d reads assigned to the amplicons.' % (N_READS_ASSIGNED,N_READS_AFTER_PREPROCESSING))
+
+    quantification_summary=[]
+    amplicon_results={}
+    for idx,row in df_template.iterrows():
+
+        if row.n_reads==0:
+            warn('Skipping amplicon [%s] since no reads are assigned to it\n'% idx)
+            quantification_summary.append([idx,np.nan,np.nan,np.nan,np.nan,np.nan,row.n_reads])
+            amplicon_results[idx]=None
+            continue
+
+        info('\n Processing:%s' % idx)
+
+        #the reads are already preprocessed
+        amplicon_args=argparse.Namespace(**vars(args))
+        amplicon_args.amplicons_file=''
+        amplicon_args.amplicon_seq=row.Amplicon_Sequence
+        amplicon_args.guide_seq=row.sgRNA
+        amplicon_args.expected_hdr_amplicon_seq=row.Expected_HDR
+        amplicon_args.coding_seq=row.Coding_sequence
+        amplicon_args.donor_seq=''
+        amplicon_args.name=idx
+        amplicon_args.output_folder=OUTPUT_DIRECTORY
+        amplicon_args.fastq_r1=row['Demultiplexed_fastq.gz_filename']
+        amplicon_args.fastq_r2=row['Demultiplexed_fastq_r2.gz_filename'] if paired_end else ''
+        amplicon_args.split_paired_end=False
+        amplicon_args.trim_sequences=False
+        amplicon_args.min_average_read_quality=0
+        amplicon_args.min_single_bp_quality=0
+
+        try:
+            amplicon_results[idx]=run_crispresso(amplicon_args)
+            quantification_summary.append([idx]+amplicon_results[idx].get_percentages()+[amplicon_results[idx].n_aligned,row.n_reads])
+
+        except Exception as e:
+            warn('Skipping amplicon [%s], the analysis failed: %s' % (idx,e))
+            quantification_summary.append([idx,np.nan,np.nan,np.nan,np.nan,np.nan,row.n_reads])
+            amplicon_results[idx]=None
+
+    df_summary_quantification=pd.DataFrame(quantification_summary,columns=['Name','Unmodified%','NHEJ%','HDR%', 'Mixed_HDR-NHEJ%','Reads_aligned','Reads_total'])
+    df_summary_quantification.fillna('NA').to_csv(_jp('SAMPLES_QUANTIFICATION_SUMMARY.txt'),sep='\t',index=None)
+
+    with open(_jp('Mapping_statistics.txt'),'w+') as outfile:
+        outfile.write('READS IN INPUTS:%d\nREADS AFTER PREPROCESSING:%d\nREADS ASSIGNED TO AMPLICONS:%d' % (N_READS_INPUT,N_READS_AFTER_PREPROCESSING,N_READS_ASSIGNED))
+
+    if not args.keep_intermediate:
+        info('Removing Intermediate files...')
+
+        demultiplexed_files=list(df_template['Demultiplexed_fastq.gz_filename'])
+        if paired_end:
+            demultiplexed_files+=list(df_template['Demultiplexed_fastq_r2.gz_filename'])
+
+        for file_to_remove in preprocessing_files_to_remove+demultiplexed_files:
+            try:
+                    if os.path.islink(file_to_remove):
+                        os.unlink(file_to_remove)
+                    else:
+                        os.remove(file_to_remove)
+            except:
+                    warn('Skipping:%s' %file_to_remove)
+
+    info('All Done!')
+
+    return CRISPRessoResult(OUTPUT_DIRECTORY,amplicon_results=amplicon_results)
+
+
+###API###################################
+
+class CRISPRessoResult(object):
+    '''
+    The result of a run: the output folder (absolute path) and the number of aligned reads of each class. The numbers of reads are None
+    for the runs that do not classify the reads (--quick_estimate and requantify --sweep). For a run on an amplicons
+    file (-f) amplicon_results has the result of each amplicon, None for the amplicons skipped or failed.
+    '''
+    def __init__(self,output_directory,n_unmodified=None,n_nhej=None,n_hdr=None,n_mixed_hdr_nhej=None,n_aligned=None,amplicon_results=None):
+        self.output_directory=os.path.abspath(output_directory)
+        self.n_unmodified=None if n_unmodified is None else int(n_unmodified)
+        self.n_nhej=None if n_nhej is None else int(n_nhej)
+        self.n_hdr=None if n_hdr is None else int(n_hdr)
+        self.n_mixed_hdr_nhej=None if n_mixed_hdr_nhej is None else int(n_mixed_hdr_nhej)
+        self.n_aligned=None if n_aligned is None else int(n_aligned)
+        self.amplicon_results=amplicon_results
+
+    def get_percentages(self):
+        '''
+        The % of the aligned reads that are unmodified, NHEJ, HDR and mixed HDR-NHEJ
+        '''
+        if not self.n_aligned:
+            return [np.nan,np.nan,np.nan,np.nan]
+
+        return [n_reads*100.0/self.n_aligned for n_reads in [self.n_unmodified,self.n_nhej,self.n_hdr,self.n_mixed_hdr_nhej]]
+
+    def __repr__(self):
+        return 'CRISPRessoResult(output_directory=%r, n_unmodified=%r, n_nhej=%r, n_hdr=%r, n_mixed_hdr_nhej=%r, n_aligned=%r)' % \
+               (self.output_directory,self.n_unmodified,self.n_nhej,self.n_hdr,self.n_mixed_hdr_nhej,self.n_aligned)
+
+
+def get_crispresso_args(config):
+    '''
+    The arguments of a run from config, a dict (or an argparse.Namespace) with the CRISPResso options by their long
+    name. The options not in config take their default value.
+    '''
+    if isinstance(config,argparse.Namespace):
+        config=vars(config)
+
+    if not config.get('fastq_r1'):
+        raise BadParameterException('Please provide the first fastq file (fastq_r1)')
+
+    args=get_crispresso_parser().parse_args(['-r1',config['fastq_r1']])
+
+    unknown_options=set(config)-set(vars(args))
+    if unknown_options:
+        raise BadParameterException('Unknown CRISPResso options: %s' % ', '.join(sorted(unknown_options)))
+
+    for option,value in config.items():
+        setattr(args,option,value)
+
+    if args.amplicons_file and args.quick_estimate:
+        raise BadParameterException('The option --quick_estimate is available only for a single amplicon (-a)')
+    elif not args.amplicons_file and not args.amplicon_seq:
+        raise BadParameterException('Please provide the amplicon sequence (-a) or an amplicons description file (-f)')
+
+    return args
+
+
+def run_crispresso(config):
+    '''
+    Run CRISPResso in this process and return a CRISPRessoResult. config is a dict (or an argparse.Namespace) with the
+    options by their long name, for example {'fastq_r1':'reads.fastq.gz','amplicon_seq':'CGGATG...','guide_seq':'...'},
+    the options not in config take their default value. The errors are raised as exceptions.
+    '''
+    args=get_crispresso_args(config)
+
+    #the log files opened by the run are closed at its end, so that many runs can be executed in the same process
+    root_logger=logging.getLogger()
+    log_handlers=list(root_logger.handlers)
+
+    try:
+        if args.amplicons_file:
+            return run_crispresso_on_amplicons(args)
+        else:
+            return run_crispresso_analysis(args)
+    finally:
+        for log_handler in root_logger.handlers[:]:
+            if log_handler not in log_handlers:
+                root_logger.removeHandler(log_handler)
+                log_handler.close()
+
+
+def run_crispresso_worker(job,result_connection):
+    #the log files of the parent process are not shared with the run
+    root_logger=logging.getLogger()
+    for log_handler in root_logger.handlers[:]:
+        if isinstance(log_handler,logging.FileHandler):
+            root_logger.removeHandler(log_handler)
+
+    #the options are a config or, for the jobs of CRISPResso serve, the command line options parsed in the job folder
+    try:
+        if 'cwd' in job:
+            os.chdir(job['cwd'])
+        config=job['config'] if 'config' in job else get_crispresso_parser().parse_args(job['argv'])
+        job_outcome=('done',run_crispresso(config),None,0)
+    except SystemExit as e:
+        job_outcome=('failed',None,'CRISPResso exited with code %s' % e.code,e.code) #a library or a program is missing, the error was already reported
+    except Exception as e:
+        error('The CRISPResso analysis failed: %s' % e)
+        job_outcome=('failed',None,'%s: %s' % (type(e).__name__,e),get_exit_code(e))
+
+    result_connection.send(job_outcome)
+    result_connection.close()
+
+
+class CRISPRessoJobScheduler(object):
+    '''
+    Run CRISPResso jobs in worker processes, up to max_jobs at the same time and in the order they are submitted. A
+    job is a dict with the config of run_crispresso (or the argv and cwd of a command line). The workers are forked
+    from this process, so the libraries already imported are reused, and are not daemonic, so each job can use its
+    own processes (-p). The outcome of a job is a (status,result,error,exit_code) tuple, the status is done or failed
+    and the exit code is the one CRISPResso would have exited with.
+    '''
+    def __init__(self,max_jobs=1):
+        self.max_jobs=max_jobs
+        self.queued_jobs=[]
+        self.running_jobs={}
+        self.job_outcomes={}
+
+    def submit(self,job_id,job):
+        '''
+        Queue a job and update the jobs, returns the ids of the jobs ended as update
+        '''
+        self.queued_jobs.append((job_id,job))
+        return self.update()
+
+    def update(self):
+        '''
+        Collect the outcomes of the jobs ended and start the queued jobs, returns the ids of the jobs ended
+        '''
+        ended_job_ids=[]
+        for job_id,(process,result_connection) in self.running_jobs.items():
+            if not result_connection.poll() and process.is_alive():
+                continue
+
+            #the worker may send its outcome and exit between the two checks, so the pipe is checked again
+            job_outcome=None
+            if result_connection.poll():
+                try:
+                    job_outcome=result_connection.recv()
+                except EOFError: #the process ended without sending the outcome
+                    pass
+
+            process.join()
+            if job_outcome is None:
+                job_outcome=('failed',None,'The worker process ended with exit code %s' % process.exitcode,process.exitcode)
+            result_connection.close()
+            del self.running_jobs[job_id]
+            self.job_outcomes[job_id]=job_outcome
+            ended_job_ids.append(job_id)
+
+        while self.queued_jobs and len(self.running_jobs)<self.max_jobs:
+            job_id,job=self.queued_jobs.pop(0)
+            result_connection,worker_connection=mp.Pipe(duplex=False)
+            process=mp.Process(target=run_crispresso_worker,args=(job,worker_connection))
+            process.start()
+            worker_connection.close()
+            self.running_jobs[job_id]=(process,result_connection)
+
+        return ended_job_ids
+
+    def get_status(self,job_id):
+        if job_id in self.job_outcomes:
+            return self.job_outcomes[job_id][0]
+        elif job_id in self.running_jobs:
+            return 'running'
+        else:
+            return 'queued'
+
+    def wait(self,poll_interval=0.1):
+        '''
+        Wait for all the jobs submitted, returns the outcomes of the jobs
+        '''
+        self.update()
+        while self.queued_jobs or self.running_jobs:
+            time.sleep(poll_interval)
+            self.update()
+
+        return self.job_outcomes
+
+    def terminate(self):
+        self.queued_jobs=[]
+        for job_id,(process,result_connection) in self.running_jobs.items():
+            process.terminate()
+            process.join()
+            self.job_outcomes[job_id]=('failed',None,'The job was stopped',process.exitcode)
+        self.running_jobs={}
+
+
+def run_crispresso_in_process(config):
+    '''
+    Run run_crispresso(config) in a new process and return its outcome (status,result,error_message,exit_code): the
+    status is 'done' with the CRISPRessoResult as result, or 'failed' with the error and the exit code of the run. The
+    process is forked from this one, so the libraries already imported are reused, and the state of the run (global
+    variables, figures and log files) is discarded at its end.
+    '''
+    scheduler=CRISPRessoJobScheduler()
+    scheduler.submit(0,{'config':config})
+
+    return scheduler.wait()[0]
+
+
+###SERVER################################
+
+DEFAULT_SERVER_SOCKET=os.path.join(tempfile.gettempdir(),'CRISPResso_server.sock')
+
+def get_result_data(result):
+    '''
+    The content of a CRISPRessoResult as a dict that can be sent as JSON
+    '''
+    result_data=dict(vars(result))
+    if result.amplicon_results is not None:
+        result_data['amplicon_results']=dict([(amplicon_name,None if amplicon_result is None else get_result_data(amplicon_result))
+                                              for amplicon_name,amplicon_result in result.amplicon_results.items()])
+    return result_data
+
+
+def parse_serve_args(argv):
+    serve_parser = argparse.ArgumentParser(prog='CRISPResso serve',
+                                           description='Run a CRISPResso server that keeps the libraries loaded and runs the jobs sent with CRISPResso submit, each job in its own worker process.',
+                                           formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    serve_parser.add_argument('--socket', type=str, help='Unix socket where the server accepts the jobs', default=DEFAULT_SERVER_SOCKET)
+    serve_parser.add_argument('--max_jobs', type=int, help='Maximum number of jobs running at the same time', default=mp.cpu_count())
+    serve_parser.add_argument('--request_timeout', type=float, help='Seconds to wait for the request of a client, after that the connection is closed', default=10.0)
+    serve_parser.add_argument('--job_expiration', type=float, help='Seconds the status and the result of a job are kept after it ends', default=3600.0)
+
+    return serve_parser.parse_args(argv)
+
+
+def serve(args):
+    '''
+    Accept the requests of CRISPResso submit on a Unix socket, one JSON object per line. The jobs run in worker
+    processes forked after the libraries are imported, up to --max_jobs at the same time.
+    '''
+    if os.path.exists(args.socket):
+        raise ServerException('The socket %s already exists, if no other CRISPResso server is running please remove it.' % args.socket)
+
+    #the workers are forked from this process with the libraries already imported and needle already checked
+    info('Loading the libraries...')
+    for library in [pd,SeqIO,pairwise2,CRISPRessoPlot]:
+        library.import_library()
+    check_program('needle')
+
+    server_socket=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    server_socket.bind(args.socket)
+    server_socket.listen(128)
+    #the jobs are started and collected also when no requests arrive
+    server_socket.settimeout(0.5)
+
+    scheduler=CRISPRessoJobScheduler(args.max_jobs)
+    jobs={}
+    job_ids=itertools.count(1)
+
+    def get_job(job_id):
+        job=dict(jobs[job_id])
+        job['status']=scheduler.get_status(job_id)
+        if job_id in scheduler.job_outcomes:
+            status,result,job['error'],job['exit_code']=scheduler.job_outcomes[job_id]
+            job['result']=None if result is None else get_result_data(result)
+        return job
+
+    #the jobs can end in any update of the scheduler, also in the one of a submit
+    def record_ended_jobs(ended_job_ids):
+        for job_id in ended_job_ids:
+            info('Job %d %s' % (job_id,scheduler.get_status(job_id)))
+            jobs[job_id]['end_time']=time.time()
+
+    info('CRISPResso server listening on %s, running up to %d jobs at the same time' % (args.socket,args.max_jobs))
+
+    try:
+        running=True
+        while running:
+            record_ended_jobs(scheduler.update())
+
+            #the jobs ended are forgotten after a while, so that the memory used by the server does not grow
+            for job_id in [job_id for job_id,job in jobs.items() if job['end_time'] is not None and time.time()-job['end_time']>args.job_expiration]:
+                del jobs[job_id]
+                del scheduler.job_outcomes[job_id]
+
+            try:
+                connection,_=server_socket.accept()
+            except socket.timeout:
+                continue
+
+            #a client that does not send its request cannot block the server
+            connection.settimeout(args.request_timeout)
+            connection_file=connection.makefile('rw')
+            try:
+                request=json.loads(connection_file.readline())
+
+                if request['command']=='submit':
+                    job_id=next(job_ids)
+                    jobs[job_id]={'job_id':job_id,'argv':request['argv'],'cwd':request['cwd'],'result':None,'error':None,'exit_code':None,'submit_time':time.time(),'end_time':None}
+                    record_ended_jobs(scheduler.submit(job_id,{'argv':request['argv'],'cwd':request['cwd']}))
+                    info('Job %d submitted: CRISPResso %s' % (job_id,' '.join(request['argv'])))
+                    response={'job_id':job_id}
+                elif request['command']=='status':
+                    if request.get('job_id') is None:
+                        response={'jobs':[dict([(key,job[key]) for key in ['job_id','status','submit_time']]) for job in map(get_job,sorted(jobs))]}
+                    elif request['job_id'] in jobs:
+                        response={'job':get_job(request['job_id'])}
+                    else:
+                        response={'error':'Unknown job %s' % request['job_id']}
+                elif request['command']=='shutdown':
+                    response={'n_jobs_pending':len(scheduler.queued_jobs)+len(scheduler.running_jobs)}
+                    running=False
+                else:
+                    response={'error':'Unknown command %s' % request['command']}
+            except socket.timeout:
+                warn('No request received from the client in %.1f seconds, closing the connection' % args.request_timeout)
+                response={'error':'No request received in %.1f seconds' % args.request_timeout}
+            except Exception as e:
+                response={'error':'Invalid request: %s' % e}
+
+            try:
+                connection_file.write(json.dumps(response)+'\n')
+                connection_file.flush()
+            except socket.error:
+                warn('The client disconnected before the response was sent')
+            finally:
+                connection_file.close()
+                connection.close()
+
+        info('Waiting for the jobs submitted...')
+        scheduler.wait()
+    except KeyboardInterrupt:
+        info('Stopping the running jobs...')
+        scheduler.terminate()
+    finally:
+        server_socket.close()
+        os.remove(args.socket)
+
+    info('CRISPResso server stopped.')
+
+
+def send_server_request(socket_filename,request):
+    client_socket=socket.socket(socket.AF_UNIX,socket.SOCK_STREAM)
+    try:
+        client_socket.connect(socket_filename)
+    except socket.error as e:
+        raise ServerException('Cannot connect to a CRISPResso server on %s (%s), please start it with: CRISPResso serve --socket %s' % (socket_filename,e,socket_filename))
+
+    connection_file=client_socket.makefile('rw')
+    try:
+        connection_file.write(json.dumps(request)+'\n')
+        connection_file.flush()
+        response=json.loads(connection_file.readline())
+    finally:
+        connection_file.close()
+        client_socket.close()
+
+    if 'error' in response:
+        raise ServerException(response['error'])
+
+    return response
+
+
+def parse_submit_args(argv):
+    submit_parser = argparse.ArgumentParser(prog='CRISPResso submit',
+                                            description='Send a job to a CRISPResso server started with CRISPResso serve and wait for it. The other options are the usual CRISPResso options, for example: CRISPResso submit -r1 reads.fastq.gz -a AMPLICON -g SGRNA',
+                                            formatter_class=argparse.ArgumentDefaultsHelpFormatter)
+    submit_parser.add_argument('--socket', type=str, help='Unix socket of the CRISPResso server', default=DEFAULT_SERVER_SOCKET)
+    submit_parser.add_argument('--no_wait',help='Return after the job is submitted, without waiting for it',action='store_true')
+    submit_parser.add_argument('--poll_interval', type=float, help='Seconds between two checks of the status of the job', default=1.0)
+    submit_parser.add_argument('--status', type=int, help='Report the status of the job with this id, instead of submitting a job', nargs='?', const=-1, default=None)
+
+    submit_parser.add_argument('--shutdown',help='Stop the server, the jobs running are completed first',action='store_true')
+
+    submit_args,crispresso_argv=submit_parser.parse_known_args(argv)
+
+    if submit_args.status is None and not submit_args.shutdown:
+        #the options are checked here, so that the errors are reported to the user and not by the server
+        get_crispresso_args(get_crispresso_parser().parse_args(crispresso_argv))
+
+    return submit_args,crispresso_argv
+
+
+def report_job(job):
+    info('Job %d: %s' % (job['job_id'],job['status']))
+    if job['status']=='done':
+        result=job['result']
+        info('Output folder: %s' % result['output_directory'])
+        if result['n_aligned'] is not None:
+            info('Reads aligned:%d, Unmodified:%d, NHEJ:%d, HDR:%d, Mixed HDR-NHEJ:%d' % (result['n_aligned'],result['n_unmodified'],result['n_nhej'],
+                                                                                          result['n_hdr'],result['n_mixed_hdr_nhej']))
+    elif job['status']=='failed':
+        info('Error: %s' % job['error'])
+
+
+def submit(args,crispresso_argv):
+    '''
+    Send a job to a CRISPResso server and wait for it, or report the status of the jobs with --status and stop the
+    server with --shutdown
+    '''
+    if args.status is not None:
+        if args.status==-1:
+            for job in send_server_request(args.socket,{'command':'status'})['jobs']:
+                info('Job %d: %s' % (job['job_id'],job['status']))
+        else:
+            report_job(send_server_request(args.socket,{'command':'status','job_id':args.status})['job'])
+        return
+
+    if args.shutdown:
+        n_jobs_pending=send_server_request(args.socket,{'command':'shutdown'})['n_jobs_pending']
+        info('The CRISPResso server on %s will stop after the %d jobs submitted' % (args.socket,n_jobs_pending))
+        return
+
+    job_id=send_server_request(args.socket,{'command':'submit','argv':crispresso_argv,'cwd':os.getcwd()})['job_id']
+    info('Submitted job %d to the CRISPResso server on %s' % (job_id,args.socket))
+
+    if args.no_wait:
+        return
+
+    job=send_server_request(args.socket,{'command':'status','job_id':job_id})['job']
+    while job['status'] in ['queued','running']:
+        time.sleep(args.poll_interval)
+        job=send_server_request(args.socket,{'command':'status','job_id':job_id})['job']
+
+    report_job(job)
+
+    #the command fails with the exit code of the job, as if CRISPResso was run directly
+    if job['status']=='failed':
+        error('The job %d failed: %s' % (job_id,job['error']))
+        sys.exit(job['exit_code'])
+
+
+def main():
+    try:
+             startup_time=time.time()-_START_TIME
+
+             print '  \n~~~CRISPResso~~~'
+             print '-Analysis of CRISPR/Cas9 outcomes from deep sequencing data-'
+             print'''
+                      )
+                     (
+                    __)__
+                 C\|     |
+                   \     /
+                    \___/
+             '''
+             print'\n[Luca Pinello 2015, send bugs, suggestions or *green coffee* to lucapinello AT gmail DOT com]\n\n',
+
+
+             print 'Version %s\n' % __version__
+
+             def print_stacktrace_if_debug():
+                debug_flag = False
+                if 'args' in globals() and 'debug' in args:
+                    debug_flag = args.debug
+
+                if debug_flag:
+                    traceback.print_exc(file=sys.stdout)
+
+
+             global args
+
+             if len(sys.argv)>1 and sys.argv[1]=='requantify':
+                 args,df_alignments,run_info,sweep_parameter_names,sweep_parameter_sets=parse_requantify_args(sys.argv[2:])
+                 run_crispresso_analysis(args,df_alignments,run_info,sweep_parameter_names,sweep_parameter_sets)
+             elif len(sys.argv)>1 and sys.argv[1]=='replot':
+                 args,plot_data=parse_replot_args(sys.argv[2:])
+                 replot(args,plot_data)
+             elif len(sys.argv)>1 and sys.argv[1]=='serve':
+                 args=parse_serve_args(sys.argv[2:])
+                 serve(args)
+             elif len(sys.argv)>1 and sys.argv[1]=='submit':
+                 args,crispresso_argv=parse_submit_args(sys.argv[2:])
+                 submit(args,crispresso_argv)
+             else:
+                 args=get_crispresso_parser().parse_args()
+                 run_crispresso(args)
+
+             if getattr(args,'debug',False):
+                 info('Startup time: %.2f seconds, time to import the libraries used by the run: %s' % (startup_time,
+                      ', '.join(['%s %.2f seconds' % (library_name,import_time) for library_name,import_time in sorted(LIBRARY_IMPORT_TIMES.items())]) or 'none'))
+
              print'''
                   )
                  (
@@ -2483,6 +4053,30 @@ def main():
          print_stacktrace_if_debug()
          error('Filtering error, please check your input.\n\nERROR: %s' % e)
          sys.exit(13)
+    except RequantifyException as e:
+         print_stacktrace_if_debug()
+         error('Requantification error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(14)
+    except UMIException as e:
+         print_stacktrace_if_debug()
+         error('UMI error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(15)
+    except SamtoolsException as e:
+         print_stacktrace_if_debug()
+         error('Samtools error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(16)
+    except ReplotException as e:
+         print_stacktrace_if_debug()
+         error('Replot error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(17)
+    except BadParameterException as e:
+         print_stacktrace_if_debug()
+         error('Parameter error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(18)
+    except ServerException as e:
+         print_stacktrace_if_debug()
+         error('Server error, please check your input.\n\nERROR: %s' % e)
+         sys.exit(19)
     except Exception as e:
          print_stacktrace_if_debug()
          error('Unexpected error, please check your input.\n\nERROR: %s' % e)
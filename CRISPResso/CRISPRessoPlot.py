@@ -0,0 +1,697 @@
+#!/usr/bin/env python
+# -*- coding: utf8 -*-
+
+'''
+CRISPResso - Luca Pinello 2015
+Software pipeline for the analysis of CRISPR-Cas9 genome editing outcomes from deep sequencing data
+https://github.com/lucapinello/CRISPResso
+
+Figures of a CRISPResso run. Each figure is drawn by a function from precomputed plot data, the figures
+are independent so they can be rendered in parallel by render_figures.
+'''
+
+import os
+import re
+from collections import defaultdict
+import multiprocessing as mp
+
+import matplotlib
+matplotlib.use('Agg')
+font = {'size'   : 22}
+matplotlib.rc('font', **font)
+
+import matplotlib.pyplot as plt
+from matplotlib import font_manager as fm
+from matplotlib import colors as colors_mpl
+import matplotlib.gridspec as gridspec
+
+import numpy as np
+import seaborn as sns
+sns.set_context('poster')
+sns.set(font_scale=2.2)
+sns.set_style('white')
+
+
+#figures rendered with --plot_level summary, the other figures are rendered only with --plot_level full
+SUMMARY_FIGURES=['1a','2','4a','5']
+PLOT_LEVELS=['none','summary','full']
+
+
+def save_figure(fig,output_root,formats,**savefig_kwargs):
+    '''
+    Save a figure drawn once in each format (pdf, png...) as output_root.<format> and free it.
+    '''
+    for output_format in formats:
+        fig.savefig('%s.%s' % (output_root,output_format),**savefig_kwargs)
+    plt.close(fig)
+
+def plot_cut_points_and_sgRNAs(ax,cut_points,offset_plots,sgRNA_intervals,y_max):
+    for idx,cut_point in enumerate(cut_points):
+        ax.plot([cut_point+offset_plots[idx],cut_point+offset_plots[idx]],[0,y_max],'--k',lw=2,label='Predicted cleavage position' if idx==0 else '_nolegend_')
+
+    for idx,sgRNA_int in enumerate(sgRNA_intervals):
+        ax.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA' if idx==0 else '_nolegend_',solid_capstyle='butt')
+
+def get_amplicon_xticks(len_amplicon):
+    return np.arange(0,len_amplicon,max(3,(len_amplicon/6) - (len_amplicon/6)%5)).astype(int)
+
+
+###FIGURES###############################
+
+def plot_indel_size_distribution(hdensity,hlengths,center_index,xmin,xmax,percentage,output_root,formats):
+    #1a: number of sequences, 1b: percentage of sequences
+    if percentage:
+        hdensity=hdensity/(float(hdensity.sum()))*100.0
+
+    fig=plt.figure(figsize=(8.3,8))
+    plt.bar(0,hdensity[center_index],color='red',linewidth=0)
+    barlist=plt.bar(hlengths,hdensity,align='center',linewidth=0)
+    barlist[center_index].set_color('r')
+    plt.xlim([xmin,xmax])
+    plt.title('Indel size distribution')
+    plt.xlabel('Indel size (bp)')
+
+    if percentage:
+        plt.ylabel('Sequences (%)')
+    else:
+        plt.ylabel('Sequences (no.)')
+        plt.ylim([0,hdensity.max()*1.2])
+
+    lgd=plt.legend(['No indel','Indel'],loc='center', bbox_to_anchor=(0.5, -0.22),ncol=1, fancybox=True, shadow=True)
+    lgd.legendHandles[0].set_height(3)
+    lgd.legendHandles[1].set_height(3)
+
+    save_figure(fig,output_root,formats,bbox_inches='tight')
+
+def plot_editing_pie_chart(n_unmodified,n_modified,n_repaired,n_mixed_hdr_nhej,n_total,expected_hdr,len_amplicon,
+                           cut_points,offset_plots,sgRNA_intervals,donor_interval,output_root,formats):
+    fig=plt.figure(figsize=(12*1.5,14.5*1.5))
+    ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
+
+    if expected_hdr:
+        patches, texts, autotexts =ax1.pie([n_unmodified,n_mixed_hdr_nhej,n_modified,n_repaired],\
+                                          labels=['Unmodified\n(%d reads)' %n_unmodified,\
+                                                  'Mixed HDR-NHEJ\n(%d reads)' %n_mixed_hdr_nhej,
+                                                  'NHEJ\n(%d reads)' % n_modified, \
+                                                  'HDR\n(%d reads)' %n_repaired,
+                                                  ],\
+                                          explode=(0,0,0,0),\
+                                          colors=[(1,0,0,0.2),(0,1,1,0.2),(0,0,1,0.2),(0,1,0,0.2)],autopct='%1.1f%%')
+
+        if cut_points or donor_interval:
+            ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+            ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+
+            if donor_interval:
+                ax2.plot(donor_interval,[0,0],'-',lw=10,c=(0,1,0,0.5),label='Donor Sequence')
+
+            if cut_points:
+                ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=24,label='Predicted Cas9 cleavage site/s')
+
+            for idx,sgRNA_int in enumerate(sgRNA_intervals):
+                ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA' if idx==0 else '_nolegend_')
+
+            plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
+            plt.xlim(0,len_amplicon)
+            plt.axis('off')
+    else:
+        patches, texts, autotexts =ax1.pie([n_unmodified/n_total*100,n_modified/n_total*100],\
+                                          labels=['Unmodified\n(%d reads)' %n_unmodified,\
+                                                  'NHEJ\n(%d reads)' % n_modified],\
+                                          explode=(0,0),colors=[(1,0,0,0.2),(0,0,1,0.2)],autopct='%1.1f%%')
+
+        if cut_points:
+            ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+            ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+
+            for idx,sgRNA_int in enumerate(sgRNA_intervals):
+                ax2.plot([sgRNA_int[0],sgRNA_int[1]],[0,0],lw=10,c=(0,0,0,0.15),label='sgRNA' if idx==0 else '_nolegend_',solid_capstyle='butt')
+
+            ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=12,label='Predicted Cas9 cleavage site/s')
+            plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1,prop={'size':'large'})
+            plt.xlim(0,len_amplicon)
+            plt.axis('off')
+
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+
+    save_figure(fig,output_root,formats,pad_inches=1,bbox_inches='tight')
+
+def plot_indel_size_histograms(x_bins_ins,y_values_ins,x_bins_del,y_values_del,x_bins_mut,y_values_mut,n_total,output_root,formats):
+    fig=plt.figure(figsize=(26,6.5))
+
+    #insertions and substitutions are positive, deletions negative
+    for idx_plot,(x_values,y_values,title,xlabel,legend) in enumerate([(x_bins_ins[:-1],y_values_ins,'Insertions','Size (bp)',['Non-insertion','Insertion']),
+                                                                      (-x_bins_del[:-1],y_values_del,'Deletions','Size (bp)',['Non-deletion','Deletion']),
+                                                                      (x_bins_mut[:-1],y_values_mut,'Substitutions','Positions substituted (number)',['Non-substitution','Substitution'])]):
+        ax=fig.add_subplot(1,3,idx_plot+1)
+        #the bars are drawn twice, the first time for the legend entry of the events
+        ax.bar(x_values,y_values,align='center',linewidth=0,color=(0,0,1))
+        barlist=ax.bar(x_values,y_values,align='center',linewidth=0,color=(0,0,1))
+        barlist[0].set_color('r')
+        plt.title(title)
+        plt.xlabel(xlabel)
+        plt.ylabel('Sequences % (no.)')
+        lgd=plt.legend(legend[::-1], bbox_to_anchor=(.82, -0.22),ncol=1, fancybox=True, shadow=True)
+        lgd.legendHandles[0].set_height(6)
+        lgd.legendHandles[1].set_height(6)
+
+        if title=='Deletions':
+            plt.xlim(xmax=1)
+        else:
+            plt.xlim(xmin=-1)
+
+        y_label_values= np.round(np.linspace(0, min(n_total,max(ax.get_yticks())),6))
+        plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/n_total*100,n_reads) for n_reads in y_label_values])
+
+    plt.tight_layout()
+
+    save_figure(fig,output_root,formats,bbox_inches='tight')
+
+def plot_combined_mutation_locations(effect_vector_any,len_amplicon,n_total,cut_points,offset_plots,sgRNA_intervals,output_root,formats):
+    fig=plt.figure(figsize=(10,10))
+    y_max=max(effect_vector_any)*1.2
+
+    plt.plot(effect_vector_any,'r',lw=3,label='Combined Insertions/Deletions/Substitutions')
+    plot_cut_points_and_sgRNAs(plt.gca(),cut_points,offset_plots,sgRNA_intervals,y_max)
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.23),ncol=1, fancybox=True, shadow=True)
+    y_label_values = np.arange(0,1,1.0/6.0)
+    if y_max > 0:
+        y_label_values=np.arange(0,y_max,y_max/6.0)
+    plt.yticks(y_label_values,['%.1f%% (%d)' % (n_reads/float(n_total)*100, n_reads) for n_reads in y_label_values])
+    plt.xticks(get_amplicon_xticks(len_amplicon))
+
+    plt.title('Mutation position distribution')
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylabel('Sequences % (no.)')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+
+    save_figure(fig,output_root,formats,bbox_extra_artists=(lgd,), bbox_inches='tight')
+
+def plot_mutation_locations(effect_vector_insertion,effect_vector_deletion,effect_vector_mutation,len_amplicon,n_total,n_class,class_label,title,
+                            cut_points,offset_plots,sgRNA_intervals,output_root,formats):
+    '''
+    Insertions, deletions and substitutions by amplicon position for the reads of a class (NHEJ, HDR, mixed HDR-NHEJ),
+    with class_label None the y axis reports the number of reads (noncoding mutations).
+    '''
+    fig=plt.figure(figsize=(10,10))
+    plt.plot(effect_vector_insertion,'r',lw=3,label='Insertions')
+    plt.plot(effect_vector_deletion,'m',lw=3,label='Deletions')
+    plt.plot(effect_vector_mutation,'g',lw=3,label='Substitutions')
+
+    y_max=max(max(effect_vector_insertion),max(effect_vector_deletion),max(effect_vector_mutation))*1.2
+    plot_cut_points_and_sgRNAs(plt.gca(),cut_points,offset_plots,sgRNA_intervals,y_max)
+
+    lgd=plt.legend(loc='center', bbox_to_anchor=(0.5, -0.28),ncol=1, fancybox=True, shadow=True)
+
+    if class_label:
+        y_label_values = np.arange(0,1,1.0/6.0)
+        if y_max > 0:
+            y_label_values=np.arange(0,y_max,y_max/6.0)
+        plt.yticks(y_label_values,['%.1f%% (%.1f%% , %d)' % (n_reads/float(n_total)*100,n_reads/float(n_class)*100, n_reads) for n_reads in y_label_values])
+        plt.ylabel('Sequences: %% Total ( %% %s, no. )' % class_label)
+    else:
+        plt.ylabel('Sequences (no.)')
+
+    plt.xticks(get_amplicon_xticks(len_amplicon))
+    plt.xlabel('Reference amplicon position (bp)')
+    plt.ylim(0,max(1,y_max))
+    plt.xlim(xmax=len_amplicon-1)
+    plt.title(title)
+
+    save_figure(fig,output_root,formats,bbox_extra_artists=(lgd,), bbox_inches='tight')
+
+def plot_position_dependent_indel_size(avg_vector_ins_all,avg_vector_del_all,len_amplicon,cut_points,offset_plots,output_root,formats):
+    fig=plt.figure(figsize=(24,10))
+
+    for idx_plot,(avg_vector,color,ylabel,title) in enumerate([(avg_vector_ins_all,'r','Average insertion length','Position dependent insertion size'),
+                                                              (avg_vector_del_all,'m','Average deletion length','Position dependent deletion size')]):
+        ax=fig.add_subplot(1,2,idx_plot+1)
+        markerline, stemlines, baseline=ax.stem(avg_vector,'r',lw=3,markerfmt="s",markerline=None,s=50)
+        plt.setp(markerline, 'markerfacecolor', color, 'markersize', 8)
+        plt.setp(baseline, 'linewidth', 0)
+        plt.setp(stemlines, 'color', color,'linewidth',3)
+
+        y_max=max(avg_vector)*1.2
+        plot_cut_points_and_sgRNAs(ax,cut_points,offset_plots,[],y_max)
+
+        plt.xticks(get_amplicon_xticks(len_amplicon))
+        plt.xlabel('Reference amplicon position (bp)')
+        plt.ylabel(ylabel)
+        plt.ylim(ymin=0,ymax=max(1,y_max))
+        plt.xlim(xmax=len_amplicon-1)
+        ax.set_title(title)
+        plt.tight_layout()
+
+    save_figure(fig,output_root,formats,bbox_inches='tight')
+
+def plot_frameshift_pie_chart(modified_frameshift,modified_non_frameshift,non_modified_non_frameshift,len_amplicon,exon_intervals,
+                              cut_points,offset_plots,output_root,formats):
+    fig=plt.figure(figsize=(12*1.5,14.5*1.5))
+    ax1 = plt.subplot2grid((6,3), (0, 0), colspan=3, rowspan=5)
+    patches, texts, autotexts =ax1.pie([modified_frameshift,\
+                                       modified_non_frameshift,\
+                                       non_modified_non_frameshift],\
+                                       labels=['Frameshift mutation\n(%d reads)' %modified_frameshift,\
+                                              'In-frame mutation\n(%d reads)' % modified_non_frameshift,\
+                                              'Noncoding mutation\n(%d reads)' %non_modified_non_frameshift],\
+                                       explode=(0.0,0.0,0.0),\
+                                       colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99215686,  0.73333333,  0.51764706,0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
+                                       autopct='%1.1f%%')
+
+    ax2 = plt.subplot2grid((6,3), (5, 0), colspan=3, rowspan=1)
+    ax2.plot([0,len_amplicon],[0,0],'-k',lw=2,label='Amplicon sequence')
+
+    for idx,exon_interval in enumerate(exon_intervals):
+        ax2.plot(exon_interval,[0,0],'-',lw=10,c=(0,0,1,0.5),label='Coding sequence/s' if idx==0 else '_nolegend_',solid_capstyle='butt')
+
+    if cut_points:
+        ax2.plot(cut_points+offset_plots,np.zeros(len(cut_points)),'vr', ms=25,label='Predicted Cas9 cleavage site/s')
+
+    plt.legend(bbox_to_anchor=(0, 0, 1., 0),  ncol=1, mode="expand", borderaxespad=0.,numpoints=1)
+    plt.xlim(0,len_amplicon)
+    plt.axis('off')
+
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+
+    save_figure(fig,output_root,formats,pad_inches=1,bbox_inches='tight')
+
+def plot_frameshift_profiles(hist_frameshift,hist_inframe,output_root,formats):
+    fig=plt.figure(figsize=(22,10))
+
+    for idx_plot,(hist,title,color,xticks) in enumerate([(hist_frameshift,'Frameshift profile',None,[idx for idx in range(-30,31) if idx % 3]),
+                                                        (hist_inframe,'In-frame profile',(0,1,1,0.2),[idx for idx in range(-30,31) if (idx % 3==0)])]):
+        ax=fig.add_subplot(2,1,idx_plot+1)
+        x,y=map(np.array,zip(*[a for a in hist.iteritems()]))
+        y=y/float(sum(hist.values()))*100
+        if color is None:
+            ax.bar(x-0.5,y)
+        else:
+            ax.bar(x-0.5,y,color=color)
+        ax.set_xlim(-30.5,30.5)
+        ax.set_frame_on(False)
+        ax.set_xticks(xticks)
+        ax.tick_params(which='both',bottom='off',top='off',labelbottom='on')
+        ax.yaxis.tick_left()
+        ax.set_xticklabels([str(idx) for idx in xticks],rotation='vertical')
+        plt.title(title)
+        plt.ylabel('%')
+        ax.tick_params(axis='both', which='major', labelsize=32)
+        ax.tick_params(axis='both', which='minor', labelsize=32)
+        plt.tight_layout()
+
+    save_figure(fig,output_root,formats,pad_inches=1,bbox_inches='tight')
+
+def plot_splice_sites_pie_chart(splicing_sites_modified,n_reads,output_root,formats):
+    fig=plt.figure(figsize=(12*1.5,12*1.5))
+    ax=fig.add_subplot(1,1,1)
+    patches, texts, autotexts =ax.pie([splicing_sites_modified,\
+                                      (n_reads - splicing_sites_modified)],\
+                                      labels=['Potential splice sites modified\n(%d reads)' %splicing_sites_modified,\
+                                              'Unmodified\n(%d reads)' % (n_reads- splicing_sites_modified)],\
+                                      explode=(0.0,0),\
+                                      colors=[(0.89019608,  0.29019608,  0.2, 0.8),(0.99607843,  0.90980392,  0.78431373,0.8)],\
+                                      autopct='%1.1f%%')
+    proptease = fm.FontProperties()
+    proptease.set_size('xx-large')
+    plt.setp(autotexts, fontproperties=proptease)
+    plt.setp(texts, fontproperties=proptease)
+
+    save_figure(fig,output_root,formats,pad_inches=1,bbox_inches='tight')
+
+
+###ALLELES TABLE#########################
+
+#We need to customize the seaborn heatmap class and function
+class Custom_HeatMapper(sns.matrix._HeatMapper):
+
+    def __init__(self, data, vmin, vmax, cmap, center, robust, annot, fmt,
+                 annot_kws,per_element_annot_kws,cbar, cbar_kws,
+                 xticklabels=True, yticklabels=True, mask=None):
+
+        super(Custom_HeatMapper, self).__init__(data, vmin, vmax, cmap, center, robust, annot, fmt,
+                 annot_kws, cbar, cbar_kws,
+                 xticklabels, yticklabels, mask)
+
+
+        if annot is not None:
+            if per_element_annot_kws is None:
+                self.per_element_annot_kws=np.empty_like(annot,dtype=np.object)
+                self.per_element_annot_kws[:]=dict()
+            else:
+                self.per_element_annot_kws=per_element_annot_kws
+
+    #add per element dict to syle the annotatiin
+    def _annotate_heatmap(self, ax, mesh):
+        """Add textual labels with the value in each cell."""
+        mesh.update_scalarmappable()
+        xpos, ypos = np.meshgrid(ax.get_xticks(), ax.get_yticks())
+
+
+        for x, y, m, color, val,per_element_dict  in zip(xpos.flat, ypos.flat,
+                                       mesh.get_array(), mesh.get_facecolors(),
+                                       self.annot_data.flat,self.per_element_annot_kws.flat):
+            #print per_element_dict
+            if m is not np.ma.masked:
+                l = sns.utils.relative_luminance(color)
+                text_color = ".15" if l > .408 else "w"
+                annotation = ("{:" + self.fmt + "}").format(val)
+                text_kwargs = dict(color=text_color, ha="center", va="center")
+                text_kwargs.update(self.annot_kws)
+                text_kwargs.update(per_element_dict)
+
+                ax.text(x, y, annotation, **text_kwargs)
+
+
+    #removed the colobar
+    def plot(self, ax, cax, kws):
+        """Draw the heatmap on the provided Axes."""
+        # Remove all the Axes spines
+        sns.utils.despine(ax=ax, left=True, bottom=True)
+
+        # Draw the heatmap
+        mesh = ax.pcolormesh(self.plot_data, vmin=self.vmin, vmax=self.vmax,
+                             cmap=self.cmap, **kws)
+
+        # Set the axis limits
+        ax.set(xlim=(0, self.data.shape[1]), ylim=(0, self.data.shape[0]))
+
+        # Add row and column labels
+        ax.set(xticks=self.xticks, yticks=self.yticks)
+        xtl = ax.set_xticklabels(self.xticklabels)
+        ytl = ax.set_yticklabels(self.yticklabels, rotation="vertical")
+
+        # Possibly rotate them if they overlap
+        plt.draw()
+        if sns.utils.axis_ticklabels_overlap(xtl):
+            plt.setp(xtl, rotation="vertical")
+        if sns.utils.axis_ticklabels_overlap(ytl):
+            plt.setp(ytl, rotation="horizontal")
+
+        # Add the axis labels
+        ax.set(xlabel=self.xlabel, ylabel=self.ylabel)
+
+        # Annotate the cells with the formatted values
+        if self.annot:
+            self._annotate_heatmap(ax, mesh)
+
+
+
+
+def custom_heatmap(data, vmin=None, vmax=None, cmap=None, center=None, robust=False,
+            annot=None, fmt=".2g", annot_kws=None,per_element_annot_kws=None,
+            linewidths=0, linecolor="white",
+            cbar=True, cbar_kws=None, cbar_ax=None,
+            square=False, ax=None, xticklabels=True, yticklabels=True,
+            mask=None,
+            **kwargs):
+
+    # Initialize the plotter object
+    plotter = Custom_HeatMapper(data, vmin, vmax, cmap, center, robust, annot, fmt,
+                          annot_kws, per_element_annot_kws,cbar, cbar_kws, xticklabels,
+                          yticklabels, mask)
+
+    # Add the pcolormesh kwargs here
+    kwargs["linewidths"] = linewidths
+    kwargs["edgecolor"] = linecolor
+
+    # Draw the plot and return the Axes
+    if ax is None:
+        ax = plt.gca()
+    if square:
+        ax.set_aspect("equal")
+    plotter.plot(ax, cbar_ax, kwargs)
+    return ax
+
+def plot_alleles_table(reference_seq,cut_point,df_alleles,output_root,formats,MIN_FREQUENCY=0.5,MAX_N_ROWS=100):
+    #bp we are plotting on each side
+    offset_around_cut_to_plot=len(df_alleles.index[0])/2
+
+    # make a color map of fixed colors
+    alpha=0.5
+
+
+    get_color=lambda x,y,z: (x/255.0,y/255.0,z/255.0,alpha)
+    A_color=get_color(127,201,127)
+    T_color=get_color(190,174,212)
+    C_color=get_color(253,192,134)
+    G_color=get_color(255,255,153)
+    INDEL_color=get_color(230,230,230)
+
+    cmap = colors_mpl.ListedColormap([INDEL_color, A_color,T_color,C_color,G_color])
+
+    #N (for example in UMI consensus reads) are shown with the indel color
+    dna_to_numbers={'-':0,'A':1,'T':2,'C':3,'G':4,'N':0}
+    seq_to_numbers= lambda seq: [dna_to_numbers[x] for x in seq]
+
+    X=[]
+    annot=[]
+    y_labels=[]
+    lines=defaultdict(list)
+
+    re_find_indels=re.compile("(-*-)")
+
+
+    per_element_annot_kws=[]
+    idx_row=0
+    for idx,row in df_alleles.ix[df_alleles['%Reads']>=MIN_FREQUENCY][:MAX_N_ROWS].iterrows():
+        X.append(seq_to_numbers(str.upper(idx)))
+        annot.append(list(idx))
+        y_labels.append('%.2f%% (%d reads)' % (row['%Reads'],row['#Reads']))
+
+
+        for p in re_find_indels.finditer(row['Reference_Sequence']):
+            lines[idx_row].append((p.start(),p.end()))
+
+        idx_row+=1
+
+
+        idxs_sub= [i_sub for i_sub in range(len(idx)) if \
+                   (row['Reference_Sequence'][i_sub]!=idx[i_sub]) and \
+                   (row['Reference_Sequence'][i_sub]!='-') and\
+                   (idx[i_sub]!='-')]
+        to_append=np.array([{}]*len(idx),dtype=np.object)
+        to_append[ idxs_sub]={'weight':'bold', 'color':'black','size':16}
+        per_element_annot_kws.append(to_append)
+
+    ref_seq_around_cut=reference_seq[cut_point-offset_around_cut_to_plot+1:cut_point+offset_around_cut_to_plot+1]
+
+
+    per_element_annot_kws=np.vstack(per_element_annot_kws[::-1])
+    ref_seq_hm=np.expand_dims(seq_to_numbers(ref_seq_around_cut),1).T
+    ref_seq_annot_hm=np.expand_dims(list(ref_seq_around_cut),1).T
+
+    NEW_SEABORN=np.sum(np.array(map(int,sns.__version__.split('.')))*(100,10,1))>= 80
+
+    if NEW_SEABORN:
+        annot=annot[::-1]
+        X=X[::-1]
+
+    sns.set_context('poster')
+
+    N_ROWS=len(X)
+    N_COLUMNS=offset_around_cut_to_plot*2
+
+    fig=plt.figure(figsize=(offset_around_cut_to_plot*0.6,(N_ROWS+1)*0.6))
+    gs1 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
+    gs2 = gridspec.GridSpec(N_ROWS+1,N_COLUMNS)
+
+    ax_hm_ref=plt.subplot(gs1[0, :])
+    ax_hm=plt.subplot(gs2[1:, :])
+
+    custom_heatmap(ref_seq_hm,annot=ref_seq_annot_hm,annot_kws={'size':16},cmap=cmap,fmt='s',ax=ax_hm_ref,vmin=0,vmax=5,square=True)
+    custom_heatmap(X,annot=np.array(annot),annot_kws={'size':16},cmap=cmap,fmt='s',ax=ax_hm,square=True, per_element_annot_kws=per_element_annot_kws)
+
+    ax_hm.yaxis.tick_right()
+    ax_hm.yaxis.set_ticklabels(y_labels[::-1],rotation=True),
+    ax_hm.xaxis.set_ticks([])
+
+    #print lines
+
+    #cut point vertical line
+    ax_hm.vlines([offset_around_cut_to_plot],*ax_hm.get_ylim(),linestyles='dashed')
+
+    #create boxes for ins
+    for idx,lss in lines.iteritems():
+            for ls in lss:
+                for l in ls:
+                    ax_hm.vlines([l],N_ROWS-idx-1,N_ROWS-idx,color='red',lw=3)
+
+                ax_hm.hlines(N_ROWS-idx-1,ls[0],ls[1],color='red',lw=3)
+                ax_hm.hlines(N_ROWS-idx,ls[0],ls[1],color='red',lw=3)
+
+    ax_hm_ref.yaxis.tick_right()
+    ax_hm_ref.xaxis.set_ticks([])
+    ax_hm_ref.yaxis.set_ticklabels(['Reference'],rotation=True)
+
+    gs2.update(left=0,right=1, hspace=0.05,wspace=0,top=1*(((N_ROWS)*1.13))/(N_ROWS))
+    gs1.update(left=0,right=1, hspace=0.05,wspace=0,)
+
+    sns.set_context(rc={'lines.markeredgewidth': 1,'mathtext.fontset' : 'stix','text.usetex':True,'text.latex.unicode':True} )
+
+    proxies = [matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='black',
+                    mec='none', marker=r'$\mathbf{{{}}}$'.format('bold'),ms=18),
+               matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
+                    mec='red', marker='s',ms=8,markeredgewidth=2.5),
+              matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
+                    mec='black', marker='_',ms=2,),
+              matplotlib.lines.Line2D([0], [1], linestyle='--',c='black',ms=6)] #
+    descriptions=['Substitutions','Insertions','Deletions','Predicted cleavage position']
+    ax_hm_ref.legend(proxies, descriptions, numpoints=1, markerscale=2, loc='center', bbox_to_anchor=(0.5, 4),ncol=1)
+
+    save_figure(fig,output_root,formats,bbox_inches='tight')
+
+
+def render_glyphs(characters,cell_px,fontsize,weight):
+    '''
+    Render each character once centered in a cell of cell_px x cell_px pixels, returns the coverage of the text
+    in each pixel (0-1) with shape (len(characters),cell_px,cell_px).
+    '''
+    glyphs=[]
+    for character in characters:
+        fig=plt.figure(figsize=(cell_px/100.0,cell_px/100.0),dpi=100)
+        fig.patch.set_alpha(0)
+        fig.text(0.5,0.5,character,ha='center',va='center',fontsize=fontsize,weight=weight)
+        fig.canvas.draw()
+        width,height=fig.canvas.get_width_height()
+        glyphs.append(np.fromstring(fig.canvas.tostring_argb(),np.uint8).reshape(height,width,4)[:cell_px,:cell_px,0]/255.0)
+        plt.close(fig)
+
+    return np.array(glyphs)
+
+def plot_alleles_table_fast(reference_seq,cut_point,df_alleles,output_root,formats,MIN_FREQUENCY=0.5,MAX_N_ROWS=100,CELL_PX=30):
+    '''
+    Same table of plot_alleles_table drawn as a single image: the colored cells and the nucleotides (rendered once
+    for each letter) are composed in an array, only the insertion boxes, the cut point and the labels are drawn
+    as vector elements. The time does not depend on the number of cells drawn as text.
+    '''
+    offset_around_cut_to_plot=len(df_alleles.index[0])/2
+    ref_seq_around_cut=reference_seq[cut_point-offset_around_cut_to_plot+1:cut_point+offset_around_cut_to_plot+1]
+
+    #same colors of plot_alleles_table, blended on white
+    alpha=0.5
+    alphabet='-ATCGN'
+    cell_colors=np.array([(230,230,230),(127,201,127),(190,174,212),(253,192,134),(255,255,153),(230,230,230)])/255.0*alpha+(1-alpha)
+    text_color=np.array(colors_mpl.to_rgb('.15'))
+
+    glyphs=np.vstack([render_glyphs(alphabet,CELL_PX,16,'normal'),render_glyphs(alphabet,CELL_PX,16,'bold')])
+
+    df_alleles_to_plot=df_alleles.ix[df_alleles['%Reads']>=MIN_FREQUENCY][:MAX_N_ROWS]
+    rows=[(ref_seq_around_cut,ref_seq_around_cut)]+zip(df_alleles_to_plot.index,df_alleles_to_plot['Reference_Sequence'])
+    y_labels=['Reference']+['%.2f%% (%d reads)' % (percentage,n_reads) for percentage,n_reads in zip(df_alleles_to_plot['%Reads'],df_alleles_to_plot['#Reads'])]
+
+    N_ROWS=len(rows)-1
+    N_COLUMNS=len(ref_seq_around_cut)
+    GAP_PX=CELL_PX/3
+
+    #the reference row, a white gap and the alleles
+    image=np.ones((CELL_PX*(N_ROWS+1)+GAP_PX,CELL_PX*N_COLUMNS,3))
+    insertion_intervals=[]
+    for idx_row,(aligned_seq,reference_seq_row) in enumerate(rows):
+        aligned_seq=aligned_seq.upper()
+        letters=np.array([alphabet.index(nt) if nt in alphabet else len(alphabet)-1 for nt in aligned_seq])
+        substitutions=np.array([(ref_nt!=nt and ref_nt!='-' and nt!='-') for ref_nt,nt in zip(reference_seq_row,aligned_seq)])
+
+        #bold black letters for the substitutions
+        coverage=glyphs[letters+len(alphabet)*substitutions][:,:,:,np.newaxis]
+        color=np.where(substitutions[:,np.newaxis],0,text_color)[:,np.newaxis,np.newaxis,:]
+        cells=cell_colors[letters][:,np.newaxis,np.newaxis,:]*(1-coverage)+color*coverage
+
+        y_start=idx_row*CELL_PX+(GAP_PX if idx_row else 0)
+        image[y_start:y_start+CELL_PX,:len(aligned_seq)*CELL_PX]=cells.transpose(1,0,2,3).reshape(CELL_PX,len(aligned_seq)*CELL_PX,3)
+
+        if idx_row:
+            insertion_intervals+=[(idx_row,p.start(),p.end()) for p in re.finditer('(-*-)',reference_seq_row)]
+
+    #in cell units, the alleles start after the gap
+    gap=GAP_PX/float(CELL_PX)
+    height=N_ROWS+1+gap
+    fig=plt.figure(figsize=(N_COLUMNS*0.3+0.5,height*0.3+1.5))
+    ax=fig.add_axes([0,0,1,height*0.3/(height*0.3+1.5)])
+    ax.imshow(image,extent=(0,N_COLUMNS,height,0),interpolation='nearest',aspect='equal')
+
+    ax.vlines([offset_around_cut_to_plot],1+gap,height,linestyles='dashed',lw=3)
+
+    #boxes around the insertions
+    if insertion_intervals:
+        ax.vlines([x for idx_row,start,end in insertion_intervals for x in (start,end)],
+                  [idx_row+gap for idx_row,start,end in insertion_intervals for x in (0,1)],
+                  [idx_row+gap+1 for idx_row,start,end in insertion_intervals for x in (0,1)],color='red',lw=3)
+        ax.hlines([idx_row+gap+y for idx_row,start,end in insertion_intervals for y in (0,1)],
+                  [start for idx_row,start,end in insertion_intervals for y in (0,1)],
+                  [end for idx_row,start,end in insertion_intervals for y in (0,1)],color='red',lw=3)
+
+    ax.set_xlim(0,N_COLUMNS)
+    ax.set_ylim(height,0)
+    ax.set_xticks([])
+    ax.yaxis.tick_right()
+    ax.set_yticks([0.5]+list(np.arange(N_ROWS)+1.5+gap))
+    ax.set_yticklabels(y_labels)
+    ax.tick_params(axis='y',length=0,labelsize=20)
+    for spine in ax.spines.values():
+        spine.set_visible(False)
+
+    proxies = [matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='black',
+                    mec='none', marker=r'$\mathbf{{{}}}$'.format('bold'),ms=18),
+               matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
+                    mec='red', marker='s',ms=8,markeredgewidth=2.5),
+              matplotlib.lines.Line2D([0], [0], linestyle='none', mfc='none',
+                    mec='black', marker='_',ms=2,),
+              matplotlib.lines.Line2D([0], [1], linestyle='--',c='black',ms=6)]
+    descriptions=['Substitutions','Insertions','Deletions','Predicted cleavage position']
+    ax.legend(proxies, descriptions, numpoints=1, markerscale=2, loc='lower center', bbox_to_anchor=(0.5, 1.02),ncol=1)
+
+    save_figure(fig,output_root,formats,bbox_inches='tight',dpi=CELL_PX/0.3)
+
+
+###RENDERING#############################
+
+def render_figure(figure_job):
+    '''
+    Render a figure job, a (figure_id,plot_function_name,plot_kwargs,output_root,formats) tuple.
+    '''
+    figure_id,plot_function_name,plot_kwargs,output_root,formats=figure_job
+
+    #each figure starts from the same style, plot_alleles_table changes the rc parameters
+    with matplotlib.rc_context():
+        globals()[plot_function_name](output_root=output_root,formats=formats,**plot_kwargs)
+
+    return output_root
+
+def select_figure_jobs(figure_jobs,plot_level):
+    '''
+    The figure jobs, (figure_id,plot_function_name,plot_kwargs,output_filename) tuples, to render at a plot level.
+    '''
+    if plot_level=='none':
+        return []
+    elif plot_level=='summary':
+        return [figure_job for figure_job in figure_jobs if figure_job[0] in SUMMARY_FIGURES]
+    else:
+        return list(figure_jobs)
+
+def render_figures(figure_jobs,output_directory,plot_level='full',formats=['pdf'],n_processes=1):
+    '''
+    Render the figures selected by plot_level in output_directory, each figure is drawn once and saved in all the
+    formats. The figures are independent, with n_processes>1 they are rendered in a pool of processes.
+    '''
+    figure_jobs=[(figure_id,plot_function_name,plot_kwargs,os.path.join(output_directory,output_filename),formats)
+                 for figure_id,plot_function_name,plot_kwargs,output_filename in select_figure_jobs(figure_jobs,plot_level)]
+
+    if n_processes>1 and len(figure_jobs)>1:
+        pool=mp.Pool(processes=min(n_processes,len(figure_jobs)))
+        try:
+            output_roots=pool.map(render_figure,figure_jobs)
+        finally:
+            pool.close()
+            pool.join()
+    else:
+        output_roots=map(render_figure,figure_jobs)
+
+    return output_roots
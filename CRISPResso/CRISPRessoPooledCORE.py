@@ -11,11 +11,17 @@ import errno
 import sys
 import subprocess as sb
 import glob
+import gzip
+import shutil
+import tempfile
+import cPickle as cp
 import argparse
 import unicodedata
 import string
 import re
 import multiprocessing
+import itertools
+from collections import OrderedDict
 
 
 import logging
@@ -126,23 +132,57 @@ def check_bowtie2():
         sys.stdout.write('\n\nPlease install it and add to your path following the instruction at: http://bowtie-bio.sourceforge.net/bowtie2/manual.shtml#obtaining-bowtie-2')
         return False
 
-#this is overkilling to run for many sequences,
-#but for few is fine and effective.
-def get_align_sequence(seq,bowtie2_index):
-    
-    cmd='''bowtie2 -x  %s -c -U %s''' %(bowtie2_index,seq) + ''' |\
-    grep -v '@' | awk '{OFS="\t"; bpstart=$4; split ($6,a,"[MIDNSHP]"); n=0;  bpend=bpstart;\
-    for (i=1; i in a; i++){\
-      n+=1+length(a[i]); \
-      if (substr($6,n,1)=="S"){\
-          bpstart-=a[i];\
-          if (bpend==$4)\
-            bpend=bpstart;\
-      } else if( (substr($6,n,1)!="I")  && (substr($6,n,1)!="H") )\
-          bpend+=a[i];\
-    }if ( ($2 % 32)>=16) print $3,bpstart,bpend,"-",$1,$10,$11;else print $3,bpstart,bpend,"+",$1,$10,$11;}' ''' 
-    p = sb.Popen(cmd, shell=True,stdout=sb.PIPE)
-    return p.communicate()[0]
+def get_align_sequences(seqs,bowtie2_index,n_processes=1,cache_filename='',log_filename=''):
+    '''
+    Aligns all the sequences to the genome with a single bowtie2 call, the genome index is loaded only once. Returns
+    for each sequence (chr_id,bpstart,bpend,strand,aligned sequence), chr_id is '*' if the sequence is not aligned.
+    The results are kept by index (its path and modification time) and sequence in the pickle file cache_filename if
+    given, shared between runs. The messages of bowtie2 are appended to log_filename if given.
+    '''
+    cache={}
+    if cache_filename and os.path.exists(cache_filename):
+        try:
+            with open(cache_filename,'rb') as cache_handle:
+                cache=cp.load(cache_handle)
+        except Exception as e:
+            warn('The mapping cache %s cannot be read and will be rebuilt: %s' % (cache_filename,e))
+
+    #the results of an index rebuilt are not reused
+    index_key=(os.path.abspath(bowtie2_index),os.path.getmtime(bowtie2_index+'.1.bt2'))
+    seqs_to_align=sorted(set([seq for seq in seqs if (index_key,seq) not in cache]))
+
+    if seqs_to_align:
+        with tempfile.NamedTemporaryFile(suffix='.fa') as query_handle:
+            for idx_seq,seq in enumerate(seqs_to_align):
+                query_handle.write('>%d\n%s\n' % (idx_seq,seq))
+            query_handle.flush()
+
+            p=sb.Popen('bowtie2 -x %s -p %d -f -U %s%s' % (bowtie2_index,n_processes,query_handle.name,' 2>>%s' % log_filename if log_filename else ''),shell=True,stdout=sb.PIPE)
+            for line in p.stdout:
+                if line.startswith('@'):
+                    continue
+
+                sam_fields=line.rstrip('\n').split('\t',11)
+                flag=int(sam_fields[1])
+                if flag & 0x900:
+                    continue
+
+                seq=seqs_to_align[int(sam_fields[0])]
+                if flag & 0x4:
+                    cache[(index_key,seq)]=('*',0,-1,'+','')
+                else:
+                    bpstart,bpend=get_alignment_span(sam_fields)
+                    cache[(index_key,seq)]=(sam_fields[2],bpstart,bpend,'-' if flag & 0x10 else '+',sam_fields[9])
+
+            if p.wait():
+                raise Bowtie2Exception('The alignment of the amplicons to the genome %s failed!%s' % (bowtie2_index,' Please check the log file %s' % log_filename if log_filename else ''))
+
+        if cache_filename:
+            with open(cache_filename+'.tmp','wb') as cache_handle:
+                cp.dump(cache,cache_handle,protocol=cp.HIGHEST_PROTOCOL)
+            os.rename(cache_filename+'.tmp',cache_filename)
+
+    return [cache[(index_key,seq)] for seq in seqs]
 
 #if a reference index is provided align the reads to it
 #extract region
@@ -155,9 +195,256 @@ def get_n_reads_fastq(fastq_filename):
      p = sb.Popen(('z' if fastq_filename.endswith('.gz') else '' ) +"cat < %s | wc -l" % fastq_filename , shell=True,stdout=sb.PIPE)
      return int(float(p.communicate()[0])/4.0)
 
+def get_n_reads_bam(bam_filename):
+     p = sb.Popen("samtools view -F 0x900 -c %s" % bam_filename , shell=True,stdout=sb.PIPE)
+     return int(p.communicate()[0])
+
 def get_n_aligned_bam(bam_filename):
      p = sb.Popen("samtools view -F 0x904 -c %s" % bam_filename , shell=True,stdout=sb.PIPE)
      return int(p.communicate()[0])
+
+class FastqDemultiplexer(object):
+    '''
+    Writes the demultiplexed reads to one output_prefix+target+'.fastq.gz' file per target. The reads are buffered
+    in memory and compressed in blocks, at most max_open_files files are kept open at the same time (the least
+    recently written is closed and reopened in append mode when needed) and the reads of each target are counted.
+    '''
+    def __init__(self,output_prefix,max_open_files=None,buffer_size=1000000,max_buffered_bytes=100000000):
+        self.output_prefix=output_prefix
+        self.max_open_files=max_open_files if max_open_files else get_max_demultiplexing_files()
+        self.buffer_size=buffer_size
+        self.max_buffered_bytes=max_buffered_bytes
+
+        self.handles=OrderedDict() #least recently written first
+        self.buffers={}
+        self.buffer_sizes={}
+        self.n_reads={}
+        self.n_buffered_bytes=0
+        self.written_targets=set()
+
+    def get_filename(self,target):
+        return '%s%s.fastq.gz' % (self.output_prefix,target)
+
+    def add_read(self,target,read_name,read_seq,read_qual):
+        record='@%s\n%s\n+\n%s\n' % (read_name,read_seq,read_qual)
+        if target in self.buffers:
+            self.buffers[target].append(record)
+            self.buffer_sizes[target]+=len(record)
+            self.n_reads[target]+=1
+        else:
+            self.buffers[target]=[record]
+            self.buffer_sizes[target]=len(record)
+            self.n_reads[target]=1
+        self.n_buffered_bytes+=len(record)
+
+        if self.buffer_sizes[target]>=self.buffer_size:
+            self.flush(target)
+        elif self.n_buffered_bytes>=self.max_buffered_bytes:
+            for buffered_target in self.buffers.keys():
+                self.flush(buffered_target)
+
+    def flush(self,target):
+        if not self.buffer_sizes.get(target):
+            return
+
+        handle=self.handles.pop(target,None)
+        if handle is None:
+            if len(self.handles)>=self.max_open_files:
+                self.handles.popitem(last=False)[1].close()
+            #the file is created with the first block of reads of the target, then the new blocks are appended
+            handle=gzip.open(self.get_filename(target),'ab' if target in self.written_targets else 'wb',6)
+            self.written_targets.add(target)
+        self.handles[target]=handle
+
+        handle.write(''.join(self.buffers[target]))
+        self.n_buffered_bytes-=self.buffer_sizes[target]
+        self.buffers[target]=[]
+        self.buffer_sizes[target]=0
+
+    def close(self):
+        for target in self.buffers.keys():
+            self.flush(target)
+        while self.handles:
+            self.handles.popitem()[1].close()
+        return self.n_reads
+
+def get_max_demultiplexing_files():
+    #leave most of the file descriptors to bowtie2, samtools and the analysis
+    try:
+        import resource
+        return max(16,min(1024,resource.getrlimit(resource.RLIMIT_NOFILE)[0]/4))
+    except (ImportError,ValueError):
+        return 64
+
+CIGAR_OPERATIONS_RE=re.compile(r'(\d+)([MIDNSHP=X])')
+
+def get_reference_name(sam_fields):
+    return sam_fields[2]
+
+def get_alignment_span(sam_fields):
+    '''
+    Returns the genomic coordinates bpstart,bpend (end excluded) covered by an alignment, the soft clipped bases
+    extend the span.
+    '''
+    bpstart=bpend=int(sam_fields[3])
+    for length,operation in CIGAR_OPERATIONS_RE.findall(sam_fields[5]):
+        if operation=='S':
+            if bpend==int(sam_fields[3]):
+                bpstart-=int(length)
+            else:
+                bpend+=int(length)
+        elif operation not in 'IHP':
+            bpend+=int(length)
+
+    return bpstart,bpend
+
+def get_region_name(sam_fields):
+    '''
+    Returns the name REGION_chr_bpstart_bpend of the genomic region covered by an alignment
+    '''
+    return 'REGION_%s_%d_%d' % ((sam_fields[2],)+get_alignment_span(sam_fields))
+
+def align_and_demultiplex_reads(aligner_command,bam_filename,output_prefix,log_filename,get_target_name=get_reference_name,max_open_files=None,demultiplexer=None,flash_command=None):
+    '''
+    Demultiplex the reads while they are aligned: the SAM output of aligner_command is read as a stream, the aligned
+    reads are written to output_prefix+get_target_name(sam_fields)+'.fastq.gz' (by default the name of the reference)
+    and all the alignments are saved in bam_filename. The reads can be added to a FastqDemultiplexer already used for
+    other reads. With flash_command the paired end reads are merged while they are aligned, its output is the input
+    of aligner_command. Returns the number of reads written for each target and the number of reads aligned.
+    '''
+    if flash_command is None:
+        flash_process=None
+        aligner_process=sb.Popen(aligner_command,shell=True,stdout=sb.PIPE)
+    else:
+        flash_process=sb.Popen(flash_command,shell=True,stdout=sb.PIPE)
+        aligner_process=sb.Popen(aligner_command,shell=True,stdin=flash_process.stdout,stdout=sb.PIPE)
+        flash_process.stdout.close() #only the aligner reads the merged reads
+    with open(log_filename,'a') as log_handle:
+        samtools_process=sb.Popen('samtools view -bS - > %s' % bam_filename,shell=True,stdin=sb.PIPE,stderr=log_handle)
+
+    if demultiplexer is None:
+        demultiplexer=FastqDemultiplexer(output_prefix,max_open_files)
+    n_reads_aligned=0
+    for line in aligner_process.stdout:
+        samtools_process.stdin.write(line)
+
+        if line.startswith('@'):
+            continue
+
+        sam_fields=line.rstrip('\n').split('\t',11)
+        flag=int(sam_fields[1])
+        if flag & 0x904: #primary alignments only, as get_n_aligned_bam, a read is demultiplexed once
+            continue
+
+        n_reads_aligned+=1
+        demultiplexer.add_read(get_target_name(sam_fields),sam_fields[0],sam_fields[9],sam_fields[10])
+
+    n_reads_targets=demultiplexer.close()
+
+    samtools_process.stdin.close()
+    if flash_process is not None and flash_process.wait():
+        raise FlashException('Flash failed to run, please check the log file %s' % log_filename)
+
+    if aligner_process.wait() or samtools_process.wait():
+        raise Bowtie2Exception('The alignment of the reads failed, please check the log file %s' % log_filename)
+
+    return n_reads_targets,n_reads_aligned
+
+def cluster_regions(n_reads_regions,mapped_regions_folder,max_region_distance=0):
+    '''
+    Merges the demultiplexed regions (REGION_chr_bpstart_bpend) of the same chromosome that overlap or are at most
+    max_region_distance bp apart, sweeping them by start position, so reads differing only by a soft clip or an indel
+    at their ends end up in the same region. The fastq.gz files of the regions merged are concatenated in the file of
+    their cluster. Returns the number of reads of each cluster.
+    '''
+    regions_by_chr={}
+    for region_name in n_reads_regions:
+        chr_id,bpstart,bpend=region_name[len('REGION_'):].rsplit('_',2)
+        regions_by_chr.setdefault(chr_id,[]).append((int(bpstart),int(bpend),region_name))
+
+    clusters=[]
+    for chr_id,regions in regions_by_chr.iteritems():
+        regions.sort()
+        cluster_start,cluster_end,cluster_regions=regions[0][0],regions[0][1],[regions[0][2]]
+        for bpstart,bpend,region_name in regions[1:]:
+            if bpstart-cluster_end<=max_region_distance:
+                cluster_end=max(cluster_end,bpend)
+                cluster_regions.append(region_name)
+            else:
+                clusters.append((chr_id,cluster_start,cluster_end,cluster_regions))
+                cluster_start,cluster_end,cluster_regions=bpstart,bpend,[region_name]
+        clusters.append((chr_id,cluster_start,cluster_end,cluster_regions))
+
+    n_reads_clusters={}
+    for chr_id,cluster_start,cluster_end,cluster_regions in clusters:
+        cluster_name='REGION_%s_%d_%d' % (chr_id,cluster_start,cluster_end)
+        n_reads_clusters[cluster_name]=sum([n_reads_regions[region_name] for region_name in cluster_regions])
+
+        if cluster_regions==[cluster_name]:
+            continue
+
+        #the concatenation of gzip files is a valid gzip file
+        cluster_filename=os.path.join(mapped_regions_folder,'%s.fastq.gz' % cluster_name)
+        with open(cluster_filename+'.tmp','wb') as cluster_handle:
+            for region_name in cluster_regions:
+                region_filename=os.path.join(mapped_regions_folder,'%s.fastq.gz' % region_name)
+                with open(region_filename,'rb') as region_handle:
+                    shutil.copyfileobj(region_handle,cluster_handle)
+                os.remove(region_filename)
+        os.rename(cluster_filename+'.tmp',cluster_filename)
+
+    return n_reads_clusters
+
+_amplicon_kmer_index=None
+
+def _assign_sequences_to_amplicons(seqs):
+    return [_amplicon_kmer_index.assign(seq) for seq in seqs]
+
+def assign_reads_to_amplicons(fastq_filename,amplicon_index,target_names,demultiplexer,unassigned_fastq_filename,n_processes=1,chunk_size=100000):
+    '''
+    Assigns the reads to the amplicons with the k-mers of amplicon_index (a CRISPRessoCORE.AmpliconKmerIndex): the reads
+    assigned are added to demultiplexer with the target name of their amplicon, the reads not assigned or ambiguous are
+    written to unassigned_fastq_filename. The unique sequences of each chunk of reads are assigned by n_processes
+    processes. Returns the number of reads assigned and not assigned.
+    '''
+    global _amplicon_kmer_index
+    _amplicon_kmer_index=amplicon_index
+    pool=multiprocessing.Pool(n_processes) if n_processes>1 else None
+
+    #most of the reads are identical, we assign each unique sequence only once
+    sequence_assignments={}
+    n_reads_assigned=0
+    n_reads_unassigned=0
+    with gzip.open(unassigned_fastq_filename,'wb') as unassigned_handle:
+        reads=CRISPRessoCORE.read_fastq(fastq_filename)
+        while True:
+            chunk=list(itertools.islice(reads,chunk_size))
+            if not chunk:
+                break
+
+            new_seqs=list(set([read_seq for _,read_seq,_ in chunk if read_seq not in sequence_assignments]))
+            if pool:
+                batch_size=max(1,len(new_seqs)/(4*n_processes))
+                assignments=list(itertools.chain.from_iterable(pool.map(_assign_sequences_to_amplicons,
+                                                    [new_seqs[i:i+batch_size] for i in range(0,len(new_seqs),batch_size)])))
+            else:
+                assignments=_assign_sequences_to_amplicons(new_seqs)
+            sequence_assignments.update(zip(new_seqs,assignments))
+
+            for read_name,read_seq,read_qual in chunk:
+                idx_amplicon=sequence_assignments[read_seq]
+                if idx_amplicon is None:
+                    unassigned_handle.write('@%s\n%s\n+\n%s\n' % (read_name,read_seq,read_qual))
+                    n_reads_unassigned+=1
+                else:
+                    demultiplexer.add_read(target_names[idx_amplicon],read_name,read_seq,read_qual)
+                    n_reads_assigned+=1
+
+    if pool:
+        pool.close()
+        pool.join()
+
+    return n_reads_assigned,n_reads_unassigned
      
 #get a clean name that we can use for a filename
 validFilenameChars = "+-_.() %s%s" % (string.ascii_letters, string.digits)
@@ -190,6 +477,8 @@ def find_overlapping_genes(row,df_genes):
 pd=check_library('pandas')
 np=check_library('numpy')
 
+from CRISPResso import CRISPRessoCORE
+
 ###EXCEPTIONS############################
 class FlashException(Exception):
     pass
@@ -263,8 +552,15 @@ def main():
         please select as table "knowGene", as output format "all fields from selected table" and as file returned "gzip compressed"', default='')
         parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
         Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)        
+        parser.add_argument('--n_parallel_amplicons',type=int, help='Number of amplicons analyzed by CRISPResso at the same time, the processes specified with -p are split between them',default=1)
         parser.add_argument('--bowtie2_options_string', type=str, help='Override options for the Bowtie2 alignment command',default=' -k 1 --end-to-end -N 0 --np 0 ')
         parser.add_argument('--min_reads_to_use_region',  type=float, help='Minimum number of reads that align to a region to perform the CRISPResso analysis', default=1000)
+        parser.add_argument('--amplicons_mapping_cache',type=str,help='Pickle file keeping the locations of the amplicons on the genome between runs, the amplicons already mapped to the same bowtie2 index are not aligned again',default='')
+        parser.add_argument('--cluster_regions',help='When only the genome is given, merge the regions discovered that overlap or are at most --max_region_distance bp apart instead of using a region for each distinct read alignment span',action='store_true')
+        parser.add_argument('--max_region_distance',type=int,help='Maximum distance in bp between two regions merged by --cluster_regions',default=0)
+        parser.add_argument('--amplicon_assignment',type=str,help='How the reads are assigned to the amplicons when only the amplicons are given: bowtie2 aligns all the reads, kmer assigns them with the k-mers specific to each amplicon and aligns with bowtie2 only the reads not assigned',choices=['bowtie2','kmer'],default='bowtie2')
+        parser.add_argument('--amplicon_assignment_kmer_size', type=int,  help='Size of the k-mers used by --amplicon_assignment kmer', default=10)
+        parser.add_argument('--amplicon_assignment_min_kmer_fraction', type=float,  help='Minimum fraction of the k-mers of a read that must be specific to its amplicon to assign the read to it with --amplicon_assignment kmer, the other reads are aligned with bowtie2', default=0.5)
     
         #general CRISPResso optional
         parser.add_argument('-q','--min_average_read_quality', type=int, help='Minimum average quality score (phred33) to keep a read', default=0)
@@ -289,6 +585,8 @@ def main():
         parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
         parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
         parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+        parser.add_argument('--plot_level',type=str,help='Figures to create for each amplicon: none, only the summary figures or all the figures',choices=['none','summary','full'],default='full')
+        parser.add_argument('--vector_alleles_table',help='Draw each nucleotide of the alleles table plots as a vector element instead of drawing the tables as images, slower for large tables',action='store_true')
         
          
     
@@ -303,24 +601,47 @@ def main():
                                   'needle_options_string',
                                   'keep_intermediate',
                                   'dump',
-                                  'save_also_png','hide_mutations_outside_window_NHEJ','n_processes',]
+                                  'save_also_png','plot_level','vector_alleles_table','hide_mutations_outside_window_NHEJ','n_processes',]
     
         
-        def propagate_options(cmd,options,args):
-        
-            for option in options :
-                if option:
-                    val=eval('args.%s' % option )
-      
-                    if type(val)==str:
-                        cmd+=' --%s "%s"' % (option,str(val)) # this is for options with space like needle...
-                    elif type(val)==bool:
-                        if val:
-                            cmd+=' --%s' % option
-                    else:
-                        cmd+=' --%s %s' % (option,str(val))
-                
-            return cmd
+        def get_crispresso_config(fastq_r1,amplicon_seq,name=None,row=None):
+            #the options propagated to CRISPResso and the sgRNA, expected HDR and coding sequence of the amplicon
+            config=dict([(option,getattr(args,option)) for option in crispresso_options])
+            config.update(fastq_r1=fastq_r1,amplicon_seq=amplicon_seq,output_folder=OUTPUT_DIRECTORY)
+
+            if name is not None:
+                config['name']=name
+
+            if row is not None:
+                for column,option in [('sgRNA','guide_seq'),('Expected_HDR','expected_hdr_amplicon_seq'),('Coding_sequence','coding_seq')]:
+                    if row[column] and not pd.isnull(row[column]):
+                        config[option]=row[column]
+
+            return config
+
+        #CRISPResso runs in processes forked from this one, the results are returned directly
+        crispresso_results={}
+        crispresso_failures=[]
+
+        def run_crispresso_jobs(crispresso_jobs):
+            #the largest amplicons are analyzed first, the processes (-p) are split between the amplicons analyzed at the same time
+            n_parallel_amplicons=min(args.n_parallel_amplicons,args.n_processes)
+            if n_parallel_amplicons<args.n_parallel_amplicons:
+                warn('Only %d processes are available (-p), %d amplicons are analyzed at the same time instead of %d' % (args.n_processes,n_parallel_amplicons,args.n_parallel_amplicons))
+            n_processes_per_amplicon=max(1,args.n_processes/n_parallel_amplicons)
+            scheduler=CRISPRessoCORE.CRISPRessoJobScheduler(n_parallel_amplicons)
+
+            for idx,n_reads,config in sorted(crispresso_jobs,key=lambda crispresso_job: crispresso_job[1],reverse=True):
+                info('Running CRISPResso on %s (%d reads)' % (idx,n_reads))
+                config['n_processes']=n_processes_per_amplicon
+                scheduler.submit(idx,{'config':config})
+
+            for idx,(status,result,error_message,exit_code) in scheduler.wait().items():
+                if status=='done':
+                    crispresso_results[idx]=result
+                else:
+                    warn('The CRISPResso analysis of %s failed: %s' % (idx,error_message))
+                    crispresso_failures.append([idx,error_message])
         
         info('Checking dependencies...')
     
@@ -393,6 +714,7 @@ def main():
         with open(log_filename,'w+') as outfile:
                   outfile.write('[Command used]:\nCRISPRessoPooled %s\n\n[Execution log]:\n' % ' '.join(sys.argv))
     
+        flash_command=None
         if args.fastq_r2=='': #single end reads
     
              #check if we need to trim
@@ -445,31 +767,37 @@ def main():
     
     
              #Merging with Flash
-             info('Merging paired sequences with Flash...')
-             cmd='flash %s %s --allow-outies --min-overlap %d --max-overlap %d -z -d %s >>%s 2>&1' %\
+             cmd='flash %s %s --allow-outies --min-overlap %d --max-overlap %d' %\
              (output_forward_paired_filename,
               output_reverse_paired_filename,
               args.min_paired_end_reads_overlap,
-              args.max_paired_end_reads_overlap,
-              OUTPUT_DIRECTORY,log_filename)
-    
-             FLASH_STATUS=sb.call(cmd,shell=True)
-             if FLASH_STATUS:
-                 raise FlashException('Flash failed to run, please check the log file.')
-    
-             info('Done!')
-    
-             flash_hist_filename=_jp('out.hist')
-             flash_histogram_filename=_jp('out.histogram')
-             flash_not_combined_1_filename=_jp('out.notCombined_1.fastq.gz')
-             flash_not_combined_2_filename=_jp('out.notCombined_2.fastq.gz')
-    
-             processed_output_filename=_jp('out.extendedFrags.fastq.gz')
+              args.max_paired_end_reads_overlap)
+
+             #the merged reads are aligned by bowtie2 while Flash writes them, unless the k-mers assign them first
+             if RUNNING_MODE=='ONLY_AMPLICONS' and args.amplicon_assignment=='kmer':
+                 info('Merging paired sequences with Flash...')
+                 FLASH_STATUS=sb.call('%s -z -d %s >>%s 2>&1' % (cmd,OUTPUT_DIRECTORY,log_filename),shell=True)
+                 if FLASH_STATUS:
+                     raise FlashException('Flash failed to run, please check the log file.')
+
+                 info('Done!')
+
+                 flash_hist_filename=_jp('out.hist')
+                 flash_histogram_filename=_jp('out.histogram')
+                 flash_not_combined_1_filename=_jp('out.notCombined_1.fastq.gz')
+                 flash_not_combined_2_filename=_jp('out.notCombined_2.fastq.gz')
+
+                 processed_output_filename=_jp('out.extendedFrags.fastq.gz')
+             else:
+                 info('The paired sequences are merged with Flash while they are aligned.')
+                 flash_command='%s --to-stdout 2>>%s' % (cmd,log_filename)
+                 processed_output_filename='-'
     
     
-        #count reads 
+        #count reads, the reads merged while they are aligned are counted in the bam file
         N_READS_INPUT=get_n_reads_fastq(args.fastq_r1)
-        N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
+        if flash_command is None:
+            N_READS_AFTER_PREPROCESSING=get_n_reads_fastq(processed_output_filename)
     
             
         #load gene annotation
@@ -551,50 +879,56 @@ def main():
                         open(fastq_gz_amplicon_filenames[-1], 'w+').close()
     
             df_template['Demultiplexed_fastq.gz_filename']=fastq_gz_amplicon_filenames
-            info('Creating a custom index file with all the amplicons...')
-            custom_index_filename=_jp('CUSTOM_BOWTIE2_INDEX')
-            sb.call('bowtie2-build %s %s >>%s 2>&1' %(amplicon_fa_filename,custom_index_filename,log_filename), shell=True)
-    
-    
-            #align the file to the amplicons (MODE 1)
-            info('Align reads to the amplicons...')
+            demultiplexer=FastqDemultiplexer(_jp(''))
             bam_filename_amplicons= _jp('CRISPResso_AMPLICONS_ALIGNED.bam')
-            aligner_command= 'bowtie2 -x %s -p %s %s -U %s 2>>%s | samtools view -bS - > %s' %(custom_index_filename,args.n_processes,args.bowtie2_options_string,processed_output_filename,log_filename,bam_filename_amplicons)
-    
-            sb.call(aligner_command,shell=True)
-    
-            N_READS_ALIGNED=get_n_aligned_bam(bam_filename_amplicons)
-            
-            s1=r"samtools view -F 4 %s 2>>%s | grep -v ^'@'" % (bam_filename_amplicons,log_filename)
-            s2=r'''|awk '{ gzip_filename=sprintf("gzip >> OUTPUTPATH%s.fastq.gz",$3);\
-            print "@"$1"\n"$10"\n+\n"$11  | gzip_filename;}' '''
-    
-            cmd=s1+s2.replace('OUTPUTPATH',_jp(''))
-            sb.call(cmd,shell=True)
+            reads_to_align_filename=processed_output_filename
+            N_READS_ASSIGNED_KMERS=n_reads_unassigned=0
+
+            if args.amplicon_assignment=='kmer':
+                info('Assign reads to the amplicons with their k-mers...')
+                amplicon_index=CRISPRessoCORE.AmpliconKmerIndex(list(df_template.Amplicon_Sequence),k=args.amplicon_assignment_kmer_size,
+                                                                min_kmer_fraction=args.amplicon_assignment_min_kmer_fraction)
+                for idx_amplicon,amplicon_name in enumerate(df_template.index):
+                    if amplicon_index.n_kmers_amplicons[idx_amplicon]==0:
+                        warn('The amplicon %s has no specific %d-mers, its reads can be assigned only by bowtie2.' % (amplicon_name,args.amplicon_assignment_kmer_size))
+
+                reads_to_align_filename=_jp('UNASSIGNED_READS.fastq.gz')
+                N_READS_ASSIGNED_KMERS,n_reads_unassigned=assign_reads_to_amplicons(processed_output_filename,amplicon_index,
+                                                                  [clean_filename('AMPL_'+idx) for idx in df_template.index],demultiplexer,
+                                                                  reads_to_align_filename,args.n_processes)
+                info('%d reads assigned with their k-mers, %d reads left to align' % (N_READS_ASSIGNED_KMERS,n_reads_unassigned))
+
+            if args.amplicon_assignment=='bowtie2' or n_reads_unassigned:
+                info('Creating a custom index file with all the amplicons...')
+                custom_index_filename=_jp('CUSTOM_BOWTIE2_INDEX')
+                sb.call('bowtie2-build %s %s >>%s 2>&1' %(amplicon_fa_filename,custom_index_filename,log_filename), shell=True)
+    
+                #align the file to the amplicons (MODE 1), the reads are demultiplexed from the output of bowtie2 while it runs
+                info('Align reads to the amplicons and demultiplex them...')
+                aligner_command= 'bowtie2 -x %s -p %s %s -U %s 2>>%s' %(custom_index_filename,args.n_processes,args.bowtie2_options_string,reads_to_align_filename,log_filename)
+    
+                n_reads_references,N_READS_ALIGNED=align_and_demultiplex_reads(aligner_command,bam_filename_amplicons,_jp(''),log_filename,demultiplexer=demultiplexer,flash_command=flash_command)
+                if flash_command is not None:
+                    N_READS_AFTER_PREPROCESSING=get_n_reads_bam(bam_filename_amplicons)
+            else:
+                n_reads_references,N_READS_ALIGNED=demultiplexer.close(),0
+
+            N_READS_ALIGNED+=N_READS_ASSIGNED_KMERS
             
-            info('Demultiplex reads and run CRISPResso on each amplicon...')
+            info('Run CRISPResso on each amplicon...')
             n_reads_aligned_amplicons=[]
+            crispresso_jobs=[]
             for idx,row in df_template.iterrows():
                 info('\n Processing:%s' %idx)
-                n_reads_aligned_amplicons.append(get_n_reads_fastq(row['Demultiplexed_fastq.gz_filename']))
-                crispresso_cmd='CRISPResso -r1 %s -a %s -o %s --name %s' % (row['Demultiplexed_fastq.gz_filename'],row['Amplicon_Sequence'],OUTPUT_DIRECTORY,idx)
+                n_reads_aligned_amplicons.append(n_reads_references.get(clean_filename('AMPL_'+idx),0))
     
                 if n_reads_aligned_amplicons[-1]>args.min_reads_to_use_region:
-                    if row['sgRNA'] and not pd.isnull(row['sgRNA']):
-                        crispresso_cmd+=' -g %s' % row['sgRNA']
-    
-                    if row['Expected_HDR'] and not pd.isnull(row['Expected_HDR']):
-                        crispresso_cmd+=' -e %s' % row['Expected_HDR']
-    
-                    if row['Coding_sequence'] and not pd.isnull(row['Coding_sequence']):
-                        crispresso_cmd+=' -c %s' % row['Coding_sequence']
-                    
-                    crispresso_cmd=propagate_options(crispresso_cmd,crispresso_options,args)
-                    info('Running CRISPResso:%s' % crispresso_cmd)
-                    sb.call(crispresso_cmd,shell=True)
+                    crispresso_jobs.append((idx,n_reads_aligned_amplicons[-1],get_crispresso_config(row['Demultiplexed_fastq.gz_filename'],row['Amplicon_Sequence'],idx,row)))
                 else:
                     warn('Skipping amplicon [%s] since no reads are aligning to it\n'% idx)
     
+            run_crispresso_jobs(crispresso_jobs)
+    
             df_template['n_reads']=n_reads_aligned_amplicons
             df_template['n_reads_aligned_%']=df_template['n_reads']/float(N_READS_ALIGNED)*100
             df_template.fillna('NA').to_csv(_jp('REPORT_READS_ALIGNED_TO_AMPLICONS.txt'),sep='\t')
@@ -605,14 +939,15 @@ def main():
             print 'Mapping amplicons to the reference genome...'
             #find the locations of the amplicons on the genome and their strand and check if there are mutations in the reference genome
             additional_columns=[]
-            for idx,row in df_template.iterrows():
-                fields_to_append=list(np.take(get_align_sequence(row.Amplicon_Sequence, args.bowtie2_index).split('\t'),[0,1,2,3,5]))
+            amplicon_alignments=get_align_sequences(list(df_template.Amplicon_Sequence),args.bowtie2_index,args.n_processes,args.amplicons_mapping_cache,log_filename)
+            for (idx,row),amplicon_alignment in zip(df_template.iterrows(),amplicon_alignments):
+                fields_to_append=list(amplicon_alignment)
                 if fields_to_append[0]=='*':
                     info('The amplicon [%s] is not mappable to the reference genome provided!' % idx )
                     additional_columns.append([idx,'NOT_ALIGNED',0,-1,'+',''])
                 else:
                     additional_columns.append([idx]+fields_to_append)
-                    info('The amplicon [%s] was mapped to: %s ' % (idx,' '.join(fields_to_append[:3]) ))
+                    info('The amplicon [%s] was mapped to: %s ' % (idx,' '.join(map(str,fields_to_append[:3])) ))
         
         
             df_template=df_template.join(pd.DataFrame(additional_columns,columns=['Name','chr_id','bpstart','bpend','strand','Reference_Sequence']).set_index('Name'))
@@ -656,52 +991,18 @@ def main():
         if RUNNING_MODE=='ONLY_GENOME' or RUNNING_MODE=='AMPLICONS_AND_GENOME':
             info('Aligning reads to the provided genome index...')
             bam_filename_genome = _jp('%s_GENOME_ALIGNED.bam' % database_id)
-            aligner_command= 'bowtie2 -x %s -p %s %s -U %s 2>>%s| samtools view -bS - > %s' %(args.bowtie2_index,args.n_processes,args.bowtie2_options_string,processed_output_filename,log_filename,bam_filename_genome)
+            aligner_command= 'bowtie2 -x %s -p %s %s -U %s 2>>%s' %(args.bowtie2_index,args.n_processes,args.bowtie2_options_string,processed_output_filename,log_filename)
             info(aligner_command)
-            sb.call(aligner_command,shell=True)
-            
-            N_READS_ALIGNED=get_n_aligned_bam(bam_filename_genome)
             
-            #REDISCOVER LOCATIONS and DEMULTIPLEX READS
+            #REDISCOVER LOCATIONS and DEMULTIPLEX READS while they are aligned
             MAPPED_REGIONS=_jp('MAPPED_REGIONS/')
             if not os.path.exists(MAPPED_REGIONS):
                 os.mkdir(MAPPED_REGIONS)
     
-            s1=r'''samtools view -F 0x0004 %s 2>>%s |''' % (bam_filename_genome,log_filename)+\
-            r'''awk '{OFS="\t"; bpstart=$4;  bpend=bpstart; split ($6,a,"[MIDNSHP]"); n=0;\
-            for (i=1; i in a; i++){\
-                n+=1+length(a[i]);\
-                if (substr($6,n,1)=="S"){\
-                    if (bpend==$4)\
-                        bpstart-=a[i];\
-                    else
-                        bpend+=a[i];
-                    }\
-                else if( (substr($6,n,1)!="I")  && (substr($6,n,1)!="H") )\
-                        bpend+=a[i];\
-                }\
-                if ( ($2 % 32)>=16)\
-                    print $3,bpstart,bpend,"-",$1,$10,$11;\
-                else\
-                    print $3,bpstart,bpend,"+",$1,$10,$11;}' | ''' 
-        
-            s2=r'''  sort -k1,1 -k2,2n  | awk \
-            'BEGIN{chr_id="NA";bpstart=-1;bpend=-1; fastq_filename="NA"}\
-            { if ( (chr_id!=$1) || (bpstart!=$2) || (bpend!=$3) )\
-                {\
-                if (fastq_filename!="NA") {close(fastq_filename); system("gzip "fastq_filename)}\
-                chr_id=$1; bpstart=$2; bpend=$3;\
-                fastq_filename=sprintf("__OUTPUTPATH__REGION_%s_%s_%s.fastq",$1,$2,$3);\
-                }\
-            print "@"$5"\n"$6"\n+\n"$7 >> fastq_filename;\
-            }' '''
-            cmd=s1+s2.replace('__OUTPUTPATH__',MAPPED_REGIONS)
-            
             info('Demultiplexing reads by location...')
-            sb.call(cmd,shell=True)
-            
-            #gzip the missing ones 
-            sb.call('gzip %s/*.fastq' % MAPPED_REGIONS,shell=True)
+            n_reads_regions,N_READS_ALIGNED=align_and_demultiplex_reads(aligner_command,bam_filename_genome,MAPPED_REGIONS,log_filename,get_region_name,flash_command=flash_command)
+            if flash_command is not None:
+                N_READS_AFTER_PREPROCESSING=get_n_reads_bam(bam_filename_genome)
     
         '''
         The most common use case, where many different target sites are pooled into a single 
@@ -717,40 +1018,28 @@ def main():
     
         
         if RUNNING_MODE=='AMPLICONS_AND_GENOME':
-            files_to_match=glob.glob(os.path.join(MAPPED_REGIONS,'REGION*'))
+            regions_to_match=set(n_reads_regions.keys())
             n_reads_aligned_genome=[]
             fastq_region_filenames=[]
+            crispresso_jobs=[]
         
             for idx,row in df_template.iterrows():
                 
                 info('Processing amplicon:%s' % idx )
         
                 #check if we have reads
-                fastq_filename_region=os.path.join(MAPPED_REGIONS,'REGION_%s_%s_%s.fastq.gz' % (row['chr_id'],row['bpstart'],row['bpend']))
+                region_name='REGION_%s_%s_%s' % (row['chr_id'],row['bpstart'],row['bpend'])
+                fastq_filename_region=os.path.join(MAPPED_REGIONS,'%s.fastq.gz' % region_name)
         
-                if os.path.exists(fastq_filename_region):
+                if region_name in n_reads_regions:
                     
-                    N_READS=get_n_reads_fastq(fastq_filename_region)
+                    N_READS=n_reads_regions[region_name]
                     n_reads_aligned_genome.append(N_READS)
                     fastq_region_filenames.append(fastq_filename_region)
-                    files_to_match.remove(fastq_filename_region)
+                    regions_to_match.discard(region_name)
                     if N_READS>=args.min_reads_to_use_region:
                         info('\nThe amplicon [%s] has enough reads (%d) mapped to it! Running CRISPResso!\n' % (idx,N_READS))
-        
-                        crispresso_cmd='CRISPResso -r1 %s -a %s -o %s --name %s' % (fastq_filename_region,row['Amplicon_Sequence'],OUTPUT_DIRECTORY,idx)
-        
-                        if row['sgRNA'] and not pd.isnull(row['sgRNA']):
-                            crispresso_cmd+=' -g %s' % row['sgRNA']
-        
-                        if row['Expected_HDR'] and not pd.isnull(row['Expected_HDR']):
-                            crispresso_cmd+=' -e %s' % row['Expected_HDR']
-        
-                        if row['Coding_sequence'] and not pd.isnull(row['Coding_sequence']):
-                            crispresso_cmd+=' -c %s' % row['Coding_sequence']
-                        
-                        crispresso_cmd=propagate_options(crispresso_cmd,crispresso_options,args)
-                        info('Running CRISPResso:%s' % crispresso_cmd)
-                        sb.call(crispresso_cmd,shell=True)
+                        crispresso_jobs.append((idx,N_READS,get_crispresso_config(fastq_filename_region,row['Amplicon_Sequence'],idx,row)))
          
                     else:
                          warn('The amplicon [%s] has not enough reads (%d) mapped to it! Skipping the execution of CRISPResso!' % (idx,N_READS))
@@ -759,6 +1048,8 @@ def main():
                     n_reads_aligned_genome.append(0)
                     warn("The amplicon %s doesn't have any read mapped to it!\n Please check your amplicon sequence." %  idx)
         
+            run_crispresso_jobs(crispresso_jobs)
+        
             df_template['Amplicon_Specific_fastq.gz_filename']=fastq_region_filenames
             df_template['n_reads']=n_reads_aligned_genome
             df_template['n_reads_aligned_%']=df_template['n_reads']/float(N_READS_ALIGNED)*100
@@ -772,8 +1063,8 @@ def main():
             
             info('Reporting problematic regions...')  
             coordinates=[]
-            for region in files_to_match:
-                coordinates.append(os.path.basename(region).replace('.fastq.gz','').replace('.fastq','').split('_')[1:4]+[region,get_n_reads_fastq(region)])
+            for region_name in regions_to_match:
+                coordinates.append(region_name.split('_')[1:4]+[os.path.join(MAPPED_REGIONS,'%s.fastq.gz' % region_name),n_reads_regions[region_name]])
         
             df_regions=pd.DataFrame(coordinates,columns=['chr_id','bpstart','bpend','fastq_file','n_reads'])
     
@@ -801,11 +1092,17 @@ def main():
     
     
         if RUNNING_MODE=='ONLY_GENOME' :
+            if args.cluster_regions:
+                info('Clustering the regions discovered...')
+                n_regions=len(n_reads_regions)
+                n_reads_regions=cluster_regions(n_reads_regions,MAPPED_REGIONS,args.max_region_distance)
+                info('%d regions merged in %d clusters' % (n_regions,len(n_reads_regions)))
+
             #Load regions and build REFERENCE TABLES 
             info('Parsing the demultiplexed files and extracting locations and reference sequences...')
             coordinates=[]
-            for region in glob.glob(os.path.join(MAPPED_REGIONS,'REGION*.fastq.gz')):
-                coordinates.append(os.path.basename(region).replace('.fastq.gz','').split('_')[1:4]+[region,get_n_reads_fastq(region)])
+            for region_name,n_reads_region in n_reads_regions.items():
+                coordinates.append(region_name.split('_')[1:4]+[os.path.join(MAPPED_REGIONS,'%s.fastq.gz' % region_name),n_reads_region])
             
             print 'C:',coordinates
             df_regions=pd.DataFrame(coordinates,columns=['chr_id','bpstart','bpend','fastq_file','n_reads'])
@@ -836,42 +1133,31 @@ def main():
             #run CRISPResso
             #demultiplex reads in the amplicons and call crispresso!
             info('Running CRISPResso on the regions discovered...')
+            crispresso_jobs=[]
             for idx,row in df_regions.iterrows():
         
                 if row.n_reads > args.min_reads_to_use_region:
                     info('\nRunning CRISPResso on: %s-%d-%d...'%(row.chr_id,row.bpstart,row.bpend ))
-                    crispresso_cmd='CRISPResso -r1 %s -a %s -o %s' %(row.fastq_file,row.sequence,OUTPUT_DIRECTORY)  
-                    crispresso_cmd=propagate_options(crispresso_cmd,crispresso_options,args)
-                    info('Running CRISPResso:%s' % crispresso_cmd)
-                    sb.call(crispresso_cmd,shell=True)
+                    crispresso_jobs.append((idx,row.n_reads,get_crispresso_config(row.fastq_file,row.sequence)))
                 else:
                     info('Skipping region: %s-%d-%d , not enough reads (%d)' %(row.chr_id,row.bpstart,row.bpend, row.n_reads))
     
+            run_crispresso_jobs(crispresso_jobs)
+    
     
         #write alignment statistics
         with open(_jp('MAPPING_STATISTICS.txt'),'w+') as outfile:
             outfile.write('READS IN INPUTS:%d\nREADS AFTER PREPROCESSING:%d\nREADS ALIGNED:%d' % (N_READS_INPUT,N_READS_AFTER_PREPROCESSING,N_READS_ALIGNED))
     
         #write a file with basic quantification info for each sample
-        def check_output_folder(output_folder):
-            quantification_file=os.path.join(output_folder,'Quantification_of_editing_frequency.txt')  
-    
-            if os.path.exists(quantification_file):
-                return quantification_file
+        def get_quantification(idx):
+            result=crispresso_results.get(idx)
+
+            if result is not None and result.n_aligned:
+                return result.get_percentages()+[result.n_aligned]
             else:
                 return None
     
-        def parse_quantification(quantification_file):
-            with open(quantification_file) as infile:
-                infile.readline()
-                N_UNMODIFIED=float(re.findall("Unmodified:(\d+)",infile.readline())[0])
-                N_MODIFIED=float(re.findall("NHEJ:(\d+)",infile.readline())[0])
-                N_REPAIRED=float(re.findall("HDR:(\d+)", infile.readline())[0])
-                N_MIXED_HDR_NHEJ=float(re.findall("Mixed HDR-NHEJ:(\d+)", infile.readline())[0])
-                infile.readline()
-                N_TOTAL=float(re.findall("Total Aligned:(\d+) reads",infile.readline())[0])
-                return N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,N_TOTAL
-    
         quantification_summary=[]
     
         if RUNNING_MODE=='ONLY_AMPLICONS' or RUNNING_MODE=='AMPLICONS_AND_GENOME':
@@ -886,11 +1172,10 @@ def main():
                 else:
                     folder_name='CRISPResso_on_REGION_%s_%d_%d' %(row.chr_id,row.bpstart,row.bpend )
     
-                quantification_file=check_output_folder(_jp(folder_name))
+                quantification=get_quantification(idx)
     
-                if quantification_file:
-                    N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,N_TOTAL=parse_quantification(quantification_file)
-                    quantification_summary.append([idx,N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100,N_REPAIRED/N_TOTAL*100,N_MIXED_HDR_NHEJ/N_TOTAL*100,N_TOTAL,row.n_reads])
+                if quantification:
+                    quantification_summary.append([idx]+quantification+[row.n_reads])
                 else:
                     quantification_summary.append([idx,np.nan,np.nan,np.nan,np.nan,np.nan,row.n_reads])
                     warn('Skipping the folder %s, not enough reads or empty folder.'% folder_name)
@@ -899,6 +1184,10 @@ def main():
         df_summary_quantification=pd.DataFrame(quantification_summary,columns=['Name','Unmodified%','NHEJ%','HDR%', 'Mixed_HDR-NHEJ%','Reads_aligned','Reads_total'])        
         df_summary_quantification.fillna('NA').to_csv(_jp('SAMPLES_QUANTIFICATION_SUMMARY.txt'),sep='\t',index=None)        
 
+        if crispresso_failures:
+            pd.DataFrame(crispresso_failures,columns=['Name','Error']).to_csv(_jp('REPORT_FAILED_CRISPRESSO_RUNS.txt'),sep='\t',index=None)
+            warn('The CRISPResso analysis failed for %d amplicons, the errors are reported in %s' % (len(crispresso_failures),_jp('REPORT_FAILED_CRISPRESSO_RUNS.txt')))
+
 	
 	if RUNNING_MODE != 'ONLY_GENOME':
 		tot_reads_aligned = df_summary_quantification['Reads_aligned'].fillna(0).sum()
@@ -909,7 +1198,10 @@ def main():
 		if RUNNING_MODE=='ONLY_AMPLICONS':  
 			this_bam_filename = bam_filename_amplicons
 		#if less than 1/2 of reads aligned, find most common unaligned reads and advise the user
-		if tot_reads > 0 and tot_reads_aligned/tot_reads < 0.5:
+		#with --amplicon_assignment kmer the bam file is written only if some reads were not assigned with their k-mers
+		if tot_reads > 0 and tot_reads_aligned/float(tot_reads) < 0.5 and not os.path.exists(this_bam_filename):
+			warn('Less than half (%d/%d) of reads aligned. All the reads were assigned to the amplicons with their k-mers, perhaps one or more of the given amplicon sequences were incomplete or incorrect.'%(tot_reads_aligned,tot_reads))
+		elif tot_reads > 0 and tot_reads_aligned/float(tot_reads) < 0.5:
 			warn('Less than half (%d/%d) of reads aligned. Finding most frequent unaligned reads.'%(tot_reads_aligned,tot_reads))
 			###
 			###this results in the unpretty messages being printed:
@@ -940,7 +1232,9 @@ def main():
         if not args.keep_intermediate:
              info('Removing Intermediate files...')
         
-             if args.fastq_r2!='':
+             if flash_command is not None:
+                 files_to_remove=[]
+             elif args.fastq_r2!='':
                  files_to_remove=[processed_output_filename,flash_hist_filename,flash_histogram_filename,\
                               flash_not_combined_1_filename,flash_not_combined_2_filename] 
              else:
@@ -955,6 +1249,8 @@ def main():
                  
              if RUNNING_MODE=='ONLY_AMPLICONS':  
                 files_to_remove+=[bam_filename_amplicons,amplicon_fa_filename]
+                if args.amplicon_assignment=='kmer':
+                    files_to_remove.append(reads_to_align_filename)
                 for bowtie2_file in glob.glob(_jp('CUSTOM_BOWTIE2_INDEX.*')):
                     files_to_remove.append(bowtie2_file)
         
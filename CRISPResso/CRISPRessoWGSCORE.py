@@ -196,6 +196,8 @@ def write_trimmed_fastq(in_bam_filename,bpstart,bpend,out_fastq_filename):
 pd=check_library('pandas')
 np=check_library('numpy')
 
+from CRISPResso import CRISPRessoCORE
+
 ###EXCEPTIONS############################
 
 class AmpliconsNamesNotUniqueException(Exception):
@@ -265,6 +267,8 @@ def main():
         parser.add_argument('--keep_intermediate',help='Keep all the  intermediate files',action='store_true')
         parser.add_argument('--dump',help='Dump numpy arrays and pandas dataframes to file for debugging purposes',action='store_true')
         parser.add_argument('--save_also_png',help='Save also .png images additionally to .pdf files',action='store_true')
+        parser.add_argument('--plot_level',type=str,help='Figures to create for each amplicon: none, only the summary figures or all the figures',choices=['none','summary','full'],default='full')
+        parser.add_argument('--vector_alleles_table',help='Draw each nucleotide of the alleles table plots as a vector element instead of drawing the tables as images, slower for large tables',action='store_true')
         parser.add_argument('-p','--n_processes',type=int, help='Specify the number of processes to use for the quantification.\
         Please use with caution since increasing this parameter will increase significantly the memory required to run CRISPResso.',default=1)
     
@@ -279,25 +283,28 @@ def main():
                                   'needle_options_string',
                                   'keep_intermediate',
                                   'dump',
-                                  'save_also_png','hide_mutations_outside_window_NHEJ','n_processes',]
+                                  'save_also_png','plot_level','vector_alleles_table','hide_mutations_outside_window_NHEJ','n_processes',]
         
            
         
-        def propagate_options(cmd,options,args):
-        
-            for option in options :
-                if option:
-                    val=eval('args.%s' % option )
-      
-                    if type(val)==str:
-                        cmd+=' --%s "%s"' % (option,str(val)) # this is for options with space like needle...
-                    elif type(val)==bool:
-                        if val:
-                            cmd+=' --%s' % option
-                    else:
-                        cmd+=' --%s %s' % (option,str(val))
-                
-            return cmd
+        def get_crispresso_config(fastq_r1,amplicon_seq,name=None,row=None):
+            #the options propagated to CRISPResso and the sgRNA, expected HDR and coding sequence of the amplicon
+            config=dict([(option,getattr(args,option)) for option in crispresso_options])
+            config.update(fastq_r1=fastq_r1,amplicon_seq=amplicon_seq,output_folder=OUTPUT_DIRECTORY)
+
+            if name is not None:
+                config['name']=name
+
+            if row is not None:
+                for column,option in [('sgRNA','guide_seq'),('Expected_HDR','expected_hdr_amplicon_seq'),('Coding_sequence','coding_seq')]:
+                    if row[column] and not pd.isnull(row[column]):
+                        config[option]=row[column]
+
+            return config
+
+        #CRISPResso runs in a process forked from this one, the results are returned directly
+        crispresso_results={}
+        crispresso_failures=[]
     
     
             
@@ -491,21 +498,13 @@ def main():
                if row['n_reads']>=args.min_reads_to_use_region:
                     info('\nThe region [%s] has enough reads (%d) mapped to it!' % (idx,row['n_reads']))
         
-                    crispresso_cmd='CRISPResso -r1 %s -a %s -o %s --name %s' %\
-                    (row['fastq.gz_file_trimmed_reads_in_region'],row['sequence'],OUTPUT_DIRECTORY,idx)
-        
-                    if row['sgRNA'] and not pd.isnull(row['sgRNA']):
-                        crispresso_cmd+=' -g %s' % row['sgRNA']
-        
-                    if row['Expected_HDR'] and not pd.isnull(row['Expected_HDR']):
-                        crispresso_cmd+=' -e %s' % row['Expected_HDR']
-        
-                    if row['Coding_sequence'] and not pd.isnull(row['Coding_sequence']):
-                        crispresso_cmd+=' -c %s' % row['Coding_sequence']
-        
-                    crispresso_cmd=propagate_options(crispresso_cmd,crispresso_options,args)
-                    info('Running CRISPResso:%s' % crispresso_cmd)
-                    sb.call(crispresso_cmd,shell=True)
+                    info('Running CRISPResso on %s' % idx)
+                    status,result,error_message,exit_code=CRISPRessoCORE.run_crispresso_in_process(get_crispresso_config(row['fastq.gz_file_trimmed_reads_in_region'],row['sequence'],idx,row))
+                    if status=='done':
+                        crispresso_results[idx]=result
+                    else:
+                        warn('The CRISPResso analysis of %s failed: %s' % (idx,error_message))
+                        crispresso_failures.append([idx,error_message])
         
                else:
                     info('\nThe region [%s] has not enough reads (%d) mapped to it! Skipping the running of CRISPResso!' % (idx,row['n_reads']))
@@ -515,35 +514,23 @@ def main():
 
 
         #write a stat file with basic info for each sample
-        def check_output_folder(output_folder):
-            quantification_file=os.path.join(output_folder,'Quantification_of_editing_frequency.txt')  
-    
-            if os.path.exists(quantification_file):
-                return quantification_file
+        def get_quantification(idx):
+            result=crispresso_results.get(idx)
+
+            if result is not None and result.n_aligned:
+                return result.get_percentages()+[result.n_aligned]
             else:
                 return None
     
-        def parse_quantification(quantification_file):
-            with open(quantification_file) as infile:
-                infile.readline()
-                N_UNMODIFIED=float(re.findall("Unmodified:(\d+)",infile.readline())[0])
-                N_MODIFIED=float(re.findall("NHEJ:(\d+)",infile.readline())[0])
-                N_REPAIRED=float(re.findall("HDR:(\d+)", infile.readline())[0])
-                N_MIXED_HDR_NHEJ=float(re.findall("Mixed HDR-NHEJ:(\d+)", infile.readline())[0])
-                infile.readline()
-                N_TOTAL=float(re.findall("Total Aligned:(\d+) reads",infile.readline())[0])
-                return N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,N_TOTAL
-    
         quantification_summary=[]
         
         for idx,row in df_regions.iterrows():
 
             folder_name='CRISPResso_on_%s' % idx
-            quantification_file=check_output_folder(_jp(folder_name))
+            quantification=get_quantification(idx)
     
-            if quantification_file:
-                N_UNMODIFIED,N_MODIFIED,N_REPAIRED,N_MIXED_HDR_NHEJ,N_TOTAL=parse_quantification(quantification_file)
-                quantification_summary.append([idx,N_UNMODIFIED/N_TOTAL*100,N_MODIFIED/N_TOTAL*100,N_REPAIRED/N_TOTAL*100,N_MIXED_HDR_NHEJ/N_TOTAL*100,N_TOTAL,row.n_reads])
+            if quantification:
+                quantification_summary.append([idx]+quantification+[row.n_reads])
             else:
                 quantification_summary.append([idx,np.nan,np.nan,np.nan,np.nan,np.nan,row.n_reads])
                 warn('Skipping the folder %s, not enough reads or empty folder.'% folder_name)
@@ -552,6 +539,10 @@ def main():
         df_summary_quantification=pd.DataFrame(quantification_summary,columns=['Name','Unmodified%','NHEJ%','HDR%', 'Mixed_HDR-NHEJ%','Reads_aligned','Reads_total'])        
         df_summary_quantification.fillna('NA').to_csv(_jp('SAMPLES_QUANTIFICATION_SUMMARY.txt'),sep='\t',index=None)        
 
+        if crispresso_failures:
+            pd.DataFrame(crispresso_failures,columns=['Name','Error']).to_csv(_jp('REPORT_FAILED_CRISPRESSO_RUNS.txt'),sep='\t',index=None)
+            warn('The CRISPResso analysis failed for %d regions, the errors are reported in %s' % (len(crispresso_failures),_jp('REPORT_FAILED_CRISPRESSO_RUNS.txt')))
+
     
         info('All Done!')
         print r'''
@@ -85,6 +85,9 @@ def main():
               'argparse>=1.3',
 			  'seaborn>=0.7.1',
               ],
+          extras_require={
+              'hdf5':['tables>=3.1'],
+              },
 
           )
 
@@ -0,0 +1,93 @@
+'''
+Tests of CRISPResso, run with: python -m unittest discover tests
+'''
+import random
+import unittest
+
+from CRISPResso import CRISPRessoCORE
+
+
+def get_random_seq(length,seed):
+    rng=random.Random(seed)
+    return ''.join([rng.choice('ACGT') for _ in range(length)])
+
+
+class AmpliconKmerIndexTest(unittest.TestCase):
+    def setUp(self):
+        self.amplicon_seqs=[get_random_seq(150,1),get_random_seq(150,2)]
+        self.amplicon_index=CRISPRessoCORE.AmpliconKmerIndex(self.amplicon_seqs,k=10)
+
+    def test_reads_are_assigned_to_their_amplicon_on_both_strands(self):
+        self.assertEqual(self.amplicon_index.assign(self.amplicon_seqs[0]),0)
+        self.assertEqual(self.amplicon_index.assign(self.amplicon_seqs[1][20:130]),1)
+        self.assertEqual(self.amplicon_index.assign(CRISPRessoCORE.reverse_complement(self.amplicon_seqs[1])),1)
+
+    def test_reads_with_an_indel_are_assigned(self):
+        self.assertEqual(self.amplicon_index.assign(self.amplicon_seqs[0][:70]+self.amplicon_seqs[0][90:]),0)
+        self.assertEqual(self.amplicon_index.assign(self.amplicon_seqs[0][:70]+'ACGTACGTAC'+self.amplicon_seqs[0][70:]),0)
+
+    def test_reads_sharing_only_a_primer_are_not_assigned(self):
+        primer_dimer=self.amplicon_seqs[0][:20]+get_random_seq(100,3)
+        self.assertIsNone(self.amplicon_index.assign(primer_dimer))
+        self.assertEqual(CRISPRessoCORE.AmpliconKmerIndex(self.amplicon_seqs,k=10,min_kmer_fraction=0).assign(primer_dimer),0)
+
+    def test_the_kmers_with_Ns_are_not_counted(self):
+        #the mates of a pair are assigned together, separated by Ns
+        pair=self.amplicon_seqs[1][:60]+'N'*10+CRISPRessoCORE.reverse_complement(self.amplicon_seqs[1][-60:])
+        self.assertEqual(self.amplicon_index.assign(pair),1)
+        self.assertIsNone(self.amplicon_index.assign('N'*50))
+
+    def test_kmers_shared_by_the_amplicons_are_not_specific(self):
+        shared_seq=get_random_seq(40,4)
+        amplicon_index=CRISPRessoCORE.AmpliconKmerIndex([shared_seq+self.amplicon_seqs[0],shared_seq+self.amplicon_seqs[1]],k=10)
+        self.assertFalse(any([shared_seq[i:i+10] in amplicon_index.kmer_to_amplicon for i in range(31)]))
+        self.assertIsNone(amplicon_index.assign(shared_seq))
+
+
+def needle_record(ref_seq,seq):
+    '''
+    The alignment record of seq as align_sequences reports it, with the scores of needle (EDNAFULL, gap open 10,
+    gap extend 0.5, end gaps free)
+    '''
+    aln_ref_seq,aln_seq=CRISPRessoCORE.pairwise2.align.globalms(ref_seq,seq,5,-4,-10,-0.5,penalize_end_gaps=False,one_alignment_only=True)[0][:2]
+    aln_str=''.join(['|' if a==b else ('.' if a!='-' and b!='-' else ' ') for a,b in zip(aln_ref_seq,aln_seq)])
+    identity=float('%.1f' % (100.0*aln_str.count('|')/len(aln_ref_seq)))
+    return ('FW',identity,None,len(aln_ref_seq),aln_ref_seq,aln_str,aln_seq)
+
+
+class DeriveNearDuplicateAlignmentTest(unittest.TestCase):
+    def setUp(self):
+        #a random amplicon with a poly-A repeat in the middle
+        self.amplicon_seq=get_random_seq(60,5)+'GAAAAAAC'+get_random_seq(60,6)
+        self.include_idxs=set(range(55,75))
+
+    def derive(self,seq,representative_seq):
+        return CRISPRessoCORE.derive_near_duplicate_alignment(seq,representative_seq,needle_record(self.amplicon_seq,representative_seq),
+                                                              None,self.include_idxs,50)
+
+    def substitute(self,seq,position):
+        return seq[:position]+('A' if seq[position]!='A' else 'C')+seq[position+1:]
+
+    def test_derived_alignment_is_the_alignment_of_the_near_duplicate(self):
+        representative_seq=self.amplicon_seq[:20]+self.amplicon_seq[23:]
+        for position in [5,40,100,120]:
+            seq=self.substitute(representative_seq,position)
+            self.assertEqual(self.derive(seq,representative_seq),needle_record(self.amplicon_seq,seq))
+
+    def test_substitutions_in_the_quantification_window_are_not_derived(self):
+        representative_seq=self.amplicon_seq
+        self.assertIsNone(self.derive(self.substitute(representative_seq,60),representative_seq))
+
+    def test_substitutions_around_a_gap_in_a_repeat_are_not_derived(self):
+        #the deletion of two As can be placed anywhere in the repeat, a substitution in it or next to it may move it
+        self.include_idxs=set()
+        representative_seq=self.amplicon_seq[:62]+self.amplicon_seq[64:]
+        for position in [59,60,62,64,65]:
+            self.assertIsNone(self.derive(self.substitute(representative_seq,position),representative_seq))
+
+        seq=self.substitute(representative_seq,50)
+        self.assertEqual(self.derive(seq,representative_seq),needle_record(self.amplicon_seq,seq))
+
+
+if __name__ == '__main__':
+    unittest.main()
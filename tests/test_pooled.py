@@ -0,0 +1,95 @@
+'''
+Tests of the demultiplexing and of the clustering of the regions of CRISPRessoPooled, run with: python -m unittest discover tests
+'''
+import gzip
+import os
+import shutil
+import tempfile
+import unittest
+from distutils.spawn import find_executable
+
+from CRISPResso import CRISPRessoPooledCORE
+
+
+def read_fastq_names(fastq_filename):
+    with gzip.open(fastq_filename) as handle:
+        return [line[1:].strip() for idx_line,line in enumerate(handle) if idx_line%4==0]
+
+
+@unittest.skipUnless(find_executable('samtools'),'samtools is required to write the bam file')
+class AlignAndDemultiplexReadsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.sam_filename=os.path.join(self.folder,'reads.sam')
+        self.log_filename=os.path.join(self.folder,'log.txt')
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def align_and_demultiplex(self,sam_records):
+        with open(self.sam_filename,'w+') as outfile:
+            outfile.write('@HD\tVN:1.0\n@SQ\tSN:AMPL_A\tLN:8\n@SQ\tSN:AMPL_B\tLN:8\n')
+            for read_name,flag,reference_name,read_seq in sam_records:
+                outfile.write('%s\t%d\t%s\t1\t42\t8M\t*\t0\t0\t%s\t%s\n' % (read_name,flag,reference_name,read_seq,'I'*len(read_seq) if read_seq!='*' else '*'))
+
+        return CRISPRessoPooledCORE.align_and_demultiplex_reads('cat %s' % self.sam_filename,os.path.join(self.folder,'reads.bam'),
+                                                                 os.path.join(self.folder,''),self.log_filename)
+
+    def test_secondary_and_supplementary_alignments_are_skipped(self):
+        n_reads_targets,n_reads_aligned=self.align_and_demultiplex([('read1',0,'AMPL_A','ACGTACGT'),
+                                                                    ('read1',256,'AMPL_B','*'),
+                                                                    ('read2',16,'AMPL_B','TTGGCCAA'),
+                                                                    ('read2',2048,'AMPL_A','TTGG'),
+                                                                    ('read3',4,'*','GGGGCCCC')])
+
+        self.assertEqual(n_reads_aligned,2)
+        self.assertEqual(n_reads_targets,{'AMPL_A':1,'AMPL_B':1})
+        self.assertEqual(read_fastq_names(os.path.join(self.folder,'AMPL_A.fastq.gz')),['read1'])
+        self.assertEqual(read_fastq_names(os.path.join(self.folder,'AMPL_B.fastq.gz')),['read2'])
+
+    def test_target_without_primary_alignments_is_not_written(self):
+        n_reads_targets,n_reads_aligned=self.align_and_demultiplex([('read1',0,'AMPL_A','ACGTACGT'),
+                                                                    ('read1',256,'AMPL_B','*')])
+
+        self.assertEqual(n_reads_targets,{'AMPL_A':1})
+        self.assertFalse(os.path.exists(os.path.join(self.folder,'AMPL_B.fastq.gz')))
+
+
+class ClusterRegionsTest(unittest.TestCase):
+    def setUp(self):
+        self.folder=tempfile.mkdtemp()
+        self.n_reads_regions={'REGION_chr1_100_200':2,'REGION_chr1_150_250':1,'REGION_chr1_253_300':1,
+                              'REGION_chr1_1000_1100':1,'REGION_chrUn_gl000220_100_200':1}
+        for region_name,n_reads in self.n_reads_regions.items():
+            with gzip.open(os.path.join(self.folder,'%s.fastq.gz' % region_name),'wb') as outfile:
+                for idx_read in range(n_reads):
+                    outfile.write('@%s_%d\nACGT\n+\nIIII\n' % (region_name,idx_read))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def get_filename(self,region_name):
+        return os.path.join(self.folder,'%s.fastq.gz' % region_name)
+
+    def test_overlapping_regions_are_merged(self):
+        n_reads_clusters=CRISPRessoPooledCORE.cluster_regions(self.n_reads_regions,self.folder)
+
+        self.assertEqual(n_reads_clusters,{'REGION_chr1_100_250':3,'REGION_chr1_253_300':1,'REGION_chr1_1000_1100':1,
+                                           'REGION_chrUn_gl000220_100_200':1})
+        self.assertEqual(sorted(read_fastq_names(self.get_filename('REGION_chr1_100_250'))),
+                         ['REGION_chr1_100_200_0','REGION_chr1_100_200_1','REGION_chr1_150_250_0'])
+        self.assertFalse(os.path.exists(self.get_filename('REGION_chr1_100_200')))
+        self.assertFalse(os.path.exists(self.get_filename('REGION_chr1_150_250')))
+        self.assertTrue(os.path.exists(self.get_filename('REGION_chr1_253_300')))
+
+    def test_regions_at_most_max_region_distance_apart_are_merged(self):
+        n_reads_clusters=CRISPRessoPooledCORE.cluster_regions(self.n_reads_regions,self.folder,max_region_distance=3)
+
+        self.assertEqual(n_reads_clusters,{'REGION_chr1_100_300':4,'REGION_chr1_1000_1100':1,'REGION_chrUn_gl000220_100_200':1})
+        self.assertEqual(len(read_fastq_names(self.get_filename('REGION_chr1_100_300'))),4)
+        self.assertEqual(sorted(os.listdir(self.folder)),['REGION_chr1_1000_1100.fastq.gz','REGION_chr1_100_300.fastq.gz',
+                                                          'REGION_chrUn_gl000220_100_200.fastq.gz'])
+
+
+if __name__ == '__main__':
+    unittest.main()